@@ -1,31 +1,316 @@
-from flask import Flask, request, jsonify, abort, render_template, send_from_directory
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from flask import Flask, request, jsonify, abort, render_template, send_from_directory, Response, stream_with_context, g
+from flask.json import JSONEncoder
 from flask_cors import CORS
 import os
 from werkzeug.exceptions import HTTPException
 from datetime import datetime
-import re
-from pyfcm import FCMNotification
+import json
+import click
+import hashlib
+import logging
+import signal
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from sqlalchemy import and_, event, text
+from sqlalchemy.orm import load_only, selectinload
 
-from models import Client, Message, Notification, Token, TokenNotification, setup_db
-from exceptions import InvalidContactException, DatabaseInsertionException, RegistrationIDsNULLException, JSONBodyFormatException, MissingJSONBodyException
-from config import api_key, api_limit_per_minute
+from models import db, Client, Message, Notification, Token, TokenNotification, Topic, ScheduledJob, DeadLetter, setup_db, prewarm_pool, read_engine, reads_from_replica, pool_checkout_observers, PoolTimeoutError
+from exceptions import InvalidContactException, DatabaseInsertionException, RegistrationIDsNULLException, JSONBodyFormatException, MissingJSONBodyException, SMSProviderException, FCMProviderException, InvalidQueryParameterException, exception_messages, exception_response
+from fcm_dispatcher import FCMDispatcher, parse_delivery_results, retryable_delivery_errors
+from jobs import JobQueue
+from caching import CountingTTLCache
+from sms_providers import create_sms_provider, ResilientSMSProvider
+from unit_of_work import unit_of_work, GroupCommitter, CommitCounter
+from history_log import HistoryLog
+from rate_limiting import RateLimit, RateLimiter, client_key, create_rate_limit_storage
+from pagination import keyset_page, parse_fields, parse_limit, project
+from exports import export, export_formats, export_queries
+from dead_tokens import DeadTokenSet, dead_token_errors
+from partitions import maintain_partitions, retention_actions
+from metrics import MetricsRegistry, record_stage, timed_stage
+from profiling import RequestProfiler
+from structured_logging import setup_logging
+from idempotency import create_idempotency_store
+from scheduler import Scheduler, spread_run_times
+from resilience import CircuitBreaker, Resilience, RetryPolicy
+from validation import is_valid_contact_format, validate_sms_body, validate_tokens_notification_body, validate_topic_notification_body, validate_schedule
+from config import api_key, api_limit_per_minute, client_api_keys, contact_limit_per_minute, notification_api_limit_per_minute, topic_limit_per_minute, rate_limit_enabled, rate_limit_storage, rate_limit_storage_settings, fcm_chunk_size, fcm_max_workers, fcm_timeout_seconds, fcm_endpoint, async_workers, async_queue_size, async_tracked_jobs, sms_batch_size, client_cache_size, client_cache_ttl_seconds, sms_provider_name, sms_provider_settings, group_commit_enabled, group_commit_max_batch, group_commit_window_ms, history_write_behind, history_log_settings, history_page_size, history_max_page_size, export_chunk_size, dead_tokens_refresh_seconds, audience_batch_size, audience_cache_size, audience_cache_ttl_seconds, history_partitions_ahead_months, history_retention_months, history_retention_action, metrics_dir, metrics_flush_interval_seconds, profile_dir, profile_sample_rate, profile_token, profile_max_files, n_plus_one_threshold, log_level, log_queue_size, log_max_field_length, log_payload_sample_rate, db_prewarm_connections, idempotency_storage, idempotency_redis_url, idempotency_cache_size, idempotency_ttl_seconds, idempotency_wait_timeout_seconds, idempotency_claim_ttl_seconds, scheduler_enabled, scheduler_tick_seconds, scheduler_poll_seconds, scheduler_horizon_seconds, scheduler_batch_size, scheduler_max_loaded_jobs, scheduler_workers, scheduler_lease_seconds, provider_retry_attempts, provider_retry_base_delay_seconds, provider_retry_max_delay_seconds, circuit_failure_rate, circuit_min_calls, circuit_window_seconds, circuit_open_seconds
 
 # Constants region
-contact_fixed_length = 13
 api_key = api_key
 ##################
 
+# JSON responses are serialized by this encoder, so the serialization time is measured per request
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        with timed_stage('serialization'):
+            return super().encode(o)
+
 def initialize_app():
     app = Flask(__name__)
+    app.json_encoder = TimedJSONEncoder
     setup_db(app)
     CORS(app)
     return app
 
+# Non-blocking JSON logs (see "structured_logging.py"), set up before the app so Flask does not add its own handler
+log_handler = setup_logging(level=log_level, queue_size=log_queue_size, max_field_length=log_max_field_length, payload_sample_rate=log_payload_sample_rate)
+logger = logging.getLogger(__name__)
+
 # Initializing app
 app = initialize_app()
-limiter = Limiter(app, key_func=get_remote_address)
+limiter = RateLimiter(create_rate_limit_storage(rate_limit_storage, **rate_limit_storage_settings[rate_limit_storage]), enabled=rate_limit_enabled)
+# Circuit breaker and retries of each provider (see "resilience.py")
+def create_resilience(open_error):
+    return Resilience(
+        RetryPolicy(provider_retry_attempts, base_delay_seconds=provider_retry_base_delay_seconds, max_delay_seconds=provider_retry_max_delay_seconds),
+        CircuitBreaker(failure_rate_threshold=circuit_failure_rate, min_calls=circuit_min_calls,
+                       window_seconds=circuit_window_seconds, open_seconds=circuit_open_seconds),
+        open_error)
+provider_resilience = {
+    'fcm': create_resilience(lambda retry_after: FCMProviderException('FCM is failing, circuit open', 503, 'circuit_open', retry_after)),
+    'sms': create_resilience(lambda retry_after: SMSProviderException('SMS provider is failing, circuit open', 503, 'circuit_open', retry_after))
+}
+# One long-lived FCM client (with its connection pool) per worker process
+fcm_dispatcher = FCMDispatcher(api_key, chunk_size=fcm_chunk_size, max_workers=fcm_max_workers, timeout=fcm_timeout_seconds, endpoint=fcm_endpoint,
+                               resilience=provider_resilience['fcm'])
+# Bounded queue of the requests accepted in asynchronous mode
+job_queue = JobQueue(app, workers=async_workers, max_queued_jobs=async_queue_size, max_tracked_jobs=async_tracked_jobs)
+# contact -> client id
+client_id_cache = CountingTTLCache(maxsize=client_cache_size, ttl=client_cache_ttl_seconds)
+sms_provider = ResilientSMSProvider(create_sms_provider(sms_provider_name, **sms_provider_settings[sms_provider_name]), provider_resilience['sms'])
+group_committer = GroupCommitter(lambda: db.engine, max_batch=group_commit_max_batch, window_seconds=group_commit_window_ms / 1000)
+# Write-behind log of the sent messages and notifications (used when "history_write_behind" is set)
+history_log = HistoryLog(engine_getter=lambda: db.engine, **history_log_settings)
+# (kind, name) -> (topic id, member count) of the local topics and segments
+audience_cache = CountingTTLCache(maxsize=audience_cache_size, ttl=audience_cache_ttl_seconds)
+# Tokens marked inactive, filtered out before the fan-out
+dead_tokens = DeadTokenSet(lambda: db.engine, refresh_interval_seconds=dead_tokens_refresh_seconds)
+# Commits issued by this worker process (in total and per request)
+commit_counter = CommitCounter()
+with app.app_context():
+    commit_counter.install(db.engine)
+##################
+
+# Metrics
+metrics_registry = MetricsRegistry(directory=metrics_dir, flush_interval_seconds=metrics_flush_interval_seconds)
+request_duration = metrics_registry.histogram(
+    'http_request_duration_seconds', 'Request latency by route', ('route', 'method', 'status'))
+request_stage_duration = metrics_registry.histogram(
+    'http_request_stage_seconds', 'Time spent per request in the database, provider I/O and serialization', ('route', 'stage'))
+db_commits = metrics_registry.counter('db_commits_total', 'Database commits')
+fcm_results = metrics_registry.counter('fcm_results_total', 'FCM results per token by error type', ('result',))
+metrics_registry.gauge('job_queue_depth', 'Accepted jobs waiting for a worker', lambda: {(): job_queue.depth()})
+metrics_registry.callback_counter('rate_limit_rejections_total', 'Requests rejected by the rate limits', lambda: {(): limiter.rejections})
+metrics_registry.gauge('db_pool_connections', 'Database pool connections by state', lambda: db_pool_usage(), ('state',))
+db_pool_checkout_wait = metrics_registry.histogram(
+    'db_pool_checkout_wait_seconds', 'Time waited for a database connection', ('pool',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5))
+db_pool_checkout_timeouts = metrics_registry.counter(
+    'db_pool_checkout_timeouts_total', 'Database connection checkouts that timed out (exhausted pool)', ('pool',))
+metrics_registry.callback_counter('log_records_dropped_total', 'Log records dropped because the log queue was full', lambda: {(): log_handler.dropped})
+metrics_registry.callback_counter('scheduled_jobs_total', 'Scheduled jobs sent by this worker by final status',
+                                  lambda: {(status,): count for status, count in scheduler.finished.items()}, ('status',))
+metrics_registry.gauge('scheduled_jobs_loaded', 'Scheduled jobs waiting in the timer wheel', lambda: {(): len(scheduler.loaded)})
+metrics_registry.callback_counter('provider_retries_total', 'Provider calls retried by error class', lambda: {
+    (provider, error_class): count
+    for provider, resilience in provider_resilience.items() for error_class, count in resilience.retries.items()
+}, ('provider', 'error_class'))
+metrics_registry.gauge('circuit_breaker_open', 'Whether the circuit of the provider is open (1) or half open (0.5)', lambda: {
+    (provider,): {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 0.5, CircuitBreaker.OPEN: 1}[resilience.breaker.state]
+    for provider, resilience in provider_resilience.items()
+}, ('provider',))
+metrics_registry.callback_counter('circuit_breaker_rejections_total', 'Provider calls failed at once by an open circuit', lambda: {
+    (provider,): resilience.breaker.rejections for provider, resilience in provider_resilience.items()
+}, ('provider',))
+
+def observe_pool_checkout(pool_name, seconds, timed_out):
+    db_pool_checkout_wait.observe(seconds, pool_name)
+    if timed_out:
+        db_pool_checkout_timeouts.inc(1, pool_name)
+
+pool_checkout_observers.append(observe_pool_checkout)
+
+def db_pool_usage():
+    pool = db.engine.pool
+    if not hasattr(pool, 'checkedout'):
+        return {}
+    return {
+        ('checked_out',): pool.checkedout(),
+        ('idle',): pool.checkedin(),
+        ('overflow',): max(pool.overflow(), 0),
+        ('size',): pool.size()
+    }
+
+# Counts the FCM results per token (or per topic message) by error type
+def count_fcm_results(result):
+    token_results = result.get('results') or []
+    if not token_results:
+        fcm_results.inc(result.get('success', 0), 'success')
+        fcm_results.inc(result.get('failure', 0), 'failure')
+        return
+    for error, count in Counter(token_result.get('error') or 'success' for token_result in token_results).items():
+        fcm_results.inc(count, error)
+
+# The start time is kept on the execution context of the statement: "after_cursor_execute" is not
+# called when the statement fails, so nothing must be left behind on the (pooled) connection
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started_at = time.perf_counter()
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, 'query_started_at', None)
+    if started_at is not None:
+        record_stage('db', time.perf_counter() - started_at)
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(db.engine, 'commit', lambda connection: db_commits.inc())
+
+@app.before_request
+def start_request_metrics():
+    metrics_registry.start()
+    g.request_started_at = time.perf_counter()
+    g.stage_seconds = {}
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started_at' not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_duration.observe(time.perf_counter() - g.request_started_at, route, request.method, response.status_code)
+    for stage, seconds in g.stage_seconds.items():
+        request_stage_duration.observe(seconds, route, stage)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics_registry.exposition(), mimetype='text/plain; version=0.0.4')
+##################
+
+# Opt-in per request profiling (see "profiling.py")
+profiler = RequestProfiler(profile_dir, sample_rate=profile_sample_rate, token=profile_token,
+                           max_files=profile_max_files, n_plus_one_threshold=n_plus_one_threshold)
+with app.app_context():
+    profiler.init_app(app, db.engine)
+##################
+
+# Health checks and draining (see "gunicorn.conf.py")
+# The worker stops being ready as soon as it receives SIGTERM, then "drain" finishes
+# the background sends once the in-flight requests are served
+draining = threading.Event()
+
+def watch_termination():
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    def handle_termination(signum, frame):
+        draining.set()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+    signal.signal(signal.SIGTERM, handle_termination)
+
+# Opens the first connections of the worker's pools before it serves requests
+def prewarm_database_pools():
+    with app.app_context():
+        for engine in {db.engine, read_engine()}:
+            try:
+                prewarm_pool(engine, db_prewarm_connections)
+            except Exception:
+                logger.exception('database pool prewarming failed')
+
+def drain():
+    draining.set()
+    scheduler.stop()
+    job_queue.shutdown()
+    group_committer.stop()
+    if history_write_behind:
+        history_log.close()
+    fcm_dispatcher.close()
+    sms_provider.close()
+    dead_tokens.stop()
+    if metrics_registry.directory is not None:
+        metrics_registry.write_snapshot()
+    log_handler.stop()
+
+# Liveness: the process serves requests
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    return jsonify({
+        'success': True
+    }), 200
+
+# Readiness: the worker accepts new requests, the database answers and the job queue has room
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    checks = {
+        'accepting': not draining.is_set(),
+        'job_queue': job_queue.depth() < job_queue.queue.maxsize
+    }
+    try:
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        checks['database'] = True
+    except Exception:
+        checks['database'] = False
+    ready = all(checks.values())
+    return jsonify({
+        'success': ready,
+        'checks': checks
+    }), 200 if ready else 503
+##################
+
+# Rate limits
+def api_key_of_request():
+    return client_key(request.headers.get('X-API-Key'), request.remote_addr, client_api_keys)
+
+def json_body_value(name):
+    def key_func():
+        body = request.get_json(silent=True)
+        value = body.get(name) if isinstance(body, dict) else None
+        return value if isinstance(value, str) else None
+    return key_func
+
+sms_api_limit = RateLimit('sms_api_key', api_limit_per_minute, 60, api_key_of_request)
+sms_batch_api_limit = RateLimit('sms_batch_api_key', api_limit_per_minute, 60, api_key_of_request)
+sms_contact_limit = RateLimit('sms_contact', contact_limit_per_minute, 60, json_body_value('contact'))
+notification_api_limit = RateLimit('notification_api_key', notification_api_limit_per_minute, 60, api_key_of_request)
+topic_limit = RateLimit('topic', topic_limit_per_minute, 60, json_body_value('topic'))
+##################
+
+# Idempotency keys (see "idempotency.py")
+# Applied before the rate limits, so the replayed responses are not counted.
+# Keys are scoped by client (API key or address) and endpoint
+idempotency_store = create_idempotency_store(idempotency_storage, idempotency_cache_size, idempotency_ttl_seconds,
+                                             idempotency_wait_timeout_seconds, idempotency_claim_ttl_seconds,
+                                             redis_url=idempotency_redis_url)
+replayed_headers = ('Content-Type', 'Location', 'Retry-After')
+metrics_registry.callback_counter('idempotent_replays_total', 'Responses replayed for a repeated Idempotency-Key', lambda: {(): idempotency_store.replays})
+
+def idempotent(view):
+    @wraps(view)
+    def idempotent_view(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        scoped_key = '%s:%s:%s' % (api_key_of_request(), request.path, key)
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        def work():
+            response = app.make_response(view(*args, **kwargs))
+            return {
+                'status_code': response.status_code,
+                'body': response.get_data(as_text=True),
+                'headers': {name: response.headers[name] for name in replayed_headers if name in response.headers}
+            }
+
+        stored, replayed = idempotency_store.execute(scoped_key, fingerprint, work)
+        response = Response(stored['body'], status=stored['status_code'], headers=stored['headers'])
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return idempotent_view
 ##################
 
 @app.route('/<path:path>')
@@ -37,211 +322,779 @@ def index():
     return render_template('index.html')
 
 @app.route('/smss', methods=['POST'])
-@limiter.limit(str(api_limit_per_minute) + '/minute')
+@idempotent
+@limiter.limit(sms_api_limit, sms_contact_limit)
 def send_sms():
     body = request.get_json()
-    if not body:
-        raise MissingJSONBodyException(status_code=400)
-    if 'contact' not in body or 'subject' not in body or 'message' not in body:
-        raise JSONBodyFormatException(status_code=400)
+    contact, subject, message = validate_sms_body(body)
+    send_at, jitter_seconds, spread_seconds = validate_schedule(body)
 
-    contact = body.get('contact')
-    subject = body.get('subject')
-    message = body.get('message')
+    if send_at is not None:
+        return schedule_jobs('sms', [{'contact': contact, 'subject': subject, 'message': message}],
+                             send_at, jitter_seconds, spread_seconds)
+    if is_async_request():
+        return accept_job(process_sms, contact, subject, message)
+    #return frontend expected JSON
+    return jsonify(process_sms(contact, subject, message)), 200
 
-    if not is_valid_contact_format(contact):
-        #if contact is not valid, raise exception with status code: 400 Bad Request
-        raise InvalidContactException(contact, 400)
-    
+# Sends the SMS and stores it in database, it is called either by the "/smss" endpoint
+# or by a job worker when the request has been accepted asynchronously
+def process_sms(contact, subject, message):
     send_sms_to_contact(contact, subject, message)
-    # Retrieve client object from database (if exist)
-    client = Client.query.filter_by(contact=contact).first()
-    if client is None:
-        # If client does not exist in database, create a record for it
-        client_id = store_client_in_db(contact)
+    cached_client_id = client_id_cache.get(contact)
+    if history_write_behind:
+        # Only the client is resolved synchronously (usually from the cache),
+        # the message itself is appended to the write-behind history log
+        client_id = cached_client_id
+        if client_id is None:
+            client_id = run_in_transaction(lambda connection: Client.get_or_create_id(contact, connection))
+        new_message_id = history_log.log_message(subject, message, client_id)
     else:
-        client_id = client.id
-    new_message_id = store_message_in_db(subject, message, client_id)
-    #return frontend expected JSON
-    return jsonify({
+        new_message_id, client_id = run_in_transaction(
+            lambda connection: store_sms_in_db(contact, subject, message, cached_client_id, connection))
+    # Client ids are only cached once committed, so a cached id always refers to a stored client
+    client_id_cache.set(contact, client_id)
+    return {
         'success': True,
         'message_id': new_message_id
-    }), 200
+    }
 
-# Validate the passed contact with respect to its country code and its format
-def is_valid_contact_format(client_contact):
-    # check that the contact starts with '+20' which is Egypt's country code 
-    # and end with number
-    # example: +201009129288
-    is_valid_format = re.search("[\'+20\'].+[0123456789]$", client_contact)
-    #check that the contact is all numeric
-    is_valid_contact = client_contact[1:len(client_contact)].isnumeric()
-    #check that the contact contains 13 character ('+' sign and 12 numeric)
-    is_valid_contact_len = len(client_contact) == contact_fixed_length
-    return is_valid_format and is_valid_contact and is_valid_contact_len
-
-def store_client_in_db(contact):
-    newClient = Client(contact=contact)
-    newClient.insert()
-    return newClient.id
+# Bulk SMS endpoint
+# The body is an NDJSON stream (one SMS JSON object per line) that is read line by line,
+# lines are processed in chunks of "sms_batch_size": the clients of a chunk are resolved in bulk
+# and its messages are stored by one multi-row insert in one transaction.
+# The response is an NDJSON stream too, with one result per non-empty input line,
+# so memory usage does not depend on the size of the upload
+@app.route('/smss/batch', methods=['POST'])
+@limiter.limit(sms_batch_api_limit)
+def send_sms_batch():
+    return Response(stream_with_context(process_sms_stream(request.stream)), mimetype='application/x-ndjson')
 
+def process_sms_stream(stream):
+    chunk = []
+    line_number = 0
+    for line in stream:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            try:
+                body = json.loads(line)
+            except ValueError:
+                raise JSONBodyFormatException(status_code=400)
+            chunk.append((line_number,) + validate_sms_body(body))
+        except (MissingJSONBodyException, JSONBodyFormatException, InvalidContactException) as error:
+            # lines of a chunk are answered in order, so the pending chunk is flushed first
+            yield from process_sms_chunk(chunk)
+            chunk = []
+            yield batch_line_result(line_number, error=error)
+            continue
+        if len(chunk) >= sms_batch_size:
+            yield from process_sms_chunk(chunk)
+            chunk = []
+    yield from process_sms_chunk(chunk)
+
+def process_sms_chunk(chunk):
+    if not chunk:
+        return
+    # The SMSs of the chunk are sent concurrently, only the sent ones are stored
+    with timed_stage('provider'):
+        send_results = sms_provider.send_many([(contact, subject, message) for _, contact, subject, message in chunk])
+    errors = {}
+    sent_chunk = []
+    for line, send_result in zip(chunk, send_results):
+        if isinstance(send_result, SMSProviderException):
+            errors[line[0]] = send_result
+        else:
+            sent_chunk.append(line)
+
+    message_ids = {}
+    if sent_chunk:
+        current_time = datetime.now()
+        client_ids = {}
+        for _, contact, _, _ in sent_chunk:
+            client_id = client_id_cache.get(contact)
+            if client_id is not None:
+                client_ids[contact] = client_id
+        try:
+            stored_ids, resolved_client_ids = run_in_transaction(
+                lambda connection: store_sms_chunk_in_db(sent_chunk, client_ids, current_time, connection))
+        except DatabaseInsertionException as error:
+            for line_number, _, _, _ in sent_chunk:
+                errors[line_number] = error
+        else:
+            for contact, client_id in resolved_client_ids.items():
+                client_id_cache.set(contact, client_id)
+            for (line_number, _, _, _), message_id in zip(sent_chunk, stored_ids):
+                message_ids[line_number] = message_id
+
+    for line_number, _, _, _ in chunk:
+        if line_number in errors:
+            yield batch_line_result(line_number, error=errors[line_number])
+        else:
+            yield batch_line_result(line_number, message_id=message_ids[line_number])
+
+# Stores the messages of a chunk, the clients that are not in "client_ids" yet are resolved in bulk
+def store_sms_chunk_in_db(chunk, client_ids, current_time, connection):
+    resolved_client_ids = Client.resolve_many([contact for _, contact, _, _ in chunk if contact not in client_ids], connection)
+    client_ids = dict(client_ids, **resolved_client_ids)
+    message_ids = Message.insert_many([
+        {'subject': subject, 'body': message, 'time': current_time, 'client_id': client_ids[contact]}
+        for _, contact, subject, message in chunk
+    ], connection)
+    return message_ids, resolved_client_ids
+
+def batch_line_result(line_number, message_id=None, error=None):
+    if error is None:
+        result = {
+            'line': line_number,
+            'success': True,
+            'message_id': message_id
+        }
+    else:
+        result = {
+            'line': line_number,
+            'success': False,
+            'error': error.status_code,
+            'message': batch_error_messages[type(error)](error)
+        }
+    return json.dumps(result) + '\n'
+
+# Same messages as the error handlers of the single SMS endpoint
+batch_error_messages = dict(exception_messages)
+batch_error_messages[MissingJSONBodyException] = lambda error: "Line cannot be an empty JSON object"
+
+# Stores the SMS message with its client (created if it does not exist in database).
+# Most SMSs are sent to returning contacts whose client ids are cached in process,
+# so the database is only reached for new (or evicted) contacts
+def store_sms_in_db(contact, subject, message, client_id, connection):
+    if client_id is None:
+        client_id = Client.get_or_create_id(contact, connection)
+    return store_message_in_db(subject, message, client_id, connection), client_id
+
+# Sends the SMS through the provider configured by "sms_provider_name" in "config.py"
 def send_sms_to_contact(contact, subject, message):
-    #integrate with real sms provider
-    #example: callr or twillo
-    #api = callr.Api('valeo_1', 'yousifelhady.1994')
-    #testSMS = api.call('sms.send', subject, contact, message, None)
-    print('message subject: ' + subject)
-    print('message body: ' + message)
-    print('has been sent to: ' + contact)
-
-def store_message_in_db(subject, message, client_id):
+    with timed_stage('provider'):
+        return sms_provider.send(contact, subject, message)
+
+def store_message_in_db(subject, message, client_id, connection):
     current_time = datetime.now()
-    new_message = Message(subject=subject, body=message, time=current_time, client_id=client_id)
-    new_message.insert()
-    return new_message.id
+    messages_table = Message.__table__
+    return connection.execute(messages_table.insert().values(
+        subject=subject, body=message, time=current_time, client_id=client_id
+    ).returning(messages_table.c.id)).scalar()
 
 @app.route('/notifications/tokens', methods=['POST'])
+@idempotent
+@limiter.limit(notification_api_limit)
 def send_notification_to_tokens():
     body = request.get_json()
-    if not body:
-        raise MissingJSONBodyException(status_code=400)
-    if 'tokens' not in body or 'title' not in body or 'body' not in body:
-        raise JSONBodyFormatException(status_code=400)
+    tokens, notification_title, notification_body = validate_tokens_notification_body(body)
+    send_at, jitter_seconds, spread_seconds = validate_schedule(body)
 
-    tokens = body.get('tokens')
-    notification_title = body.get('title')
-    notification_body = body.get('body')
+    if send_at is not None:
+        # one job per dispatcher chunk, so a campaign can be spread over a window
+        token_chunks = fcm_dispatcher.chunks(tokens) if isinstance(tokens, list) else [tokens]
+        return schedule_jobs('notification_tokens', [
+            {'tokens': chunk, 'title': notification_title, 'body': notification_body} for chunk in token_chunks
+        ], send_at, jitter_seconds, spread_seconds)
+    if is_async_request():
+        return accept_job(process_notification_to_tokens, tokens, notification_title, notification_body)
+    return jsonify(process_notification_to_tokens(tokens, notification_title, notification_body)), 200
 
-    result = send_notification(tokens, notification_title, notification_body)
-    print(result)
+# Sends the notification to the passed tokens and stores it in database, it is called either by
+# the "/notifications/tokens" endpoint or by a job worker when the request has been accepted asynchronously
+def process_notification_to_tokens(tokens, notification_title, notification_body):
+    if not isinstance(tokens, list):
+        tokens = [tokens]
+    # Tokens known as inactive are not sent to (they would only waste provider quota and latency)
+    live_tokens, skipped_tokens = dead_tokens.filter(tokens)
+    if not live_tokens:
+        return {
+            'success': False,
+            'notification_id': None,
+            'skipped_tokens': len(skipped_tokens)
+        }
 
-    if isinstance(result, list):
-        success = bool(result[0].get('success'))
-    else:
-        success = bool(result['success'])
-    if success:
-        # The following database action could be remove (if not required) as the API should not be responsible for db actions
-        # Explanation:
-        # "handle_notification_storage" function stores the sent notification and targeted tokens in database
-        # and it creates a relation between the sent notification and the tokens (as their relation is Many to Many)
-        # Another alternative:
-        # log the notification's (sender, targeted token, title and body) in a log file for tracking and debugging purposes
-        notification_id = handle_notification_storage(notification_title, notification_body, tokens)
-    
-    return jsonify({
+    result = send_notification(live_tokens, notification_title, notification_body)
+    logger.info('notification sent to tokens', extra={'fields': {'tokens': len(live_tokens), 'result': result}})
+
+    # The dispatcher merges the results of all chunks into one response
+    success = bool(result['success'])
+    deliveries = parse_delivery_results(live_tokens, result)
+    # The following database action could be remove (if not required) as the API should not be responsible for db actions
+    # Explanation:
+    # "handle_notification_storage" function stores the sent notification and targeted tokens in database
+    # and it creates a relation between the sent notification and the tokens (as their relation is Many to Many)
+    # Another alternative:
+    # log the notification's (sender, targeted token, title and body) in a log file for tracking and debugging purposes
+    notification_id = handle_notification_storage(notification_title, notification_body, deliveries, store_history=success)
+    dead_letter_failed_deliveries(deliveries, notification_title, notification_body, notification_id)
+
+    return {
         'success': success,
-        'notification_id': notification_id
-    }), 200
+        'notification_id': notification_id,
+        'skipped_tokens': len(skipped_tokens)
+    }
 
 def send_notification(tokens, notification_title, notification_body):
-    push_service = FCMNotification(api_key=api_key)
     if isinstance(tokens, list):
         # if passed tokens list is empty, raise exception with status code: 400 Bad Request
         if tokens == []:
             raise RegistrationIDsNULLException(status_code=400)
-        return push_service.notify_multiple_devices(registration_ids=tokens, message_body=notification_body, message_title=notification_title)
+        with timed_stage('provider'):
+            result = fcm_dispatcher.notify_multiple_devices(registration_ids=tokens, message_body=notification_body, message_title=notification_title)
     else:
-        return push_service.notify_single_device(registration_id=tokens, message_body=notification_body, message_title=notification_title)
+        with timed_stage('provider'):
+            result = fcm_dispatcher.notify_single_device(registration_id=tokens, message_body=notification_body, message_title=notification_title)
+    count_fcm_results(result)
+    return result
+
+# Stores the notification, the targeted tokens and their relations (with the delivery errors) in one transaction,
+# the tokens FCM reported as permanently invalid are marked inactive in the same transaction.
+# When "store_history" is not set (nothing has been delivered) only the invalid tokens are marked
+def handle_notification_storage(title, body, deliveries, store_history=True):
+    invalid_tokens = {token: error for token, error in deliveries.items() if error in dead_token_errors}
 
-def handle_notification_storage(title, body, tokens):
-    notification_id = store_notification_in_db(title, body)
-    store_tokens_notification_relation_in_db(tokens, notification_id)
+    if history_write_behind or not store_history:
+        if invalid_tokens:
+            run_in_transaction(lambda connection: store_invalid_tokens_in_db(invalid_tokens, connection))
+        notification_id = history_log.log_notification(title, body, deliveries) if store_history else None
+    else:
+        def store_notification_history(connection):
+            notification_time = datetime.now()
+            notification_id = store_notification_in_db(title, body, notification_time, connection)
+            store_tokens_notification_relation_in_db(deliveries, notification_id, notification_time, connection)
+            Token.mark_inactive(invalid_tokens, connection)
+            return notification_id
+
+        notification_id = run_in_transaction(store_notification_history)
+    dead_tokens.add(invalid_tokens)
     return notification_id
 
-def store_notification_in_db(title, body):
-    current_time = datetime.now()
-    newNotification = Notification(title=title, body=body, time=current_time)
-    newNotification.insert()
-    return newNotification.id
+# The notification's time is passed because its relations are stored in the partition of the same time
+def store_notification_in_db(title, body, notification_time, connection):
+    notifications_table = Notification.__table__
+    return connection.execute(notifications_table.insert().values(
+        title=title, body=body, time=notification_time
+    ).returning(notifications_table.c.id)).scalar()
 
 # Store a relation between the sent notification id and targeted tokens ids
 # So the history of notifications and their recipients are maintained.
-# If tokens are not existing in database, they will be stored too
-def store_tokens_notification_relation_in_db(tokens, notification_id):
-    stored_tokens = Token.query.all()
-    stored_tokens = [_token.token for _token in stored_tokens]
-    for token in tokens:
-        if token not in stored_tokens:
-            newToken = Token(token=token)
-            newToken.insert()
-            token_id = newToken.id
-        else:
-            existing_token = Token.query.filter_by(token=token).first()
-            token_id = existing_token.id
-        token_notification_entry = TokenNotification(token_id=token_id, notification_id=notification_id)
-        token_notification_entry.insert()
+# If tokens are not existing in database, they will be stored too.
+# All tokens are resolved (or created) by one upsert statement and all relations
+# are written by one multi-row insert, so the cost does not depend on the size of the tokens table
+def store_tokens_notification_relation_in_db(deliveries, notification_id, notification_time, connection):
+    token_ids = Token.upsert_many(list(deliveries), connection)
+    TokenNotification.insert_many(
+        {token_ids[token]: error for token, error in deliveries.items()}, notification_id, notification_time, connection)
+
+# Invalid tokens are stored (if they are not yet) so they are filtered by all the workers
+def store_invalid_tokens_in_db(invalid_tokens, connection):
+    Token.upsert_many(list(invalid_tokens), connection)
+    Token.mark_inactive(invalid_tokens, connection)
 
 @app.route('/notifications/topic', methods=['POST'])
+@limiter.limit(notification_api_limit, topic_limit)
 def send_notification_to_topic():
+    body = request.get_json()
+    topic_name, message_title, message_body = validate_topic_notification_body(body)
+    send_at, jitter_seconds, spread_seconds = validate_schedule(body)
+
+    if send_at is not None:
+        return schedule_jobs('notification_topic', [{'topic': topic_name, 'title': message_title, 'body': message_body}],
+                             send_at, jitter_seconds, spread_seconds)
+    result = process_notification_to_topic(topic_name, message_title, message_body)
+    if result['success']:
+        status_code = 200
+    else:
+        status_code = 500
+    return jsonify(result), status_code
+
+# Sends the notification to the FCM topic, it is called either by the "/notifications/topic" endpoint
+# or by the scheduler when the notification has been scheduled
+def process_notification_to_topic(topic_name, message_title, message_body):
+    with timed_stage('provider'):
+        result = fcm_dispatcher.notify_topic_subscribers(topic_name=topic_name, message_body=message_body, message_title=message_title)
+    count_fcm_results(result)
+    logger.info('notification sent to topic', extra={'fields': {'topic': topic_name, 'result': result}})
+    return {
+        'success': bool(result['success'])
+    }
+
+# Local topics and segments
+# Unlike "/notifications/topic" (forwarded to FCM topics, nothing is stored), these audiences are stored
+# by the API (see "Topic" in "models.py"): their members are added/removed with POST/DELETE ".../members",
+# "GET /topics/<name>" returns the member count (cached) to estimate the size of a campaign at once,
+# and ".../notifications" sends a notification to all the active members and records it in the history
+audience_kinds = {'topics': 'topic', 'segments': 'segment'}
+
+# Returns the (id, member count) of an audience, aborts with 404 if it does not exist
+def get_audience(kind, name):
+    audience = audience_cache.get((kind, name))
+    if audience is None:
+        topic = Topic.query.filter_by(kind=kind, name=name).first()
+        if topic is None:
+            abort(404)
+        audience = (topic.id, topic.member_count)
+        audience_cache.set((kind, name), audience)
+    return audience
+
+@app.route('/<any(topics, segments):kinds>/<name>', methods=['GET'])
+def get_audience_size(kinds, name):
+    topic_id, member_count = get_audience(audience_kinds[kinds], name)
+    return jsonify({
+        'success': True,
+        'id': topic_id,
+        'name': name,
+        'kind': audience_kinds[kinds],
+        'member_count': member_count
+    }), 200
+
+# POST adds the passed tokens to the audience (creating it if needed), DELETE removes them
+@app.route('/<any(topics, segments):kinds>/<name>/members', methods=['POST', 'DELETE'])
+@limiter.limit(notification_api_limit)
+def update_audience_members(kinds, name):
     body = request.get_json()
     if not body:
         raise MissingJSONBodyException(status_code=400)
-    if 'topic' not in body or 'title' not in body or 'body' not in body:
+    if not isinstance(body, dict) or not isinstance(body.get('tokens'), list):
         raise JSONBodyFormatException(status_code=400)
-    
-    topic_name = body.get('topic')
-    message_title = body.get('title')
-    message_body = body.get('body')
-    
-    push_service = FCMNotification(api_key=api_key)
-    result = push_service.notify_topic_subscribers(topic_name=topic_name, message_body=message_body, message_title=message_title)
-    print(result)
-    success = bool(result['success'])
-    if success:
-        status_code = 200
+    tokens = body.get('tokens')
+    if not tokens:
+        raise RegistrationIDsNULLException(status_code=400)
+
+    kind = audience_kinds[kinds]
+    if request.method == 'POST':
+        def add_members(connection):
+            topic_id, _ = Topic.get_or_create(kind, name, connection)
+            return topic_id, Topic.add_members(topic_id, tokens, connection)
+        topic_id, member_count = run_in_transaction(add_members)
     else:
-        status_code = 500
+        topic_id, _ = get_audience(kind, name)
+        member_count = run_in_transaction(lambda connection: Topic.remove_members(topic_id, tokens, connection))
+    audience_cache.set((kind, name), (topic_id, member_count))
     return jsonify({
-        'success': success,
-    }), status_code
+        'success': True,
+        'id': topic_id,
+        'member_count': member_count
+    }), 200
 
-@app.errorhandler(HTTPException)
-def handle_HTTPException(error):
+@app.route('/<any(topics, segments):kinds>/<name>/notifications', methods=['POST'])
+@limiter.limit(notification_api_limit)
+def send_notification_to_audience(kinds, name):
+    body = request.get_json()
+    if not body:
+        raise MissingJSONBodyException(status_code=400)
+    if not isinstance(body, dict) or 'title' not in body or 'body' not in body:
+        raise JSONBodyFormatException(status_code=400)
+
+    topic_id, member_count = get_audience(audience_kinds[kinds], name)
+    notification_title = body.get('title')
+    notification_body = body.get('body')
+    if is_async_request():
+        return accept_job(process_notification_to_audience, topic_id, notification_title, notification_body)
+    return jsonify(process_notification_to_audience(topic_id, notification_title, notification_body)), 200
+
+# Sends the notification to the active members of an audience, batch by batch: every batch of
+# "audience_batch_size" members is read from the database, sent through the chunked fan-out of the
+# dispatcher, and its deliveries are stored before the next batch is read, so only one batch
+# of the membership is held in memory whatever the size of the audience.
+# The history is written synchronously (the write-behind log stores one record per notification)
+def process_notification_to_audience(topic_id, notification_title, notification_body):
+    notification_time = datetime.now()
+    notification_id = run_in_transaction(
+        lambda connection: store_notification_in_db(notification_title, notification_body, notification_time, connection))
+    sent = 0
+    failed = 0
+    for members in Topic.member_batches(db.engine, topic_id, audience_batch_size):
+        token_ids = {token: token_id for token_id, token in members}
+        tokens = list(token_ids)
+        with timed_stage('provider'):
+            result = fcm_dispatcher.notify_multiple_devices(registration_ids=tokens, message_body=notification_body, message_title=notification_title)
+        count_fcm_results(result)
+        sent += result['success']
+        failed += result['failure']
+        deliveries = parse_delivery_results(tokens, result)
+        invalid_tokens = {token: error for token, error in deliveries.items() if error in dead_token_errors}
+        run_in_transaction(
+            lambda connection: store_audience_deliveries(deliveries, token_ids, invalid_tokens, notification_id, notification_time, connection))
+        dead_letter_failed_deliveries(deliveries, notification_title, notification_body, notification_id)
+        dead_tokens.add(invalid_tokens)
+    return {
+        'success': sent > 0,
+        'notification_id': notification_id,
+        'sent': sent,
+        'failed': failed
+    }
+
+# The members' token ids are already known, so the relations are inserted without resolving the tokens
+def store_audience_deliveries(deliveries, token_ids, invalid_tokens, notification_id, notification_time, connection):
+    TokenNotification.insert_many(
+        {token_ids[token]: error for token, error in deliveries.items()}, notification_id, notification_time, connection)
+    Token.mark_inactive(invalid_tokens, connection)
+
+# Runs "work(connection)" and commits its writes in one transaction:
+# either in the request's unit of work, or (when "group_commit_enabled" is set)
+# in a transaction shared with the writes of concurrent requests
+def run_in_transaction(work):
+    try:
+        if group_commit_enabled:
+            return group_committer.submit(work)
+        with unit_of_work(db.session) as session:
+            return work(session)
+    except DatabaseInsertionException:
+        raise
+    except Exception as ex:
+        raise DatabaseInsertionException(str(ex), 500)
+
+# History API
+# Endpoints are paginated with keyset pagination on (time, id) (see "pagination.py"):
+# a response contains 'next_cursor' to pass as the "cursor" query parameter of the next page
+# (it is null on the last page). The "fields" query parameter projects the returned fields
+# (comma separated) and only the requested columns are loaded
+message_fields = ['id', 'subject', 'body', 'time', 'client_id']
+notification_fields = ['id', 'title', 'body', 'time']
+
+def history_page_limit():
+    return parse_limit(request.args.get('limit'), history_page_size, history_max_page_size)
+
+# Columns to load: the requested fields and the pagination key
+def history_columns(fields):
+    return list(set(fields) | {'id', 'time'})
+
+@app.route('/clients/<contact>/messages', methods=['GET'])
+@reads_from_replica
+def get_client_messages(contact):
+    fields = parse_fields(request.args.get('fields'), message_fields)
+    limit = history_page_limit()
+    client_id = client_id_cache.get(contact)
+    if client_id is None:
+        client = Client.query.filter_by(contact=contact).first()
+        if client is None:
+            abort(404)
+        client_id = client.id
+        client_id_cache.set(contact, client_id)
+
+    query = Message.query.options(load_only(*history_columns(fields))).filter(Message.client_id == client_id)
+    messages, next_cursor = keyset_page(query, Message.time, Message.id, request.args.get('cursor'), limit)
     return jsonify({
-        "success": False, 
-        "error": error.code,
-        "message": error.name
-        }), error.code
+        'success': True,
+        'messages': [project(message, fields) for message in messages],
+        'next_cursor': next_cursor
+    }), 200
+
+# "tokens=true" adds the tokens each notification has been sent to,
+# they are loaded for the whole page at once (no query per notification)
+@app.route('/notifications', methods=['GET'])
+@reads_from_replica
+def get_notifications():
+    fields = parse_fields(request.args.get('fields'), notification_fields)
+    limit = history_page_limit()
+    include_tokens = request.args.get('tokens', '').lower() in ('1', 'true')
 
-@app.errorhandler(InvalidContactException)
-def handle_InvalidContactException(error):
+    query = Notification.query.options(load_only(*history_columns(fields)))
+    if include_tokens:
+        query = query.options(selectinload(Notification.notificationtokens).joinedload(TokenNotification.token_notifications))
+    notifications, next_cursor = keyset_page(query, Notification.time, Notification.id, request.args.get('cursor'), limit)
+
+    formatted_notifications = []
+    for notification in notifications:
+        formatted_notification = project(notification, fields)
+        if include_tokens:
+            formatted_notification['tokens'] = [relation.token_notifications.token for relation in notification.notificationtokens]
+        formatted_notifications.append(formatted_notification)
     return jsonify({
-        'success': False,
-        'error': error.status_code,
-        'message': "Invalid contact: " + error.contact
-    }), error.status_code
+        'success': True,
+        'notifications': formatted_notifications,
+        'next_cursor': next_cursor
+    }), 200
+
+@app.route('/tokens/<token>/notifications', methods=['GET'])
+@reads_from_replica
+def get_token_notifications(token):
+    fields = parse_fields(request.args.get('fields'), notification_fields)
+    limit = history_page_limit()
+    stored_token = Token.query.filter_by(token=token).first()
+    if stored_token is None:
+        abort(404)
 
-@app.errorhandler(DatabaseInsertionException)
-def handle_DatabaseInsertionException(error):
+    query = Notification.query.options(load_only(*history_columns(fields))) \
+        .join(TokenNotification, and_(TokenNotification.notification_id == Notification.id, TokenNotification.time == Notification.time)) \
+        .filter(TokenNotification.token_id == stored_token.id)
+    notifications, next_cursor = keyset_page(query, Notification.time, Notification.id, request.args.get('cursor'), limit)
     return jsonify({
-        'success': False,
-        'error': error.status_code,
-        'message': "Error occured while inserting in database: " + error.exception_message
-    }), error.status_code
+        'success': True,
+        'notifications': [project(notification, fields) for notification in notifications],
+        'next_cursor': next_cursor
+    }), 200
+
+# Exports
+# GET "/exports/messages" or "/exports/notifications" streams the rows whose time is in ["from", "to")
+# as NDJSON (default) or CSV ("format=csv"), gzip compressed when "gzip=true"
+def parse_export_date(parameter):
+    try:
+        return datetime.fromisoformat(request.args[parameter])
+    except (KeyError, ValueError):
+        raise InvalidQueryParameterException(parameter, 400)
+
+@app.route('/exports/<kind>', methods=['GET'])
+def export_history(kind):
+    if kind not in export_queries:
+        abort(404)
+    start = parse_export_date('from')
+    end = parse_export_date('to')
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in export_formats:
+        raise InvalidQueryParameterException('format', 400)
+    compress = request.args.get('gzip', '').lower() in ('1', 'true')
+
+    chunks = export(read_engine(), kind, start, end, export_format, compress, export_chunk_size)
+    filename = kind + '.' + export_format + ('.gz' if compress else '')
+    mimetype = 'application/gzip' if compress else ('application/x-ndjson' if export_format == 'ndjson' else 'text/csv')
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+@app.cli.command('export')
+@click.argument('kind', type=click.Choice(list(export_queries)))
+@click.option('--from', 'start', required=True, type=click.DateTime(), help='first exported time (included)')
+@click.option('--to', 'end', required=True, type=click.DateTime(), help='last exported time (excluded)')
+@click.option('--format', 'export_format', default='ndjson', type=click.Choice(export_formats))
+@click.option('--gzip', 'compress', is_flag=True, help='gzip compress the export')
+@click.option('--output', type=click.Path(dir_okay=False), help='output file (default: standard output)')
+def export_command(kind, start, end, export_format, compress, output):
+    chunks = export(read_engine(), kind, start, end, export_format, compress, export_chunk_size)
+    if compress:
+        stream = open(output, 'wb') if output else click.get_binary_stream('stdout')
+    else:
+        stream = open(output, 'w', encoding='utf-8') if output else click.get_text_stream('stdout')
+    try:
+        for chunk in chunks:
+            stream.write(chunk)
+    finally:
+        if output:
+            stream.close()
 
-@app.errorhandler(RegistrationIDsNULLException)
-def hande_RegistrationIDsNULLException(error):
+# Creates the monthly partitions of the history tables ahead of time and removes the expired ones,
+# meant to be run periodically (e.g. daily from cron)
+@app.cli.command('maintain-partitions')
+@click.option('--ahead', default=history_partitions_ahead_months, type=int, help='months to create ahead of the current month')
+@click.option('--retention', default=history_retention_months, type=int, help='months to keep before the current month')
+@click.option('--action', default=history_retention_action, type=click.Choice(retention_actions), help='what to do with the expired partitions')
+def maintain_partitions_command(ahead, retention, action):
+    with db.engine.begin() as connection:
+        created, removed = maintain_partitions(connection, ahead, retention, action)
+    for name in created:
+        click.echo('created ' + name)
+    for name in removed:
+        click.echo(action + ' ' + name)
+
+# The write-behind log is started with the first request (after the server forked its workers),
+# so segments left unloaded by a previous run are replayed right after a restart
+@app.before_first_request
+def start_history_log():
+    if history_write_behind:
+        history_log.start()
+
+# Loads all the pending history segments (including those of stopped processes) into the database
+@app.cli.command('load-history')
+def load_history():
+    if not os.path.isdir(history_log.directory):
+        return
+    history_log.recover_orphaned_segments()
+    history_log.load_closed_segments()
+
+# Asynchronous accept mode
+# A client opts in per request with the "Prefer: respond-async" header (RFC 7240)
+# or with the "async=true" query parameter
+def is_async_request():
+    prefer = request.headers.get('Prefer', '')
+    if 'respond-async' in [value.strip() for value in prefer.split(',')]:
+        return True
+    return request.args.get('async', '').lower() in ('1', 'true')
+
+def accept_job(function, *args):
+    job = job_queue.submit(function, *args)
+    response = jsonify({
+        'success': True,
+        'job_id': job.id
+    })
+    response.headers['Location'] = '/jobs/' + job.id
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
     return jsonify({
-        'success': False,
-        'error': error.status_code,
-        'message': "Tokens list cannot be empty / nulled list"
-    }), error.status_code
+        'success': True,
+        'job': job.format()
+    }), 200
+
+# Dead letters (see "DeadLetter" in "models.py")
+# The sends that still fail after the retries of the provider calls, when no client is waiting for them:
+# the tokens of a multicast that still have a retryable error, and the scheduled jobs failed by a provider.
+# A synchronous request that fails returns the error (with "Retry-After" when known) to its client instead.
+# "flask replay-dead-letters" sends them again
+provider_exceptions = (SMSProviderException, FCMProviderException)
+
+# kind -> function sending the payload of a dead letter or of a scheduled job
+send_handlers = {
+    'sms': lambda payload: process_sms(payload['contact'], payload['subject'], payload['message']),
+    'notification_tokens': lambda payload: process_notification_to_tokens(payload['tokens'], payload['title'], payload['body']),
+    'notification_topic': lambda payload: process_notification_to_topic(payload['topic'], payload['title'], payload['body'])
+}
+
+def store_dead_letter(kind, payload, error):
+    return run_in_transaction(lambda connection: DeadLetter.store(kind, payload, error, connection))
+
+def failed_delivery_tokens(deliveries):
+    return [token for token, error in deliveries.items() if error in retryable_delivery_errors]
+
+# "notification_id" is the notification in the history (None if it was not stored), a replay does not store it again
+def dead_letter_failed_deliveries(deliveries, title, body, notification_id=None):
+    failed_tokens = failed_delivery_tokens(deliveries)
+    if failed_tokens:
+        store_dead_letter('notification_tokens', {'tokens': failed_tokens, 'title': title, 'body': body,
+                                                  'notification_id': notification_id}, deliveries[failed_tokens[0]])
+
+def dead_lettered(kind, handler):
+    def handle(payload):
+        try:
+            return handler(payload)
+        except provider_exceptions as error:
+            store_dead_letter(kind, payload, error.exception_message)
+            raise
+    return handle
 
-@app.errorhandler(JSONBodyFormatException)
-def hande_JSONBodyFormatException(error):
+# Sends the tokens of a dead letter again, the notification is stored in the history only if it is not yet
+# (by the first send or a previous replay). Returns the payload of the tokens that failed again (None if there are none)
+def replay_notification_to_tokens(payload):
+    live_tokens, _ = dead_tokens.filter(payload['tokens'])
+    if not live_tokens:
+        return None
+    result = send_notification(live_tokens, payload['title'], payload['body'])
+    deliveries = parse_delivery_results(live_tokens, result)
+    notification_id = payload.get('notification_id')
+    stored_id = handle_notification_storage(payload['title'], payload['body'], deliveries,
+                                            store_history=notification_id is None and bool(result['success']))
+    failed_tokens = failed_delivery_tokens(deliveries)
+    if not failed_tokens:
+        return None
+    return dict(payload, tokens=failed_tokens, notification_id=notification_id or stored_id)
+
+def replay_whole(handler):
+    def replay(payload):
+        return None if handler(payload).get('success', True) else payload
+    return replay
+
+# kind -> function replaying the payload of a dead letter, returns the payload still to replay (None if all was sent)
+replay_handlers = {kind: replay_whole(handler) for kind, handler in send_handlers.items()}
+replay_handlers['notification_tokens'] = replay_notification_to_tokens
+
+# Replays the pending dead letters (the oldest first, each one once), one transaction each: a dead letter is locked
+# while it is sent so concurrent replays skip it. A dead letter partially sent again stays pending with what is left to send
+@app.cli.command('replay-dead-letters')
+@click.option('--kind', type=click.Choice(sorted(send_handlers)), help='Only replay the dead letters of this kind.')
+@click.option('--limit', default=100, show_default=True, help='Maximum number of dead letters replayed.')
+def replay_dead_letters_command(kind, limit):
+    after_id = 0
+    for _ in range(limit):
+        with db.engine.begin() as connection:
+            dead_letter = DeadLetter.lock_next_pending(kind, after_id, connection)
+            if dead_letter is None:
+                return
+            try:
+                remaining_payload = replay_handlers[dead_letter.kind](dead_letter.payload)
+                if remaining_payload is None:
+                    outcome, error = 'replayed', None
+                elif remaining_payload == dead_letter.payload:
+                    outcome, error = 'failed', 'not delivered'
+                else:
+                    outcome, error = 'partial', 'partially replayed'
+            except provider_exceptions as ex:
+                remaining_payload = None
+                error = ex.exception_message
+                outcome = 'failed'
+            DeadLetter.record_replay(dead_letter.id, error, remaining_payload, connection)
+        after_id = dead_letter.id
+        click.echo('%s %d (%s)%s' % (outcome, dead_letter.id, dead_letter.kind, '' if error is None else ': ' + error))
+
+# Scheduled sends (see "scheduler.py")
+# "/smss", "/notifications/tokens" and "/notifications/topic" accept an optional "send_at" (ISO 8601 date):
+# the send is stored as a scheduled job (202) and sent by the scheduler of one of the instances at that time.
+# "spread_seconds" spreads the jobs of a campaign (one per chunk of tokens) evenly over a window,
+# "jitter_seconds" delays every job by a random number of seconds, so the campaigns scheduled for the
+# same minute do not all hit the providers at once. "GET /scheduled-jobs/<id>" returns the status of a job,
+# "DELETE /scheduled-jobs/<id>" cancels it while it is still pending
+scheduled_job_handlers = {kind: dead_lettered(kind, handler) for kind, handler in send_handlers.items()}
+scheduler = Scheduler(app, lambda: db.engine, scheduled_job_handlers, tick_seconds=scheduler_tick_seconds,
+                      horizon_seconds=scheduler_horizon_seconds, poll_interval_seconds=scheduler_poll_seconds,
+                      batch_size=scheduler_batch_size, max_loaded_jobs=scheduler_max_loaded_jobs,
+                      workers=scheduler_workers, lease_seconds=scheduler_lease_seconds)
+
+# Started with the first request (after the server forked its workers), the jobs due
+# while no instance was running are sent right away
+@app.before_first_request
+def start_scheduler():
+    if scheduler_enabled:
+        scheduler.start()
+
+def schedule_jobs(kind, payloads, send_at, jitter_seconds, spread_seconds):
+    run_times = spread_run_times(send_at, len(payloads), spread_seconds, jitter_seconds)
+    jobs = [{'kind': kind, 'payload': payload, 'run_at': run_at} for payload, run_at in zip(payloads, run_times)]
+    job_ids = run_in_transaction(lambda connection: ScheduledJob.schedule_many(jobs, connection))
+    for job_id, run_at in zip(job_ids, run_times):
+        scheduler.add(job_id, run_at)
+    response = jsonify({
+        'success': True,
+        'scheduled_job_ids': job_ids,
+        'send_at': send_at
+    })
+    response.headers['Location'] = '/scheduled-jobs/' + str(job_ids[0])
+    return response, 202
+
+@app.route('/scheduled-jobs/<int:job_id>', methods=['GET', 'DELETE'])
+def scheduled_job(job_id):
+    job = ScheduledJob.query.get(job_id)
+    if job is None:
+        abort(404)
+    if request.method == 'DELETE':
+        if not ScheduledJob.cancel(job_id):
+            # already sent (or being sent)
+            abort(409)
+        db.session.commit()
+        db.session.refresh(job)
     return jsonify({
-        'success': False,
-        'error': error.status_code,
-        'message': "Passed JSON body format is incorrect"
-    }), error.status_code
+        'success': True,
+        'scheduled_job': job.format()
+    }), 200
 
-@app.errorhandler(MissingJSONBodyException)
-def hande_MissingJSONBodyException(error):
+@app.errorhandler(HTTPException)
+def handle_HTTPException(error):
+    return jsonify({
+        "success": False, 
+        "error": error.code,
+        "message": error.name
+        }), error.code
+
+# The pool is exhausted: the client retries instead of the request queueing without limit
+@app.errorhandler(PoolTimeoutError)
+def handle_PoolTimeoutError(error):
     return jsonify({
         'success': False,
-        'error': error.status_code,
-        'message': "Method cannot have empty JSON body"
-    }), error.status_code
+        'error': 503,
+        'message': "Database is busy, retry later"
+    }), 503, {'Retry-After': '1'}
+
+def handle_api_exception(error):
+    body, status_code, headers = exception_response(error)
+    return jsonify(body), status_code, headers
+
+for exception_class in exception_messages:
+    app.register_error_handler(exception_class, handle_api_exception)
 
+# Development server only, production runs "gunicorn -c gunicorn.conf.py wsgi:app"
 if __name__ == "__main__":
     app.run('0.0.0.0', '5000', debug=True)
\ No newline at end of file
@@ -0,0 +1,263 @@
+import contextvars
+import json
+import logging
+from http import HTTPStatus
+
+from sqlalchemy import create_engine
+
+from async_history import AsyncHistoryStore
+from async_providers import AsyncFCMDispatcher, create_async_sms_provider
+from dead_tokens import DeadTokenSet
+from exceptions import JobQueueFullException, exception_messages, exception_response
+from fcm_dispatcher import FCMDispatcher, parse_delivery_results
+from models import database_path
+from rate_limiting import RateLimit, RateLimiter, client_key, create_rate_limit_storage
+from scheduler import spread_run_times
+from structured_logging import setup_logging
+from validation import validate_sms_body, validate_tokens_notification_body, validate_topic_notification_body, validate_schedule
+from config import api_key, api_limit_per_minute, client_api_keys, contact_limit_per_minute, notification_api_limit_per_minute, topic_limit_per_minute, rate_limit_enabled, rate_limit_storage, rate_limit_storage_settings, fcm_chunk_size, fcm_timeout_seconds, fcm_endpoint, sms_provider_name, sms_provider_settings, dead_tokens_refresh_seconds, async_max_in_flight_sends, async_http_connections, async_db_pool_size, log_level, log_queue_size, log_max_field_length, log_payload_sample_rate, db_prewarm_connections, db_statement_timeout_ms, db_pgbouncer
+
+# Asynchronous variant of the send endpoints (ASGI)
+# "/smss", "/notifications/tokens" and "/notifications/topic" served by an event loop:
+# an in-flight send is a suspended coroutine waiting on its provider (aiohttp) or on the database (asyncpg),
+# not a blocked thread, so one process holds thousands of them. At most "async_max_in_flight_sends"
+# requests are processed at once, the next ones are rejected with 429 so memory stays bounded.
+# The request validation, the rate limits and the error responses are the same as the Flask app's.
+# The provider calls are not wrapped by the retries and circuit breakers of "resilience.py" (a failed send
+# fails the request at once) and the "Idempotency-Key" header is ignored (see "idempotency.py"): clients that
+# need either one use the Flask app's endpoints.
+# Sends with "send_at" are stored as scheduled jobs, sent by the scheduler of the Flask app's instances.
+# Run with: uvicorn asgi:app --host 0.0.0.0 --port 5001 --workers <n>
+
+log_handler = setup_logging(level=log_level, queue_size=log_queue_size, max_field_length=log_max_field_length, payload_sample_rate=log_payload_sample_rate)
+logger = logging.getLogger(__name__)
+
+# Per process clients, opened by the lifespan startup inside the event loop
+fcm_dispatcher = AsyncFCMDispatcher(
+    FCMDispatcher(api_key, chunk_size=fcm_chunk_size, timeout=fcm_timeout_seconds, endpoint=fcm_endpoint),
+    max_connections=async_http_connections)
+sms_provider = create_async_sms_provider(sms_provider_name, **sms_provider_settings[sms_provider_name])
+history_store = AsyncHistoryStore(database_path, min_connections=db_prewarm_connections, max_connections=async_db_pool_size,
+                                   statement_timeout_ms=db_statement_timeout_ms, pgbouncer=db_pgbouncer)
+# the dead tokens are reloaded by a background thread through a one connection engine
+dead_tokens_engine = create_engine(database_path, pool_size=1, max_overflow=0)
+dead_tokens = DeadTokenSet(lambda: dead_tokens_engine, refresh_interval_seconds=dead_tokens_refresh_seconds)
+in_flight_sends = 0
+
+# Requests
+##################
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.remote_addr = scope['client'][0] if scope.get('client') else None
+        self.body = body
+
+    # Same as Flask's "request.get_json()": None unless the body is JSON, 400 when it cannot be parsed
+    def get_json(self):
+        if self.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400)
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+def http_error_response(status_code):
+    return status_code, {
+        'success': False,
+        'error': status_code,
+        'message': HTTPStatus(status_code).phrase
+    }, {}
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_json(send, status_code, body, headers):
+    content = json.dumps(body, default=str).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(content)).encode())] +
+                   [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+    })
+    await send({'type': 'http.response.body', 'body': content})
+##################
+
+# Rate limits, the same as the Flask app's (and counted in the same storage)
+current_request = contextvars.ContextVar('current_request')
+
+def api_key_of_request():
+    request = current_request.get()
+    return client_key(request.headers.get('x-api-key'), request.remote_addr, client_api_keys)
+
+def json_body_value(name):
+    def key_func():
+        try:
+            body = current_request.get().get_json()
+        except HTTPError:
+            body = None
+        value = body.get(name) if isinstance(body, dict) else None
+        return value if isinstance(value, str) else None
+    return key_func
+
+limiter = RateLimiter(create_rate_limit_storage(rate_limit_storage, **rate_limit_storage_settings[rate_limit_storage]), enabled=rate_limit_enabled)
+sms_api_limit = RateLimit('sms_api_key', api_limit_per_minute, 60, api_key_of_request)
+sms_contact_limit = RateLimit('sms_contact', contact_limit_per_minute, 60, json_body_value('contact'))
+notification_api_limit = RateLimit('notification_api_key', notification_api_limit_per_minute, 60, api_key_of_request)
+topic_limit = RateLimit('topic', topic_limit_per_minute, 60, json_body_value('topic'))
+##################
+
+# Endpoints, each returns (status code, JSON body, headers)
+##################
+# Same as "schedule_jobs" in "app.py"
+async def schedule_jobs(kind, payloads, send_at, jitter_seconds, spread_seconds):
+    run_times = spread_run_times(send_at, len(payloads), spread_seconds, jitter_seconds)
+    job_ids = await history_store.schedule_jobs(kind, payloads, run_times)
+    return 202, {
+        'success': True,
+        'scheduled_job_ids': job_ids,
+        'send_at': send_at
+    }, {'Location': '/scheduled-jobs/' + str(job_ids[0])}
+
+async def send_sms(request):
+    body = request.get_json()
+    contact, subject, message = validate_sms_body(body)
+    send_at, jitter_seconds, spread_seconds = validate_schedule(body)
+    if send_at is not None:
+        return await schedule_jobs('sms', [{'contact': contact, 'subject': subject, 'message': message}],
+                                   send_at, jitter_seconds, spread_seconds)
+    await sms_provider.send(contact, subject, message)
+    message_id, _ = await history_store.store_message(contact, subject, message)
+    return 200, {
+        'success': True,
+        'message_id': message_id
+    }, {}
+
+async def send_notification_to_tokens(request):
+    body = request.get_json()
+    tokens, notification_title, notification_body = validate_tokens_notification_body(body)
+    send_at, jitter_seconds, spread_seconds = validate_schedule(body)
+    if send_at is not None:
+        token_chunks = fcm_dispatcher.dispatcher.chunks(tokens) if isinstance(tokens, list) else [tokens]
+        return await schedule_jobs('notification_tokens', [
+            {'tokens': chunk, 'title': notification_title, 'body': notification_body} for chunk in token_chunks
+        ], send_at, jitter_seconds, spread_seconds)
+    if not isinstance(tokens, list):
+        tokens = [tokens]
+    live_tokens, skipped_tokens = dead_tokens.filter(tokens)
+    if not live_tokens:
+        return 200, {
+            'success': False,
+            'notification_id': None,
+            'skipped_tokens': len(skipped_tokens)
+        }, {}
+
+    result = await fcm_dispatcher.notify_multiple_devices(
+        registration_ids=live_tokens, message_body=notification_body, message_title=notification_title)
+    logger.info('notification sent to tokens', extra={'fields': {'tokens': len(live_tokens), 'result': result}})
+    success = bool(result['success'])
+    deliveries = parse_delivery_results(live_tokens, result)
+    notification_id, invalid_tokens = await history_store.store_notification(
+        notification_title, notification_body, deliveries, store_history=success)
+    dead_tokens.add(invalid_tokens)
+    return 200, {
+        'success': success,
+        'notification_id': notification_id,
+        'skipped_tokens': len(skipped_tokens)
+    }, {}
+
+async def send_notification_to_topic(request):
+    body = request.get_json()
+    topic_name, message_title, message_body = validate_topic_notification_body(body)
+    send_at, jitter_seconds, spread_seconds = validate_schedule(body)
+    if send_at is not None:
+        return await schedule_jobs('notification_topic', [{'topic': topic_name, 'title': message_title, 'body': message_body}],
+                                   send_at, jitter_seconds, spread_seconds)
+    result = await fcm_dispatcher.notify_topic_subscribers(
+        topic_name=topic_name, message_body=message_body, message_title=message_title)
+    logger.info('notification sent to topic', extra={'fields': {'topic': topic_name, 'result': result}})
+    success = bool(result['success'])
+    return 200 if success else 500, {
+        'success': success
+    }, {}
+
+# path -> (method, endpoint, rate limits)
+routes = {
+    '/smss': ('POST', send_sms, (sms_api_limit, sms_contact_limit)),
+    '/notifications/tokens': ('POST', send_notification_to_tokens, (notification_api_limit,)),
+    '/notifications/topic': ('POST', send_notification_to_topic, (notification_api_limit, topic_limit))
+}
+##################
+
+async def handle_request(request):
+    global in_flight_sends
+    if request.path not in routes:
+        return http_error_response(404)
+    method, endpoint, rate_limits = routes[request.path]
+    if request.method != method:
+        return http_error_response(405)
+    token = current_request.set(request)
+    try:
+        if limiter.enabled:
+            limiter.check(rate_limits)
+        if in_flight_sends >= async_max_in_flight_sends:
+            raise JobQueueFullException(status_code=429)
+        in_flight_sends += 1
+        try:
+            return await endpoint(request)
+        finally:
+            in_flight_sends -= 1
+    except tuple(exception_messages) as error:
+        body, status_code, headers = exception_response(error)
+        return status_code, body, headers
+    except HTTPError as error:
+        return http_error_response(error.status_code)
+    except Exception:
+        logger.exception('request failed', extra={'fields': {'path': request.path}})
+        return http_error_response(500)
+    finally:
+        current_request.reset(token)
+
+async def startup():
+    await fcm_dispatcher.start()
+    await sms_provider.start()
+    await history_store.start()
+
+# The in-flight requests are finished by the server before the shutdown
+async def shutdown():
+    await fcm_dispatcher.close()
+    await sms_provider.close()
+    await history_store.close()
+    dead_tokens.stop()
+    log_handler.stop()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    request = Request(scope, await read_body(receive))
+    status_code, body, headers = await handle_request(request)
+    await send_json(send, status_code, body, headers)
@@ -0,0 +1,133 @@
+import json
+from datetime import datetime
+
+import asyncpg
+
+from dead_tokens import dead_token_errors
+
+# Asynchronous history writes (asyncpg), used by the ASGI app ("asgi.py")
+# The statements mirror those of the Flask app: the client and the tokens are inserted with
+# "ON CONFLICT DO NOTHING" (see "get_or_create_ids" in "models.py"), the ids of the already existing
+# ones are read by a second statement, the relations are written by one multi-row insert,
+# everything in one transaction.
+
+insert_client_statement = """
+    INSERT INTO clients (contact) VALUES ($1)
+    ON CONFLICT (contact) DO NOTHING
+    RETURNING id
+"""
+
+select_client_statement = """
+    SELECT id FROM clients WHERE contact = $1
+"""
+
+store_message_statement = """
+    INSERT INTO messages (subject, body, time, client_id) VALUES ($1, $2, $3, $4)
+    RETURNING id
+"""
+
+insert_tokens_statement = """
+    INSERT INTO tokens (token) SELECT unnest($1::varchar[])
+    ON CONFLICT (token) DO NOTHING
+    RETURNING id, token
+"""
+
+select_tokens_statement = """
+    SELECT id, token FROM tokens WHERE token = ANY($1::varchar[])
+"""
+
+mark_inactive_statement = """
+    UPDATE tokens SET active = false, inactive_reason = $1, inactive_since = $2
+    WHERE token = ANY($3::varchar[])
+"""
+
+reserve_job_ids_statement = """
+    SELECT nextval(pg_get_serial_sequence('scheduled_jobs', 'id')) FROM generate_series(1, $1)
+"""
+
+schedule_jobs_statement = """
+    INSERT INTO scheduled_jobs (id, kind, payload, run_at, status, attempts, created_at)
+    SELECT unnest($1::integer[]), $2, unnest($3::jsonb[]), unnest($4::timestamp[]), 'pending', 0, $5
+"""
+
+class AsyncHistoryStore:
+    def __init__(self, database_url, min_connections=2, max_connections=10, statement_timeout_ms=0, pgbouncer=False):
+        self.database_url = database_url
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.statement_timeout_ms = statement_timeout_ms
+        self.pgbouncer = pgbouncer
+        self.pool = None
+
+    # The pool opens its first "min_connections" connections right away. Behind PgBouncer (transaction
+    # pooling) prepared statements cannot be cached and startup settings are not accepted
+    async def start(self):
+        options = {'min_size': self.min_connections, 'max_size': self.max_connections}
+        if self.pgbouncer:
+            options['statement_cache_size'] = 0
+        elif self.statement_timeout_ms:
+            options['server_settings'] = {'statement_timeout': str(self.statement_timeout_ms)}
+        self.pool = await asyncpg.create_pool(self.database_url, **options)
+
+    # Returns the (message id, client id) of the stored SMS
+    async def store_message(self, contact, subject, message):
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                client_id = await connection.fetchval(insert_client_statement, contact)
+                if client_id is None:
+                    client_id = await connection.fetchval(select_client_statement, contact)
+                message_id = await connection.fetchval(store_message_statement, subject, message, datetime.now(), client_id)
+        return message_id, client_id
+
+    # Same as "handle_notification_storage" in "app.py": stores the notification with its relations
+    # (when "store_history" is set) and marks inactive the tokens FCM reported as permanently invalid
+    async def store_notification(self, title, body, deliveries, store_history=True):
+        invalid_tokens = {token: error for token, error in deliveries.items() if error in dead_token_errors}
+        notification_id = None
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                if store_history:
+                    notification_time = datetime.now()
+                    notification_id = await connection.fetchval(
+                        'INSERT INTO notifications (title, body, time) VALUES ($1, $2, $3) RETURNING id',
+                        title, body, notification_time)
+                    token_ids = await self.upsert_tokens(list(deliveries), connection)
+                    await connection.execute("""
+                        INSERT INTO tokennotifications (token_id, notification_id, time, error)
+                        SELECT unnest($1::integer[]), $2, $3, unnest($4::varchar[])
+                    """, [token_ids[token] for token in deliveries], notification_id, notification_time, list(deliveries.values()))
+                elif invalid_tokens:
+                    await self.upsert_tokens(list(invalid_tokens), connection)
+                await self.mark_inactive(invalid_tokens, connection)
+        return notification_id, invalid_tokens
+
+    # Same as "ScheduledJob.schedule_many": stores the jobs of one kind and returns their ids in the same order
+    async def schedule_jobs(self, kind, payloads, run_times):
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                job_ids = [row[0] for row in await connection.fetch(reserve_job_ids_statement, len(payloads))]
+                await connection.execute(schedule_jobs_statement, job_ids, kind,
+                                         [json.dumps(payload) for payload in payloads], run_times, datetime.now())
+        return job_ids
+
+    async def upsert_tokens(self, tokens, connection):
+        unique_tokens = sorted(set(tokens))
+        token_ids = {row['token']: row['id'] for row in await connection.fetch(insert_tokens_statement, unique_tokens)}
+        existing_tokens = [token for token in unique_tokens if token not in token_ids]
+        if existing_tokens:
+            rows = await connection.fetch(select_tokens_statement, existing_tokens)
+            token_ids.update({row['token']: row['id'] for row in rows})
+        return token_ids
+
+    async def mark_inactive(self, reasons, connection):
+        tokens_by_reason = {}
+        for token, reason in reasons.items():
+            tokens_by_reason.setdefault(reason, []).append(token)
+        current_time = datetime.now()
+        for reason, tokens in tokens_by_reason.items():
+            await connection.execute(mark_inactive_statement, reason, current_time, sorted(tokens))
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import random
+import uuid
+
+import aiohttp
+
+from exceptions import SMSProviderException
+from fcm_dispatcher import merge_results, parse_response_content
+from resilience import parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Asynchronous providers, used by the ASGI app ("asgi.py")
+# A send waiting on the provider is a suspended coroutine instead of a blocked thread,
+# the concurrency is bounded by the connection limit of each client session.
+# Sessions are opened by "start" inside the event loop that uses them.
+
+# Sends the same payloads as "FCMDispatcher" (whose PyFCM payload builder and chunking are reused),
+# the chunks of a multicast are sent concurrently and their results merged into one response
+class AsyncFCMDispatcher:
+    def __init__(self, dispatcher, max_connections=256):
+        self.dispatcher = dispatcher
+        self.max_connections = max_connections
+        self.session = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            headers=self.dispatcher.payload_builder.request_headers(),
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=self.dispatcher.timeout))
+
+    async def notify_single_device(self, registration_id, message_title=None, message_body=None):
+        payload = self.dispatcher.payload_builder.parse_payload(
+            registration_ids=[registration_id], message_title=message_title, message_body=message_body)
+        return merge_results([await self.send_payload(payload)])
+
+    async def notify_multiple_devices(self, registration_ids, message_title=None, message_body=None):
+        payloads = [self.dispatcher.payload_builder.parse_payload(
+            registration_ids=chunk, message_title=message_title, message_body=message_body)
+            for chunk in self.dispatcher.chunks(registration_ids)]
+        return merge_results(await asyncio.gather(*[self.send_payload(payload) for payload in payloads]))
+
+    async def notify_topic_subscribers(self, topic_name, message_title=None, message_body=None):
+        payload = self.dispatcher.payload_builder.parse_payload(
+            topic_name=topic_name, message_title=message_title, message_body=message_body)
+        return merge_results([await self.send_payload(payload)])
+
+    async def send_payload(self, payload):
+        async with self.session.post(self.dispatcher.endpoint, data=payload) as response:
+            return parse_response_content(response.status, await response.read(), parse_retry_after(response.headers.get('Retry-After')))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+class AsyncSMSProvider:
+    name = None
+
+    async def start(self):
+        pass
+
+    async def send(self, contact, subject, message):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class AsyncConsoleSMSProvider(AsyncSMSProvider):
+    name = 'console'
+
+    async def send(self, contact, subject, message):
+        logger.info('sms sent', extra={'fields': {'contact': contact, 'subject': subject, 'message': message}})
+        return None
+
+# Same as "StubSMSProvider", at most "max_concurrency" SMSs are in flight (the next ones wait for a slot)
+class AsyncStubSMSProvider(AsyncSMSProvider):
+    name = 'stub'
+
+    def __init__(self, latency_seconds=0.05, error_rate=0.0, max_concurrency=16):
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+
+    async def start(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def send(self, contact, subject, message):
+        async with self.semaphore:
+            if self.latency_seconds:
+                await asyncio.sleep(self.latency_seconds)
+            if self.error_rate and random.random() < self.error_rate:
+                raise SMSProviderException('stub provider simulated failure', 502)
+            return uuid.uuid4().hex
+
+# Same gateway protocol as "HTTPSMSProvider", at most "max_concurrency" SMSs are in flight
+class AsyncHTTPSMSProvider(AsyncSMSProvider):
+    name = 'http'
+
+    def __init__(self, url, api_key=None, timeout_seconds=5, max_concurrency=16):
+        self.url = url
+        self.api_key = api_key
+        self.timeout_seconds = timeout_seconds
+        self.max_concurrency = max_concurrency
+        self.session = None
+
+    async def start(self):
+        headers = {'Authorization': 'Bearer ' + self.api_key} if self.api_key else {}
+        self.session = aiohttp.ClientSession(
+            headers=headers,
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout_seconds))
+
+    async def send(self, contact, subject, message):
+        try:
+            async with self.session.post(self.url, json={'to': contact, 'subject': subject, 'body': message}) as response:
+                if response.status >= 400:
+                    raise SMSProviderException('provider responded with status ' + str(response.status), 502)
+                try:
+                    return (await response.json(content_type=None) or {}).get('message_id')
+                except ValueError:
+                    return None
+        except asyncio.TimeoutError:
+            raise SMSProviderException('provider timed out', 504)
+        except aiohttp.ClientError as ex:
+            raise SMSProviderException(str(ex), 502)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+async_sms_providers = {
+    AsyncConsoleSMSProvider.name: AsyncConsoleSMSProvider,
+    AsyncStubSMSProvider.name: AsyncStubSMSProvider,
+    AsyncHTTPSMSProvider.name: AsyncHTTPSMSProvider
+}
+
+def create_async_sms_provider(name, **settings):
+    if name not in async_sms_providers:
+        raise ValueError('Unknown SMS provider: ' + str(name))
+    return async_sms_providers[name](**settings)
@@ -0,0 +1,53 @@
+# Counts the database commits (and so the WAL fsyncs) issued per request by the history writes
+# The SMS provider is replaced by the local stub provider, so no SMS is really sent,
+# and the notification history is stored directly (without calling FCM).
+#
+# Usage (same database environment variables as the app):
+#   python benchmarks/commits_per_request.py --tokens 100 --batch-lines 100
+import argparse
+import json
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('sms_provider', 'stub')
+os.environ.setdefault('sms_stub_latency_seconds', '0')
+
+from app import app, commit_counter, handle_notification_storage
+
+def count_commits(action):
+    before = commit_counter.total
+    action()
+    return commit_counter.total - before
+
+def random_contact():
+    return '+20' + str(uuid.uuid4().int)[:10]
+
+def main():
+    parser = argparse.ArgumentParser(description='Database commits per request')
+    parser.add_argument('--tokens', type=int, default=100, help='tokens per notification')
+    parser.add_argument('--batch-lines', type=int, default=100, help='lines per "/smss/batch" request')
+    args = parser.parse_args()
+
+    client = app.test_client()
+    contact = random_contact()
+    sms = {'contact': contact, 'subject': 'benchmark', 'message': 'commits per request'}
+    batch = '\n'.join(json.dumps(dict(sms, contact=random_contact())) for _ in range(args.batch_lines))
+    deliveries = {'benchmark-commit-token-' + uuid.uuid4().hex: None for _ in range(args.tokens)}
+
+    results = {
+        '/smss (new contact)': count_commits(lambda: client.post('/smss', json=sms)),
+        '/smss (returning contact)': count_commits(lambda: client.post('/smss', json=sms)),
+        '/smss/batch (%d lines)' % args.batch_lines: count_commits(
+            lambda: client.post('/smss/batch', data=batch, content_type='application/x-ndjson').get_data()),
+    }
+    with app.app_context():
+        results['notification history (%d new tokens)' % args.tokens] = count_commits(
+            lambda: handle_notification_storage('benchmark', 'commits per request', deliveries))
+        results['notification history (%d known tokens)' % args.tokens] = count_commits(
+            lambda: handle_notification_storage('benchmark', 'commits per request', deliveries))
+    print(json.dumps(results, indent=4))
+
+if __name__ == '__main__':
+    main()
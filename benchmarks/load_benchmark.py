@@ -0,0 +1,276 @@
+# End-to-end load benchmark
+# Starts the app (a "flask run" process, or targets an already running server with --app-url) with
+# FCM and the SMS gateway replaced by local fake HTTP servers, so it runs offline and never sends
+# anything. The endpoints are driven at each concurrency level and payload size for a fixed duration,
+# and the throughput and p50/p95/p99 latencies are written to a JSON file that can be compared
+# with the file of another commit (--compare).
+#
+# Usage (same database environment variables as the app, or --database-url):
+#   python benchmarks/load_benchmark.py --concurrency 1 8 32 --duration 20 --output before.json
+#   python benchmarks/load_benchmark.py --concurrency 1 8 32 --duration 20 --output after.json --compare before.json
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+repository_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+scenario_names = ('smss', 'notifications_tokens', 'notifications_topic')
+
+# Fake servers
+##############
+class FakeServerHandler(BaseHTTPRequestHandler):
+    latency_seconds = 0
+    error_rate = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        response = json.dumps(self.respond(json.loads(body or b'{}'))).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def respond(self, payload):
+        raise NotImplementedError
+
+    def log_message(self, format, *args):
+        pass
+
+# Answers like the FCM legacy HTTP API, a token fails with 'NotRegistered' with a probability of "error_rate"
+class FakeFCMHandler(FakeServerHandler):
+    def respond(self, payload):
+        if str(payload.get('to', '')).startswith('/topics/'):
+            return {'message_id': int(time.time() * 1000)}
+        tokens = payload.get('registration_ids') or [payload.get('to')]
+        results = [
+            {'error': 'NotRegistered'} if self.error_rate and hash(token) % 1000 < self.error_rate * 1000
+            else {'message_id': '0:' + uuid.uuid4().hex} for token in tokens
+        ]
+        failure = sum(1 for result in results if 'error' in result)
+        return {
+            'multicast_id': int(time.time() * 1000),
+            'success': len(results) - failure,
+            'failure': failure,
+            'canonical_ids': 0,
+            'results': results
+        }
+
+class FakeSMSHandler(FakeServerHandler):
+    def respond(self, payload):
+        return {'message_id': uuid.uuid4().hex}
+
+def serve(handler_class, port, latency_seconds, error_rate):
+    handler_class.latency_seconds = latency_seconds
+    handler_class.error_rate = error_rate
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+    server.daemon_threads = True
+    server.serve_forever()
+
+# The fake servers run in their own processes so they do not compete with the load generator for the GIL
+def start_fake_server(handler_class, port, latency_seconds, error_rate=0):
+    process = multiprocessing.Process(target=serve, args=(handler_class, port, latency_seconds, error_rate), daemon=True)
+    process.start()
+    return process
+
+def wait_until_listening(url, timeout_seconds=30):
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError('nothing is listening on ' + url)
+
+def start_app(args):
+    environment = dict(
+        os.environ,
+        FLASK_APP='app.py',
+        fcm_endpoint='http://127.0.0.1:%d/fcm/send' % args.fcm_port,
+        sms_provider='http',
+        sms_provider_url='http://127.0.0.1:%d/sms' % args.sms_port,
+        rate_limit_enabled='true' if args.rate_limits else 'false'
+    )
+    if args.database_url:
+        environment['database_url'] = args.database_url
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'flask', 'run', '--port', str(args.app_port), '--with-threads', '--no-reload'],
+        cwd=repository_path, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process
+
+# Load generation
+#################
+def random_contact():
+    return '+20' + str(uuid.uuid4().int)[:10]
+
+# Returns (path, JSON body) of a request of the scenario, "payload" is the size of the message body
+# in characters (SMS, topic) or the number of tokens (notifications to tokens)
+def build_request(scenario, payload):
+    if scenario == 'smss':
+        return '/smss', {'contact': random_contact(), 'subject': 'load benchmark', 'message': 'x' * payload}
+    if scenario == 'notifications_tokens':
+        return '/notifications/tokens', {
+            'tokens': ['load-benchmark-' + uuid.uuid4().hex for _ in range(payload)],
+            'title': 'load benchmark',
+            'body': 'load benchmark'
+        }
+    return '/notifications/topic', {'topic': 'load-benchmark', 'title': 'load benchmark', 'body': 'x' * payload}
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def run_level(app_url, scenario, concurrency, payload, duration_seconds, warmup_seconds):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    measure_from = time.monotonic() + warmup_seconds
+    stop_at = measure_from + duration_seconds
+
+    def worker():
+        session = requests.Session()
+        while True:
+            path, body = build_request(scenario, payload)
+            start = time.monotonic()
+            if start >= stop_at:
+                return
+            try:
+                status_code = session.post(app_url + path, json=body, timeout=60).status_code
+            except requests.RequestException:
+                status_code = None
+            end = time.monotonic()
+            if start < measure_from:
+                continue
+            with lock:
+                latencies.append(end - start)
+                if status_code != 200:
+                    errors.append(status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    to_ms = lambda seconds: None if seconds is None else round(seconds * 1000, 2)
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'payload': payload,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_status_codes': sorted(set(str(status_code) for status_code in errors)),
+        'throughput_rps': round(len(latencies) / duration_seconds, 2),
+        'p50_ms': to_ms(percentile(latencies, 0.50)),
+        'p95_ms': to_ms(percentile(latencies, 0.95)),
+        'p99_ms': to_ms(percentile(latencies, 0.99))
+    }
+
+# Reporting
+###########
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository_path).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result):
+    return (result['scenario'], result['concurrency'], result['payload'])
+
+def compare(results, previous_report):
+    previous_results = {result_key(result): result for result in previous_report['results']}
+    print('compared with commit %s:' % previous_report.get('commit'))
+    for result in results:
+        previous = previous_results.get(result_key(result))
+        if previous is None or not previous['throughput_rps'] or not previous['p95_ms']:
+            continue
+        print('%-22s c=%-4d payload=%-6d throughput %+7.1f%%  p95 %+7.1f%%' % (
+            result['scenario'], result['concurrency'], result['payload'],
+            (result['throughput_rps'] / previous['throughput_rps'] - 1) * 100,
+            ((result['p95_ms'] or 0) / previous['p95_ms'] - 1) * 100))
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load benchmark with fake FCM and SMS providers')
+    parser.add_argument('--scenarios', nargs='+', choices=scenario_names, default=list(scenario_names))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--sms-sizes', type=int, nargs='+', default=[160], help='SMS body sizes (characters)')
+    parser.add_argument('--token-counts', type=int, nargs='+', default=[1, 100, 1000], help='tokens per notification')
+    parser.add_argument('--topic-sizes', type=int, nargs='+', default=[100], help='topic notification body sizes (characters)')
+    parser.add_argument('--duration', type=float, default=20, help='measured seconds per level')
+    parser.add_argument('--warmup', type=float, default=2, help='unmeasured seconds before each level')
+    parser.add_argument('--provider-latency-ms', type=float, default=20, help='latency of the fake FCM and SMS servers')
+    parser.add_argument('--fcm-error-rate', type=float, default=0, help='fraction of tokens the fake FCM reports as NotRegistered')
+    parser.add_argument('--rate-limits', action='store_true', help='keep the API rate limits enabled')
+    parser.add_argument('--app-url', help='benchmark an already running app instead of starting one')
+    parser.add_argument('--app-port', type=int, default=5100)
+    parser.add_argument('--fcm-port', type=int, default=5101)
+    parser.add_argument('--sms-port', type=int, default=5102)
+    parser.add_argument('--database-url', help='database of the started app (default: the app\'s environment variables)')
+    parser.add_argument('--output', default='load_benchmark.json')
+    parser.add_argument('--compare', help='report of a previous run to compare with')
+    args = parser.parse_args()
+
+    payloads = {'smss': args.sms_sizes, 'notifications_tokens': args.token_counts, 'notifications_topic': args.topic_sizes}
+    latency_seconds = args.provider_latency_ms / 1000
+    fake_servers = [
+        start_fake_server(FakeFCMHandler, args.fcm_port, latency_seconds, args.fcm_error_rate),
+        start_fake_server(FakeSMSHandler, args.sms_port, latency_seconds)
+    ]
+    app_process = None
+    app_url = args.app_url
+    try:
+        if app_url is None:
+            app_process = start_app(args)
+            app_url = 'http://127.0.0.1:%d' % args.app_port
+        wait_until_listening(app_url)
+
+        results = []
+        for scenario in args.scenarios:
+            for payload in payloads[scenario]:
+                for concurrency in args.concurrency:
+                    results.append(run_level(app_url, scenario, concurrency, payload, args.duration, args.warmup))
+                    print(json.dumps(results[-1]))
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait()
+        for server in fake_servers:
+            server.terminate()
+
+    report = {
+        'commit': current_commit(),
+        'started_at': datetime.now().isoformat(),
+        'settings': {
+            'duration_seconds': args.duration,
+            'warmup_seconds': args.warmup,
+            'provider_latency_ms': args.provider_latency_ms,
+            'fcm_error_rate': args.fcm_error_rate,
+            'rate_limits': args.rate_limits,
+            'app_url': args.app_url
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+if __name__ == '__main__':
+    main()
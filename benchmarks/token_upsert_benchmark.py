@@ -0,0 +1,84 @@
+# Benchmark of the notification history storage path
+# It grows the "tokens" table step by step and measures the time needed to store
+# one notification sent to a fixed number of tokens (half of them already stored, half new).
+# With the set-based upsert the latency shall stay flat while the table grows.
+#
+# Usage (same database environment variables as the app):
+#   python benchmarks/token_upsert_benchmark.py --sizes 10000 100000 1000000 --tokens 500
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app, handle_notification_storage
+from models import db
+
+benchmark_prefix = 'benchmark-token-'
+benchmark_title = 'token upsert benchmark'
+
+def grow_tokens_table(target_size):
+    current_size = db.session.execute(
+        "SELECT count(*) FROM tokens WHERE token LIKE :prefix", {'prefix': benchmark_prefix + '%'}).scalar()
+    if current_size < target_size:
+        db.session.execute(
+            "INSERT INTO tokens (token) SELECT :prefix || g FROM generate_series(:start, :stop) AS g "
+            "ON CONFLICT (token) DO NOTHING",
+            {'prefix': benchmark_prefix, 'start': current_size, 'stop': target_size - 1})
+        db.session.commit()
+        db.session.execute("ANALYZE tokens")
+        db.session.commit()
+
+def sample_tokens(table_size, tokens_count):
+    existing_count = min(tokens_count // 2, table_size)
+    step = max(table_size // max(existing_count, 1), 1)
+    existing = [benchmark_prefix + str(i * step) for i in range(existing_count)]
+    new = [benchmark_prefix + 'new-' + uuid.uuid4().hex for _ in range(tokens_count - existing_count)]
+    return existing + new
+
+def measure(table_size, tokens_count, repeat):
+    timings = []
+    for _ in range(repeat):
+        tokens = sample_tokens(table_size, tokens_count)
+        start = time.perf_counter()
+        handle_notification_storage(benchmark_title, 'benchmark body', {token: None for token in tokens})
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'tokens_table_size': table_size,
+        'tokens_per_request': tokens_count,
+        'median_ms': round(statistics.median(timings) * 1000, 2),
+        'p95_ms': round(timings[int(len(timings) * 0.95) - 1] * 1000, 2),
+        'max_ms': round(timings[-1] * 1000, 2),
+    }
+
+def cleanup():
+    db.session.execute("DELETE FROM notifications WHERE title = :title", {'title': benchmark_title})
+    db.session.execute("DELETE FROM tokens WHERE token LIKE :prefix", {'prefix': benchmark_prefix + '%'})
+    db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description='Notification history storage latency vs "tokens" table size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--tokens', type=int, default=500, help='tokens per simulated request')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help='keep the generated rows after the run')
+    args = parser.parse_args()
+
+    with app.app_context():
+        results = []
+        try:
+            for size in sorted(args.sizes):
+                grow_tokens_table(size)
+                results.append(measure(size, args.tokens, args.repeat))
+                print(json.dumps(results[-1]))
+        finally:
+            if not args.keep:
+                cleanup()
+
+if __name__ == '__main__':
+    main()
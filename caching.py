@@ -0,0 +1,42 @@
+import threading
+
+from cachetools import TTLCache
+
+# Thread safe LRU cache whose entries expire after "ttl" seconds,
+# it counts its hits and misses so its efficiency can be monitored
+class CountingTTLCache:
+    def __init__(self, maxsize, ttl):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.cache[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.cache),
+                'maxsize': self.cache.maxsize
+            }
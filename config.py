@@ -1,5 +1,243 @@
+import os
+
 # FCM API Key
 api_key = 'AAAA6EwhWKo:APA91bHJiaWrXskFxQGQoybatbMLJxiDBC7nDT5hu7w8YYT1q_tZ2lnWqLjZeMpgPHjGYexZWiRhoq3ibxAUtkdyRLuIeripcVVi4-PzrvW2GcKJkWpbRCzSzd4NenMR8dGGSP931AUk'
 
 # API Limiter
-api_limit_per_minute = 5
\ No newline at end of file
+# Requests per minute to "/smss" per API key ("X-API-Key" header, or the client's address when missing)
+api_limit_per_minute = 5
+# API keys of the clients (comma separated), a request whose "X-API-Key" is not one of them
+# is limited by the client's address (any other header value would get its own counter)
+client_api_keys = frozenset(key.strip() for key in os.environ.get('client_api_keys', '').split(',') if key.strip())
+# SMSs per minute to the same destination contact
+contact_limit_per_minute = 5
+# Notification requests per minute per API key
+notification_api_limit_per_minute = 60
+# Notifications per minute to the same FCM topic
+topic_limit_per_minute = 10
+# The limits can be turned off, e.g. for load benchmarks
+rate_limit_enabled = os.environ.get('rate_limit_enabled', 'true').lower() == 'true'
+# Where the rate limit counters are kept:
+# 'memory' (per process), 'shared_memory' (shared by all the worker processes of a host)
+# or 'redis' (shared by all hosts, synchronized in the background every "sync_interval_seconds")
+rate_limit_storage = os.environ.get('rate_limit_storage', 'memory')
+rate_limit_storage_settings = {
+    'memory': {},
+    'shared_memory': {
+        'path': os.environ.get('rate_limit_shared_memory_path', '/dev/shm/flask_sms_notifications_rate_limits'),
+        'slots': 65536
+    },
+    'redis': {
+        'url': os.environ.get('rate_limit_redis_url', 'redis://localhost:6379/0'),
+        'sync_interval_seconds': 0.1
+    }
+}
+
+# FCM Dispatcher
+# FCM accepts up to 1000 registration ids per multicast request
+fcm_chunk_size = 1000
+# Maximum number of chunks that are sent at the same time (also the size of the HTTP connection pool)
+fcm_max_workers = 8
+fcm_timeout_seconds = 10
+# FCM send endpoint (PyFCM's default when not set), e.g. a local fake server for load benchmarks
+fcm_endpoint = os.environ.get('fcm_endpoint')
+
+# Asynchronous accept mode
+# Number of worker threads that execute the accepted send requests
+async_workers = 4
+# Maximum number of accepted requests waiting for a worker, 429 is returned when it is reached
+async_queue_size = 1000
+# Number of the latest jobs whose status can be retrieved from "/jobs/<id>"
+async_tracked_jobs = 10000
+
+# Bulk SMS
+# Number of NDJSON lines of "/smss/batch" that are stored together in one transaction
+sms_batch_size = 500
+
+# Client id cache
+# Maximum number of contacts whose client ids are cached by each worker process
+client_cache_size = 100000
+client_cache_ttl_seconds = 3600
+
+# SMS Provider
+# One of: 'console' (prints the SMSs), 'stub' (local simulated gateway for load tests), 'http' (real HTTP gateway)
+sms_provider_name = os.environ.get('sms_provider', 'console')
+sms_provider_settings = {
+    'console': {},
+    'stub': {
+        'latency_seconds': float(os.environ.get('sms_stub_latency_seconds', 0.05)),
+        'error_rate': float(os.environ.get('sms_stub_error_rate', 0)),
+        'max_concurrency': 16
+    },
+    'http': {
+        'url': os.environ.get('sms_provider_url'),
+        'api_key': os.environ.get('sms_provider_api_key'),
+        'timeout_seconds': 5,
+        'max_concurrency': 16
+    }
+}
+
+# Group commit
+# When enabled, the history writes of concurrent requests are merged into shared transactions,
+# a transaction waits at most "group_commit_window_ms" for up to "group_commit_max_batch" writes
+group_commit_enabled = os.environ.get('group_commit_enabled', 'false').lower() == 'true'
+group_commit_max_batch = 64
+group_commit_window_ms = 2
+
+# Write-behind history
+# When enabled, sent messages and notifications are appended to local segment files
+# and bulk loaded into the database in the background instead of being inserted by the request
+history_write_behind = os.environ.get('history_write_behind', 'false').lower() == 'true'
+history_log_settings = {
+    'directory': os.environ.get('history_log_dir', 'history_log'),
+    # a segment is closed (then loaded) when it reaches this size or this age
+    'segment_max_bytes': 16 * 1024 * 1024,
+    'segment_max_age_seconds': 5,
+    # appended records are fsynced in batches at this interval
+    'fsync_interval_seconds': 0.05,
+    # number of message/notification ids reserved from the sequences at once
+    'id_block_size': 1000
+}
+
+# History API
+# Default and maximum page size of the history endpoints
+history_page_size = 50
+history_max_page_size = 500
+
+# Exports
+# Number of rows fetched from the server-side cursor (and serialized) at once
+export_chunk_size = 5000
+
+# Inactive tokens
+# Interval at which every worker reloads the set of inactive tokens from the database
+dead_tokens_refresh_seconds = 300
+
+# Local topics and segments
+# Number of members read from the database and sent at once, a multiple of "fcm_chunk_size"
+# so the chunks of a batch are sent concurrently by the dispatcher
+audience_batch_size = fcm_chunk_size * fcm_max_workers
+# Member counts of the audiences cached by each worker process
+audience_cache_size = 10000
+audience_cache_ttl_seconds = 60
+
+# History partitions
+# The history tables are partitioned by month, "flask maintain-partitions" creates the partitions
+# of the next "history_partitions_ahead_months" months and removes the partitions older than
+# "history_retention_months": 'detach' keeps them as plain tables (e.g. to be archived), 'drop' deletes them
+history_partitions_ahead_months = 3
+history_retention_months = int(os.environ.get('history_retention_months', 12))
+history_retention_action = os.environ.get('history_retention_action', 'detach')
+
+# Metrics
+# Directory where every worker process writes its metrics, so "/metrics" aggregates all the workers
+# of the host (it shall be emptied when the server starts). When not set, "/metrics" only reports
+# the process that serves the scrape
+metrics_dir = os.environ.get('metrics_dir')
+metrics_flush_interval_seconds = 1
+
+# Profiling
+# A request is profiled when its "X-Profile" header equals "profile_token", or randomly with a
+# probability of "profile_sample_rate". Nothing is installed when both are unset
+profile_token = os.environ.get('profile_token')
+profile_sample_rate = float(os.environ.get('profile_sample_rate', 0))
+# the profiles of the latest "profile_max_files" profiled requests are kept in "profile_dir"
+profile_dir = os.environ.get('profile_dir', 'profiles')
+profile_max_files = 200
+# a statement executed this number of times by the same request is flagged as an N+1 pattern
+n_plus_one_threshold = 5
+
+# Logging
+# JSON records written to the standard output by a background thread, the records logged while
+# "log_queue_size" records are waiting are dropped (and counted by "log_records_dropped_total")
+log_level = os.environ.get('log_level', 'INFO').upper()
+log_queue_size = 10000
+# fields longer than "log_max_field_length" characters (e.g. provider responses) are only logged
+# in full for a "log_payload_sample_rate" fraction of the records
+log_max_field_length = 2048
+log_payload_sample_rate = float(os.environ.get('log_payload_sample_rate', 0.01))
+
+# Production server (see "gunicorn.conf.py")
+web_port = int(os.environ.get('PORT', 5000))
+web_workers = int(os.environ.get('web_workers', os.cpu_count() * 2 + 1))
+# 'gthread' (threads per worker) or 'gevent' (greenlets, for provider-bound traffic)
+worker_class = os.environ.get('worker_class', 'gthread')
+worker_threads = int(os.environ.get('worker_threads', 8))
+worker_connections = int(os.environ.get('worker_connections', 1000))
+# seconds given to a stopping worker to serve its in-flight requests and drain its background sends
+graceful_timeout_seconds = int(os.environ.get('graceful_timeout_seconds', 30))
+request_timeout_seconds = int(os.environ.get('request_timeout_seconds', 60))
+
+# ASGI app (see "asgi.py")
+# requests processed at once by each process, the next ones are rejected with 429
+async_max_in_flight_sends = int(os.environ.get('async_max_in_flight_sends', 5000))
+# connections of each provider client (FCM) and of the asyncpg pool, per process
+async_http_connections = 256
+async_db_pool_size = int(os.environ.get('async_db_pool_size', 20))
+
+# Database connections
+# Pool of each worker process: "db_pool_size" kept connections plus up to "db_max_overflow" temporary ones,
+# a request waits at most "db_pool_timeout_seconds" for a connection then gets 503
+db_pool_size = int(os.environ.get('db_pool_size', 10))
+db_max_overflow = int(os.environ.get('db_max_overflow', 10))
+db_pool_timeout_seconds = float(os.environ.get('db_pool_timeout_seconds', 5))
+# connections are tested before use, and replaced after "db_pool_recycle_seconds"
+db_pool_pre_ping = os.environ.get('db_pool_pre_ping', 'true').lower() == 'true'
+db_pool_recycle_seconds = int(os.environ.get('db_pool_recycle_seconds', 1800))
+# statements running longer are cancelled by the server (0: no timeout)
+db_statement_timeout_ms = int(os.environ.get('db_statement_timeout_ms', 30000))
+# connections opened by every worker at startup, so the first requests do not pay for them
+db_prewarm_connections = int(os.environ.get('db_prewarm_connections', 2))
+# Set when the database URL points to PgBouncer in transaction pooling mode: PgBouncer pools
+# the connections (no pool in the app), and the statement timeout is set per transaction
+db_pgbouncer = os.environ.get('db_pgbouncer', 'false').lower() == 'true'
+
+# Idempotency keys
+# Responses of the requests sent with an "Idempotency-Key" header, kept "idempotency_ttl_seconds"
+# ('memory': per process, at most "idempotency_cache_size" keys, 'redis': shared by all the processes)
+idempotency_storage = os.environ.get('idempotency_storage', 'memory')
+idempotency_redis_url = os.environ.get('idempotency_redis_url', 'redis://localhost:6379/0')
+idempotency_cache_size = 100000
+idempotency_ttl_seconds = int(os.environ.get('idempotency_ttl_seconds', 86400))
+# a duplicate waits at most this number of seconds for the response of the first request
+idempotency_wait_timeout_seconds = 30
+# a running request keeps its key claimed (for the other processes) at most this number of seconds:
+# as long as a request may run, so a duplicate is never sent while the first request is still sending
+idempotency_claim_ttl_seconds = max(request_timeout_seconds, idempotency_wait_timeout_seconds)
+
+# Scheduled sends (see "scheduler.py")
+# set to 'false' on the instances that must not send the scheduled jobs
+scheduler_enabled = os.environ.get('scheduler_enabled', 'true').lower() == 'true'
+scheduler_tick_seconds = 1
+# every "scheduler_poll_seconds" the jobs due within "scheduler_horizon_seconds" are loaded,
+# "scheduler_batch_size" per query and at most "scheduler_max_loaded_jobs" per process
+scheduler_poll_seconds = int(os.environ.get('scheduler_poll_seconds', 5))
+scheduler_horizon_seconds = int(os.environ.get('scheduler_horizon_seconds', 60))
+scheduler_batch_size = 500
+scheduler_max_loaded_jobs = 100000
+# threads sending the due jobs, per process
+scheduler_workers = int(os.environ.get('scheduler_workers', 8))
+# a job not sent within this number of seconds after its claim is considered interrupted
+scheduler_lease_seconds = int(os.environ.get('scheduler_lease_seconds', 600))
+# longest "jitter_seconds" and "spread_seconds" accepted by the send endpoints
+schedule_max_window_seconds = 86400
+
+# Provider calls (see "resilience.py")
+# attempts per error class, including the first one ('rejected' requests are never retried).
+# A timed out or 'disconnected' send may have been delivered, retrying it can send it twice: opt-in
+provider_retry_attempts = {
+    'timeout': int(os.environ.get('provider_retry_attempts_timeout', 1)),
+    'disconnected': int(os.environ.get('provider_retry_attempts_disconnected', 1)),
+    'connection': int(os.environ.get('provider_retry_attempts_connection', 3)),
+    'unavailable': int(os.environ.get('provider_retry_attempts_unavailable', 3)),
+    'rate_limited': int(os.environ.get('provider_retry_attempts_rate_limited', 3))
+}
+# the backoff doubles from "provider_retry_base_delay_seconds" up to "provider_retry_max_delay_seconds",
+# a longer "Retry-After" is not waited for (the call fails instead)
+provider_retry_base_delay_seconds = float(os.environ.get('provider_retry_base_delay_seconds', 0.2))
+provider_retry_max_delay_seconds = float(os.environ.get('provider_retry_max_delay_seconds', 5))
+# the circuit of a provider opens for "circuit_open_seconds" when at least "circuit_failure_rate"
+# of the calls of the last "circuit_window_seconds" failed (once there are "circuit_min_calls" calls)
+circuit_failure_rate = float(os.environ.get('circuit_failure_rate', 0.5))
+circuit_min_calls = int(os.environ.get('circuit_min_calls', 20))
+circuit_window_seconds = int(os.environ.get('circuit_window_seconds', 30))
+circuit_open_seconds = int(os.environ.get('circuit_open_seconds', 15))
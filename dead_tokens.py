@@ -0,0 +1,76 @@
+import logging
+import threading
+
+from models import Token
+
+logger = logging.getLogger(__name__)
+
+# FCM errors meaning that a registration token will never be valid again
+dead_token_errors = ('NotRegistered', 'InvalidRegistration')
+
+# In-memory set of the inactive tokens, used to filter the tokens out before the fan-out
+# without querying the database for every request. It is reloaded from the database every
+# "refresh_interval_seconds" (so tokens marked inactive by other workers are filtered too)
+# and the tokens marked inactive by this worker are added right away
+class DeadTokenSet:
+    def __init__(self, engine_getter, refresh_interval_seconds=300, fetch_size=10000):
+        self.engine_getter = engine_getter
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.fetch_size = fetch_size
+        self.tokens = frozenset()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.loaded = threading.Event()
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='dead-tokens-refresh', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                # the previous set is kept until the next refresh
+                logger.exception('dead tokens refresh failed')
+            self.loaded.set()
+            if self.stopped.wait(self.refresh_interval_seconds):
+                return
+
+    def refresh(self):
+        tokens_table = Token.__table__
+        tokens = set()
+        with self.engine_getter().connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                tokens_table.select().with_only_columns([tokens_table.c.token]).where(~tokens_table.c.active))
+            while True:
+                rows = result.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                tokens.update(row[0] for row in rows)
+        # inactive tokens are never reactivated, so the loaded tokens are merged
+        # with the tokens added while the set was loading
+        with self.lock:
+            self.tokens = self.tokens | frozenset(tokens)
+
+    def add(self, tokens):
+        with self.lock:
+            self.tokens = self.tokens | frozenset(tokens)
+
+    # Splits the passed tokens into (live tokens, dead tokens)
+    def filter(self, tokens):
+        self.start()
+        dead_tokens = self.tokens
+        live = [token for token in tokens if token not in dead_tokens]
+        dead = [token for token in tokens if token in dead_tokens]
+        return live, dead
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -3,4 +3,4 @@ cd flask-sms-notifications-app
 pip3 install -r requirements.txt
 export FLASK_APP=app.py
 flask db upgrade
-python3 app.py
+exec gunicorn -c gunicorn.conf.py wsgi:app
@@ -1,4 +1,5 @@
 from flask import Flask
+import math
 import os
 
 class InvalidContactException(Exception):
@@ -21,4 +22,82 @@ class JSONBodyFormatException(Exception):
 
 class MissingJSONBodyException(Exception):
     def __init__(self, status_code):
-        self.status_code = status_code
\ No newline at end of file
+        self.status_code = status_code
+
+class JobQueueFullException(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+# "error_class" and "retry_after" are used by the retries of the provider calls (see "resilience.py")
+class SMSProviderException(Exception):
+    def __init__(self, exception_message, status_code, error_class='unavailable', retry_after=None):
+        self.exception_message = exception_message
+        self.status_code = status_code
+        self.error_class = error_class
+        self.retry_after = retry_after
+
+class FCMProviderException(Exception):
+    def __init__(self, exception_message, status_code, error_class='unavailable', retry_after=None):
+        self.exception_message = exception_message
+        self.status_code = status_code
+        self.error_class = error_class
+        self.retry_after = retry_after
+
+class InvalidQueryParameterException(Exception):
+    def __init__(self, parameter, status_code):
+        self.parameter = parameter
+        self.status_code = status_code
+
+class RateLimitExceededException(Exception):
+    def __init__(self, limit_name, retry_after, status_code):
+        self.limit_name = limit_name
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+class InvalidFieldException(Exception):
+    def __init__(self, field, status_code):
+        self.field = field
+        self.status_code = status_code
+
+class IdempotencyKeyReusedException(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+class IdempotencyKeyInProgressException(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+# JSON error responses of the exceptions above, shared by the Flask app and the ASGI app
+exception_messages = {
+    InvalidContactException: lambda error: "Invalid contact: " + error.contact,
+    DatabaseInsertionException: lambda error: "Error occured while inserting in database: " + error.exception_message,
+    SMSProviderException: lambda error: "Error occured while sending SMS: " + error.exception_message,
+    FCMProviderException: lambda error: "Error occured while sending notification: " + error.exception_message,
+    InvalidQueryParameterException: lambda error: "Invalid query parameter: " + error.parameter,
+    InvalidFieldException: lambda error: "Invalid field: " + error.field,
+    RateLimitExceededException: lambda error: "Too Many Requests: rate limit '" + error.limit_name + "' exceeded",
+    RegistrationIDsNULLException: lambda error: "Tokens list cannot be empty / nulled list",
+    JSONBodyFormatException: lambda error: "Passed JSON body format is incorrect",
+    JobQueueFullException: lambda error: "Too many pending requests, retry later",
+    MissingJSONBodyException: lambda error: "Method cannot have empty JSON body",
+    IdempotencyKeyReusedException: lambda error: "Idempotency-Key has already been used for a different request",
+    IdempotencyKeyInProgressException: lambda error: "A request with the same Idempotency-Key is in progress, retry later"
+}
+
+exception_headers = {
+    RateLimitExceededException: lambda error: {'Retry-After': str(error.retry_after)},
+    JobQueueFullException: lambda error: {'Retry-After': '1'},
+    SMSProviderException: lambda error: {'Retry-After': str(math.ceil(error.retry_after))} if error.retry_after else {},
+    FCMProviderException: lambda error: {'Retry-After': str(math.ceil(error.retry_after))} if error.retry_after else {},
+    IdempotencyKeyInProgressException: lambda error: {'Retry-After': '1'}
+}
+
+# Returns the (JSON body, status code, headers) of the response to the passed exception
+def exception_response(error):
+    body = {
+        'success': False,
+        'error': error.status_code,
+        'message': exception_messages[type(error)](error)
+    }
+    headers = exception_headers[type(error)](error) if type(error) in exception_headers else {}
+    return body, error.status_code, headers
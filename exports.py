@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import select, and_
+
+from models import Client, Message, Notification, Token, TokenNotification
+
+# Streaming exports of the history tables
+# Rows are read from a server-side cursor ("stream_results", a named cursor with psycopg2)
+# by chunks of "chunk_size" rows and serialized chunk by chunk, so the memory used by an export
+# is bounded by the chunk size whatever the number of exported rows, and the first bytes are
+# sent as soon as the first chunk is read.
+
+export_formats = ('ndjson', 'csv')
+
+def messages_query(start, end):
+    messages = Message.__table__
+    clients = Client.__table__
+    return select([
+        messages.c.id, messages.c.subject, messages.c.body, messages.c.time, messages.c.client_id, clients.c.contact
+    ]).select_from(messages.join(clients, clients.c.id == messages.c.client_id)) \
+        .where(and_(messages.c.time >= start, messages.c.time < end)) \
+        .order_by(messages.c.time, messages.c.id)
+
+# One row per delivery (notification, token), notifications without any token are exported once with a null token
+def notifications_query(start, end):
+    notifications = Notification.__table__
+    tokennotifications = TokenNotification.__table__
+    tokens = Token.__table__
+    return select([
+        notifications.c.id, notifications.c.title, notifications.c.body, notifications.c.time, tokens.c.token
+    ]).select_from(
+        notifications.outerjoin(tokennotifications, and_(
+            tokennotifications.c.notification_id == notifications.c.id, tokennotifications.c.time == notifications.c.time))
+        .outerjoin(tokens, tokens.c.id == tokennotifications.c.token_id)
+    ).where(and_(notifications.c.time >= start, notifications.c.time < end)) \
+        .order_by(notifications.c.time, notifications.c.id)
+
+export_queries = {
+    'messages': messages_query,
+    'notifications': notifications_query
+}
+
+# Yields the exported rows by chunks (lists of rows)
+def export_row_chunks(engine, kind, start, end, chunk_size=5000):
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(export_queries[kind](start, end))
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def ndjson_chunks(row_chunks):
+    for rows in row_chunks:
+        yield ''.join(json.dumps({key: format_value(value) for key, value in row.items()}) + '\n' for row in rows)
+
+def csv_chunks(row_chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header_written = False
+    for rows in row_chunks:
+        if not header_written:
+            writer.writerow(rows[0].keys())
+            header_written = True
+        for row in rows:
+            writer.writerow([format_value(value) for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# Yields the serialized export (str chunks, or bytes chunks when "gzip" is set)
+def export(engine, kind, start, end, export_format='ndjson', gzip=False, chunk_size=5000):
+    row_chunks = export_row_chunks(engine, kind, start, end, chunk_size)
+    chunks = ndjson_chunks(row_chunks) if export_format == 'ndjson' else csv_chunks(row_chunks)
+    if gzip:
+        return gzip_chunks(chunks)
+    return chunks
@@ -0,0 +1,222 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from pyfcm import FCMNotification
+
+from exceptions import FCMProviderException
+from resilience import parse_retry_after, request_error_class
+
+# Delivery errors of single tokens that may succeed later, they are retried (and dead lettered
+# when they still fail) -> error class of the retry policy
+retryable_delivery_errors = {
+    'Unavailable': 'unavailable',
+    'InternalServerError': 'unavailable'
+}
+
+# Dispatcher that keeps one long-lived FCM client per worker process.
+# PyFCM opens a new connection for every request it sends and sends the chunks of
+# a multicast one after the other, so this class only reuses PyFCM to build the payloads
+# and sends them through a pooled HTTP session on a bounded thread pool instead.
+# With a "resilience" (see "resilience.py") every request is sent through its circuit breaker and retry
+# policy, and the tokens of a multicast whose result is a retryable error are sent again.
+# A failed chunk does not fail the other chunks of a multicast: its tokens get the 'Unavailable' error
+class FCMDispatcher:
+    def __init__(self, api_key, chunk_size=1000, max_workers=8, timeout=10, endpoint=None, resilience=None):
+        self.payload_builder = FCMNotification(api_key=api_key)
+        self.chunk_size = min(chunk_size, FCMNotification.FCM_MAX_RECIPIENTS)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.endpoint = endpoint or FCMNotification.FCM_END_POINT
+        self.resilience = resilience
+        self._lock = threading.Lock()
+        self._session = None
+        self._executor = None
+
+    # The session and the executor are created lazily, so the dispatcher can be
+    # created at import time in a master process and used in its forked workers
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update(self.payload_builder.request_headers())
+                    self._session = session
+        return self._session
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='fcm')
+        return self._executor
+
+    def chunks(self, registration_ids):
+        for i in range(0, len(registration_ids), self.chunk_size):
+            yield registration_ids[i:i + self.chunk_size]
+
+    def notify_single_device(self, registration_id, message_title=None, message_body=None):
+        result = self.send_chunk([registration_id], message_title, message_body)
+        if isinstance(result, FCMProviderException):
+            raise result
+        return merge_results([result])
+
+    # Splits the registration ids into provider sized chunks, sends the chunks concurrently
+    # and merges their results into one response (results keep the order of the passed ids).
+    # Raises the error of the chunks only when all of them failed
+    def notify_multiple_devices(self, registration_ids, message_title=None, message_body=None):
+        chunks = list(self.chunks(registration_ids))
+        if len(chunks) == 1:
+            chunk_results = [self.send_chunk(chunks[0], message_title, message_body)]
+        else:
+            chunk_results = list(self.executor.map(
+                lambda chunk: self.send_chunk(chunk, message_title, message_body), chunks))
+        errors = [result for result in chunk_results if isinstance(result, FCMProviderException)]
+        if len(errors) == len(chunk_results):
+            raise errors[0]
+        return merge_results([
+            failed_chunk_result(chunk) if isinstance(result, FCMProviderException) else result
+            for chunk, result in zip(chunks, chunk_results)
+        ])
+
+    # Returns the result of the chunk, or the exception it failed with
+    def send_chunk(self, tokens, message_title, message_body):
+        try:
+            result = self.send_payload(self.payload_builder.parse_payload(
+                registration_ids=tokens, message_title=message_title, message_body=message_body))
+        except FCMProviderException as error:
+            return error
+        if self.resilience is not None:
+            self.retry_failed_deliveries(tokens, result, message_title, message_body)
+        return result
+
+    # Sends again the tokens whose result is a retryable error (following the retry policy),
+    # their results are replaced in "result"
+    def retry_failed_deliveries(self, tokens, result, message_title, message_body):
+        results = result.get('results') or []
+        if len(results) != len(tokens):
+            return
+        attempt = 0
+        while True:
+            positions = [i for i, token_result in enumerate(results) if token_result.get('error') in retryable_delivery_errors]
+            if not positions:
+                return
+            delay = self.resilience.policy.delay(attempt, retryable_delivery_errors[results[positions[0]]['error']])
+            if delay is None:
+                return
+            self.resilience.count_retry('delivery')
+            self.resilience.sleep(delay)
+            attempt += 1
+            try:
+                retry_result = self.send_payload(self.payload_builder.parse_payload(
+                    registration_ids=[tokens[i] for i in positions], message_title=message_title, message_body=message_body))
+            except FCMProviderException:
+                return
+            retry_results = retry_result.get('results') or []
+            if len(retry_results) != len(positions):
+                return
+            for position, token_result in zip(positions, retry_results):
+                results[position] = token_result
+            result['success'] = sum(1 for token_result in results if 'error' not in token_result)
+            result['failure'] = len(results) - result['success']
+
+    def notify_topic_subscribers(self, topic_name, message_title=None, message_body=None):
+        payload = self.payload_builder.parse_payload(
+            topic_name=topic_name, message_title=message_title, message_body=message_body)
+        return merge_results([self.send_payload(payload)])
+
+    def send_payload(self, payload):
+        if self.resilience is None:
+            return self.post_payload(payload)
+        return self.resilience.call(self.post_payload, payload)
+
+    def post_payload(self, payload):
+        try:
+            response = self.session.post(self.endpoint, data=payload, timeout=self.timeout)
+        except requests.RequestException as ex:
+            error_class = request_error_class(ex)
+            raise FCMProviderException(str(ex), 504 if error_class == 'timeout' else 502, error_class)
+        return parse_response(response)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+# Parses a single FCM response the same way PyFCM does,
+# the errors are raised as "FCMProviderException" classified for the retries
+def parse_response(response):
+    return parse_response_content(response.status_code, response.content, parse_retry_after(response.headers.get('Retry-After')))
+
+# Used by the synchronous and the asynchronous ("async_providers.py") dispatchers
+def parse_response_content(status_code, content, retry_after=None):
+    if status_code == 200:
+        if not content:
+            return {}
+        parsed_response = json.loads(content)
+        success = parsed_response.get('success', 0)
+        # topic messages only return a message id
+        if parsed_response.get('message_id'):
+            success = 1
+        return {
+            'multicast_id': parsed_response.get('multicast_id'),
+            'success': success,
+            'failure': parsed_response.get('failure', 0),
+            'canonical_ids': parsed_response.get('canonical_ids', 0),
+            'results': parsed_response.get('results', [])
+        }
+    elif status_code == 401:
+        raise FCMProviderException("There was an error authenticating the sender account", 502, 'rejected')
+    elif status_code == 400:
+        raise FCMProviderException(content.decode('utf-8', 'replace'), 502, 'rejected')
+    elif status_code == 429:
+        raise FCMProviderException("FCM rate limit exceeded", 503, 'rate_limited', retry_after)
+    else:
+        raise FCMProviderException("FCM server is temporarily unavailable", 503, 'unavailable', retry_after)
+
+# Result of a chunk that could not be sent, every token gets a retryable error
+def failed_chunk_result(tokens):
+    return {
+        'success': 0,
+        'failure': len(tokens),
+        'canonical_ids': 0,
+        'results': [{'error': 'Unavailable'} for _ in tokens]
+    }
+
+# Merges the per chunk responses into one response
+def merge_results(chunk_results):
+    merged = {
+        'multicast_ids': [],
+        'success': 0,
+        'failure': 0,
+        'canonical_ids': 0,
+        'results': []
+    }
+    for result in chunk_results:
+        if result.get('multicast_id') is not None:
+            merged['multicast_ids'].append(result['multicast_id'])
+        merged['success'] += result.get('success', 0)
+        merged['failure'] += result.get('failure', 0)
+        merged['canonical_ids'] += result.get('canonical_ids', 0)
+        merged['results'].extend(result.get('results', []))
+    return merged
+
+# FCM returns one result per registration id, in the same order:
+# {'message_id': ...} when delivered or {'error': 'NotRegistered'} (for example) when not.
+# Returns a dict of token -> error (None when delivered)
+def parse_delivery_results(tokens, result):
+    results = result.get('results') or []
+    if len(results) != len(tokens):
+        return {token: None for token in tokens}
+    return {token: token_result.get('error') for token, token_result in zip(tokens, results)}
@@ -0,0 +1,58 @@
+# Production server (gunicorn -c gunicorn.conf.py wsgi:app)
+# A pre-fork server: the app is imported once by the master process (preload) then forked into
+# "web_workers" workers, each serving requests with "worker_threads" threads ('gthread')
+# or with greenlets ('gevent'). On SIGTERM the workers stop accepting connections, finish their
+# in-flight requests then drain their background sends (async jobs, group commits, history log)
+# within "graceful_timeout" seconds.
+import os
+
+# With preloading the app is imported before the workers patch the standard library,
+# so the gevent patches are applied here, before anything else is imported
+# ("worker_class" is read from the environment like "config.py" does, importing it would come first)
+if os.environ.get('worker_class', 'gthread') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import glob
+
+# The metrics of every worker are aggregated through the metrics directory, emptied at startup.
+# Set before "config" is imported, so the preloaded app (and its metrics registry) uses it
+os.environ.setdefault('metrics_dir', '/tmp/flask-sms-notifications-metrics')
+
+# "worker_class" and "worker_connections" are gunicorn settings as well
+from config import web_port, web_workers, worker_class, worker_threads, worker_connections, graceful_timeout_seconds, request_timeout_seconds
+
+if worker_class not in ('gthread', 'gevent'):
+    raise ValueError("worker_class must be 'gthread' or 'gevent'")
+
+bind = '0.0.0.0:%d' % web_port
+workers = web_workers
+threads = worker_threads
+preload_app = True
+graceful_timeout = graceful_timeout_seconds
+timeout = request_timeout_seconds
+accesslog = '-'
+
+def on_starting(server):
+    for path in glob.glob(os.path.join(os.environ['metrics_dir'], '*.json')):
+        os.unlink(path)
+
+# The connections opened by the master process (if any) must not be shared with the workers
+def post_fork(server, worker):
+    from app import app, db, read_engine
+    with app.app_context():
+        for engine in {db.engine, read_engine()}:
+            engine.dispose()
+    if worker_class == 'gevent':
+        # psycopg2 waits on its sockets cooperatively
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+def post_worker_init(worker):
+    from app import watch_termination, prewarm_database_pools
+    watch_termination()
+    prewarm_database_pools()
+
+def worker_exit(server, worker):
+    from app import drain
+    drain()
@@ -0,0 +1,275 @@
+import fcntl
+import io
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from models import Message, Notification, reserve_ids
+
+logger = logging.getLogger(__name__)
+
+# Write-behind history log
+# Instead of inserting the sent messages/notifications on the request's critical path, the records
+# are appended to a local append-only segment file and the request returns at once.
+# - The active segment is flushed and fsynced in batches every "fsync_interval_seconds".
+# - A segment is closed when it reaches "segment_max_bytes" or "segment_max_age_seconds".
+# - A background loader bulk loads the closed segments with COPY, then deletes them.
+# - Ids are reserved from the tables' sequences by blocks, so the endpoints can still return them.
+# - On start, segments left by a stopped process (detected because nobody holds their lock)
+#   are closed and replayed. Loading is idempotent (ON CONFLICT DO NOTHING on the reserved ids and times),
+#   so a segment loaded twice after a crash does not duplicate the history.
+
+active_suffix = '.log'
+closed_suffix = '.closed'
+
+# Reserves ids from a table's sequence by blocks of "block_size" (one round trip per block)
+class IdAllocator:
+    def __init__(self, table_name, engine_getter, block_size=1000):
+        self.table_name = table_name
+        self.engine_getter = engine_getter
+        self.block_size = block_size
+        self.ids = []
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            if not self.ids:
+                with self.engine_getter().begin() as connection:
+                    self.ids = reserve_ids(self.table_name, self.block_size, connection)
+                self.ids.reverse()
+            return self.ids.pop()
+
+class HistoryLog:
+    def __init__(self, directory, engine_getter, segment_max_bytes=16 * 1024 * 1024, segment_max_age_seconds=5,
+                 fsync_interval_seconds=0.05, id_block_size=1000):
+        self.directory = directory
+        self.engine_getter = engine_getter
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age_seconds = segment_max_age_seconds
+        self.fsync_interval_seconds = fsync_interval_seconds
+        self.message_ids = IdAllocator(Message.__tablename__, engine_getter, id_block_size)
+        self.notification_ids = IdAllocator(Notification.__tablename__, engine_getter, id_block_size)
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_path = None
+        self.segment_opened_at = None
+        self.segment_sequence = 0
+        self.dirty = False
+        self.flusher = None
+        self.loaded_event = threading.Event()
+        self.stopped = threading.Event()
+
+    # Appending records
+    ###################
+    def log_message(self, subject, body, client_id):
+        message_id = self.message_ids.next_id()
+        self.append({
+            'type': 'message',
+            'id': message_id,
+            'subject': subject,
+            'body': body,
+            'time': datetime.now().isoformat(),
+            'client_id': client_id
+        })
+        return message_id
+
+    # "deliveries" is a dict of token -> delivery error (None when delivered)
+    def log_notification(self, title, body, deliveries):
+        notification_id = self.notification_ids.next_id()
+        self.append({
+            'type': 'notification',
+            'id': notification_id,
+            'title': title,
+            'body': body,
+            'time': datetime.now().isoformat(),
+            'deliveries': sorted(deliveries.items())
+        })
+        return notification_id
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        self.start()
+        with self.lock:
+            if self.segment is None:
+                self.open_segment()
+            self.segment.write(line)
+            self.dirty = True
+
+    # Segments
+    ##########
+    def open_segment(self):
+        self.segment_sequence += 1
+        name = 'segment-%d-%d-%06d%s' % (int(time.time() * 1000), os.getpid(), self.segment_sequence, active_suffix)
+        self.segment_path = os.path.join(self.directory, name)
+        self.segment = open(self.segment_path, 'a', encoding='utf-8')
+        # the lock is held as long as the segment is active, so other processes know it is not orphaned
+        fcntl.flock(self.segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.segment_opened_at = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            if self.segment is None or not self.dirty:
+                return
+            self.segment.flush()
+            descriptor = self.segment.fileno()
+            self.dirty = False
+        os.fsync(descriptor)
+
+    # Closes the active segment if it is full or old enough (or if "force" is set)
+    def roll(self, force=False):
+        with self.lock:
+            if self.segment is None:
+                return
+            is_full = self.segment.tell() >= self.segment_max_bytes
+            is_old = time.monotonic() - self.segment_opened_at >= self.segment_max_age_seconds
+            if not (force or is_full or is_old):
+                return
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            closed_path = self.segment_path[:-len(active_suffix)] + closed_suffix
+            os.rename(self.segment_path, closed_path)
+            self.segment.close()
+            self.segment = None
+            self.dirty = False
+
+    # Active segments whose lock is not held belong to a stopped process, they are closed so they get loaded
+    def recover_orphaned_segments(self):
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(active_suffix) or path == self.segment_path:
+                continue
+            with open(path, 'a') as segment:
+                try:
+                    fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                os.rename(path, path[:-len(active_suffix)] + closed_suffix)
+
+    # Loading segments
+    ##################
+    def load_closed_segments(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(closed_suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                segment = open(path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                # already loaded by another process
+                continue
+            with segment:
+                try:
+                    fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                if not os.path.exists(path):
+                    continue
+                self.load_segment(segment)
+                os.unlink(path)
+
+    def load_segment(self, segment):
+        messages = io.StringIO()
+        notifications = io.StringIO()
+        deliveries = io.StringIO()
+        for line in segment:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a torn last line written right before a crash
+                continue
+            if record['type'] == 'message':
+                messages.write(csv_row([record['id'], record['subject'], record['body'], record['time'], record['client_id']]))
+            elif record['type'] == 'notification':
+                notifications.write(csv_row([record['id'], record['title'], record['body'], record['time']]))
+                for token, error in record['deliveries']:
+                    deliveries.write(csv_row([record['id'], token, error]))
+
+        connection = self.engine_getter().raw_connection()
+        try:
+            cursor = connection.cursor()
+            copy_history(cursor, messages, notifications, deliveries)
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    # Background flusher
+    ####################
+    def start(self):
+        if self.flusher is not None:
+            return
+        with self.lock:
+            if self.flusher is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.stopped.clear()
+            self.flusher = threading.Thread(target=self.run, name='history-log-flusher', daemon=True)
+            self.flusher.start()
+
+    def run(self):
+        self.recover_orphaned_segments()
+        while not self.stopped.wait(self.fsync_interval_seconds):
+            try:
+                self.sync()
+                self.roll()
+                self.load_closed_segments()
+            except Exception:
+                # the segments stay on disk and are loaded on the next attempt
+                logger.exception('history log flush failed')
+
+    # Closes the active segment and loads everything that is pending (used at shutdown)
+    def close(self):
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        self.roll(force=True)
+        if os.path.isdir(self.directory):
+            self.load_closed_segments()
+
+# CSV line of the values for COPY: the strings are quoted and None is written as the unquoted NULL marker,
+# so an empty string is not loaded as NULL (COPY never reads a quoted value as NULL)
+null_marker = '\\N'
+
+def csv_row(values):
+    return ','.join(null_marker if value is None else str(value) if isinstance(value, int)
+                    else '"' + str(value).replace('"', '""') + '"' for value in values) + '\n'
+
+# Loads the CSV buffers into the history tables through temporary tables:
+# rows whose ids are already stored (segment replayed after a crash) are skipped,
+# and the relations are only created for the notifications inserted by this load
+def copy_history(cursor, messages, notifications, deliveries):
+    cursor.execute("""
+        CREATE TEMP TABLE history_messages (id integer, subject varchar, body varchar, time timestamp, client_id integer) ON COMMIT DROP;
+        CREATE TEMP TABLE history_notifications (id integer, title varchar, body varchar, time timestamp) ON COMMIT DROP;
+        CREATE TEMP TABLE history_deliveries (notification_id integer, token varchar, error varchar) ON COMMIT DROP;
+    """)
+    for table, buffer in (('history_messages', messages), ('history_notifications', notifications), ('history_deliveries', deliveries)):
+        buffer.seek(0)
+        cursor.copy_expert("COPY " + table + " FROM STDIN WITH (FORMAT csv, NULL '" + null_marker + "')", buffer)
+    cursor.execute("""
+        INSERT INTO messages (id, subject, body, time, client_id)
+        SELECT id, subject, body, time, client_id FROM history_messages
+        ON CONFLICT (id, time) DO NOTHING;
+
+        INSERT INTO tokens (token)
+        SELECT DISTINCT token FROM history_deliveries ORDER BY token
+        ON CONFLICT (token) DO NOTHING;
+
+        WITH inserted_notifications AS (
+            INSERT INTO notifications (id, title, body, time)
+            SELECT id, title, body, time FROM history_notifications
+            ON CONFLICT (id, time) DO NOTHING
+            RETURNING id, time
+        )
+        INSERT INTO tokennotifications (token_id, notification_id, time, error)
+        SELECT tokens.id, history_deliveries.notification_id, inserted_notifications.time, history_deliveries.error
+        FROM history_deliveries
+        JOIN inserted_notifications ON inserted_notifications.id = history_deliveries.notification_id
+        JOIN tokens ON tokens.token = history_deliveries.token;
+    """)
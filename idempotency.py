@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+
+from cachetools import TTLCache
+
+from exceptions import IdempotencyKeyInProgressException, IdempotencyKeyReusedException
+from rate_limiting import RedisConnection
+
+# Idempotency keys
+# A request sent with an "Idempotency-Key" header is executed once: its response is stored
+# (for "ttl_seconds", at most "maxsize" keys per process, least recently used evicted first)
+# and the requests repeating the key get the stored response without executing anything.
+# A duplicate arriving while the first request is running waits for its response instead of
+# running again (at most "wait_timeout_seconds", then 409). Reusing a key for a different
+# request (different body) is rejected with 422.
+# With a shared backend (Redis) the responses and the running requests are seen by all the processes.
+# A running request keeps its key claimed for "claim_ttl_seconds" (at least the time a request may run,
+# so a duplicate never runs while the first request is still sending) unless it finishes earlier.
+# Only final responses are stored: server errors and 429 can be retried with the same key.
+
+class InFlightRequest:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+
+class IdempotencyStore:
+    def __init__(self, maxsize=100000, ttl_seconds=86400, wait_timeout_seconds=30, claim_ttl_seconds=60, backend=None):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.claim_ttl_seconds = claim_ttl_seconds
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.replays = 0
+
+    # Returns (response, replayed): the stored response of the key, or the response returned by "work()".
+    # A response is a dict of 'status_code', 'body' (text) and 'headers'
+    def execute(self, key, fingerprint, work):
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    in_flight = InFlightRequest(fingerprint)
+                    self.entries[key] = in_flight
+                    break
+            if not isinstance(entry, InFlightRequest):
+                return self.replay(entry, fingerprint), True
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyKeyReusedException(status_code=422)
+            if not entry.done.wait(self.wait_timeout_seconds):
+                raise IdempotencyKeyInProgressException(status_code=409)
+
+        claimed = False
+        try:
+            if self.backend is not None:
+                stored = self.claim_shared(key)
+                if stored is not None:
+                    self.complete(key, stored)
+                    return self.replay(stored, fingerprint), True
+                claimed = True
+            response = work()
+            if is_final(response['status_code']):
+                stored = dict(response, fingerprint=fingerprint)
+                self.complete(key, stored)
+                if claimed:
+                    self.store_shared(key, stored)
+            return response, False
+        finally:
+            with self.lock:
+                if self.entries.get(key) is in_flight:
+                    del self.entries[key]
+            in_flight.done.set()
+            if claimed:
+                self.release_shared(key)
+
+    def complete(self, key, stored):
+        with self.lock:
+            self.entries[key] = stored
+
+    def replay(self, stored, fingerprint):
+        if stored['fingerprint'] != fingerprint:
+            raise IdempotencyKeyReusedException(status_code=422)
+        with self.lock:
+            self.replays += 1
+        return {name: stored[name] for name in ('status_code', 'body', 'headers')}
+
+    # Returns the response stored by another process, or None once this process runs the request.
+    # When the backend cannot be reached the keys are only deduplicated per process
+    def claim_shared(self, key):
+        deadline = time.monotonic() + self.wait_timeout_seconds
+        try:
+            while True:
+                stored = self.backend.get(key)
+                if stored is not None:
+                    return stored
+                if self.backend.claim(key, self.claim_ttl_seconds):
+                    return None
+                if time.monotonic() >= deadline:
+                    raise IdempotencyKeyInProgressException(status_code=409)
+                time.sleep(0.05)
+        except (OSError, ConnectionError):
+            return None
+
+    def store_shared(self, key, stored):
+        try:
+            self.backend.set(key, stored, self.ttl_seconds)
+        except (OSError, ConnectionError):
+            pass
+
+    def release_shared(self, key):
+        try:
+            self.backend.release(key)
+        except (OSError, ConnectionError):
+            pass
+
+def is_final(status_code):
+    return status_code < 500 and status_code != 429
+
+# The running requests are marked by "<prefix><key>:running" keys that expire
+# (so a crashed process does not block its keys)
+class RedisIdempotencyBackend:
+    def __init__(self, url, prefix='idempotency:'):
+        self.connection = RedisConnection(url)
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+    def command(self, *command):
+        with self.lock:
+            return self.connection.send_pipeline([command])[0]
+
+    def get(self, key):
+        stored = self.command('GET', self.prefix + key)
+        return None if stored is None else json.loads(stored)
+
+    def claim(self, key, ttl_seconds):
+        return self.command('SET', self.prefix + key + ':running', '1', 'NX', 'PX', int(ttl_seconds * 1000)) == 'OK'
+
+    def set(self, key, stored, ttl_seconds):
+        self.command('SET', self.prefix + key, json.dumps(stored), 'PX', int(ttl_seconds * 1000))
+
+    def release(self, key):
+        self.command('DEL', self.prefix + key + ':running')
+
+def create_idempotency_store(storage, maxsize, ttl_seconds, wait_timeout_seconds, claim_ttl_seconds, redis_url=None):
+    if storage == 'memory':
+        backend = None
+    elif storage == 'redis':
+        backend = RedisIdempotencyBackend(redis_url)
+    else:
+        raise ValueError('Unknown idempotency storage: ' + str(storage))
+    return IdempotencyStore(maxsize=maxsize, ttl_seconds=ttl_seconds, wait_timeout_seconds=wait_timeout_seconds,
+                            claim_ttl_seconds=claim_ttl_seconds, backend=backend)
@@ -0,0 +1,117 @@
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from exceptions import JobQueueFullException
+
+# Asynchronous execution of accepted send requests
+# Requests are validated by the endpoints, then queued in a bounded in-process queue
+# that is drained by a fixed pool of worker threads, so the throughput depends on the
+# number of workers and not on the round trip time of the providers.
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __init__(self, function, args):
+        self.id = uuid.uuid4().hex
+        self.function = function
+        self.args = args
+        self.status = Job.QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+
+    def format(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+    def __repr__(self):
+        return f'job id: {self.id}, status: {self.status}'
+
+class JobQueue:
+    def __init__(self, app, workers=4, max_queued_jobs=1000, max_tracked_jobs=10000):
+        self.app = app
+        self.workers = workers
+        self.max_tracked_jobs = max_tracked_jobs
+        self.queue = queue.Queue(maxsize=max_queued_jobs)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    # Queues the passed function with its arguments and returns the created job,
+    # raises JobQueueFullException (429 Too Many Requests) when the queue is full
+    def submit(self, function, *args):
+        self.start()
+        job = Job(function, args)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            raise JobQueueFullException(status_code=429)
+        with self.lock:
+            self.jobs[job.id] = job
+            # Keep the status of the latest jobs only, so the registry cannot grow without limit
+            while len(self.jobs) > self.max_tracked_jobs:
+                self.jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    # Worker threads are started on the first submitted job
+    # (and not at import time) so they are started in the serving process
+    def start(self):
+        if self.threads:
+            return
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name='job-worker-' + str(i), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            job.status = Job.RUNNING
+            try:
+                with self.app.app_context():
+                    job.result = job.function(*job.args)
+                job.status = Job.SUCCEEDED
+            except Exception as ex:
+                job.error = {
+                    'error': getattr(ex, 'status_code', 500),
+                    'message': str(ex) or ex.__class__.__name__
+                }
+                job.status = Job.FAILED
+            finally:
+                job.finished_at = datetime.now()
+                self.queue.task_done()
+
+    # Waits for the queued jobs to finish then stops the workers
+    def shutdown(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
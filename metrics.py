@@ -0,0 +1,261 @@
+import bisect
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+# Prometheus-style metrics
+# Counters and histograms are recorded in "shard_count" shards: every thread (or greenlet) is given one
+# of them in turn, so recording a value only contends with the few threads sharing its shard, and
+# the shards do not grow with the threads started over the life of the process. The shards are summed
+# when the metrics are collected.
+# Gauges (and counters kept elsewhere, e.g. by the rate limiter) are read by callbacks at collection time.
+#
+# With several worker processes, every process writes a snapshot of its metrics to "directory"
+# ("<pid>.json", every "flush_interval_seconds" and on every scrape) and "/metrics" aggregates the
+# snapshots of all the processes: counters and histograms are summed (the snapshots of stopped
+# processes are kept, so the counters never go backwards), the callback metrics are summed over the live processes.
+# The directory shall be emptied when the server starts.
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+shard_count = 16
+
+def labels_key(label_values):
+    return json.dumps([str(value) for value in label_values])
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.reset()
+
+    # Returns the (values, lock) of the shard of the current thread
+    def shard(self):
+        index = getattr(self.local, 'index', None)
+        if index is None:
+            index = self.local.index = next(self.next_index) % shard_count
+        return self.shards[index]
+
+    def inc(self, amount=1, *label_values):
+        shard, lock = self.shard()
+        key = labels_key(label_values)
+        with lock:
+            shard[key] = shard.get(key, 0) + amount
+
+    # Also called in a forked process: the locks may have been held by a thread of the parent
+    def reset(self):
+        self.shards = [({}, threading.Lock()) for _ in range(shard_count)]
+        self.local = threading.local()
+        self.next_index = itertools.count()
+
+    # Returns {labels key: value} summed over all the shards
+    def collect(self):
+        values = {}
+        for shard, lock in self.shards:
+            with lock:
+                shard = dict(shard)
+            for key, value in shard.items():
+                values[key] = values.get(key, 0) + value
+        return values
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=default_buckets):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+
+    # A series is [count of each bucket..., count above the last bucket, sum]
+    def observe(self, value, *label_values):
+        shard, lock = self.shard()
+        key = labels_key(label_values)
+        with lock:
+            series = shard.get(key)
+            if series is None:
+                series = shard[key] = [0] * (len(self.buckets) + 2)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def collect(self):
+        values = {}
+        for shard, lock in self.shards:
+            with lock:
+                shard = {key: list(series) for key, series in shard.items()}
+            for key, series in shard.items():
+                total = values.setdefault(key, [0] * (len(self.buckets) + 2))
+                for index, value in enumerate(series):
+                    total[index] += value
+        return values
+
+# A metric whose samples ({labels tuple: value}) are returned by "callback" at collection time
+class CallbackMetric:
+    def __init__(self, name, help, callback, label_names=(), type='gauge'):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.label_names = tuple(label_names)
+        self.type = type
+
+    def collect(self):
+        return {labels_key(label_values): value for label_values, value in self.callback().items()}
+
+class MetricsRegistry:
+    def __init__(self, directory=None, flush_interval_seconds=1):
+        self.directory = directory
+        self.flush_interval_seconds = flush_interval_seconds
+        self.metrics = []
+        self.pid = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self.register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=default_buckets):
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def gauge(self, name, help, callback, label_names=()):
+        return self.register(CallbackMetric(name, help, callback, label_names))
+
+    def callback_counter(self, name, help, callback, label_names=()):
+        return self.register(CallbackMetric(name, help, callback, label_names, type='counter'))
+
+    # Starts the snapshot writer of the current process, the values recorded before a fork
+    # (e.g. while the app is preloaded by the master process) are not carried into the worker
+    def start(self):
+        if self.pid == os.getpid() or self.directory is None:
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                for metric in self.metrics:
+                    if isinstance(metric, Counter):
+                        metric.reset()
+            self.pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            self.thread = threading.Thread(target=self.run, name='metrics-writer', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(self.flush_interval_seconds)
+            try:
+                self.write_snapshot()
+            except OSError:
+                pass
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'metrics': {metric.name: metric.collect() for metric in self.metrics}
+        }
+
+    def write_snapshot(self):
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(temporary_path, path)
+
+    def read_snapshots(self):
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    # Returns {metric name: {labels key: value}} aggregated over all the processes
+    def aggregate(self):
+        if self.directory is None:
+            return self.snapshot()['metrics']
+        self.start()
+        self.write_snapshot()
+        aggregated = {metric.name: {} for metric in self.metrics}
+        callback_metrics = {metric.name for metric in self.metrics if isinstance(metric, CallbackMetric)}
+        for snapshot in self.read_snapshots():
+            live = process_is_alive(snapshot['pid'])
+            for name, values in snapshot['metrics'].items():
+                if name not in aggregated or (name in callback_metrics and not live):
+                    continue
+                for key, value in values.items():
+                    if isinstance(value, list):
+                        total = aggregated[name].setdefault(key, [0] * len(value))
+                        for index, item in enumerate(value):
+                            total[index] += item
+                    else:
+                        aggregated[name][key] = aggregated[name].get(key, 0) + value
+        return aggregated
+
+    # Prometheus text exposition format (version 0.0.4)
+    def exposition(self):
+        aggregated = self.aggregate()
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for key, value in sorted(aggregated.get(metric.name, {}).items()):
+                labels = list(zip(metric.label_names, json.loads(key)))
+                if metric.type != 'histogram':
+                    lines.append('%s%s %s' % (metric.name, format_labels(labels), format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (metric.name, format_labels(labels + [('le', format_value(bound))]), cumulative))
+                lines.append('%s_sum%s %s' % (metric.name, format_labels(labels), format_value(value[-1])))
+                lines.append('%s_count%s %d' % (metric.name, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+def process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+# Per request stages
+# The time a request spends in each stage ('db', 'provider', 'serialization') is accumulated in "g"
+def record_stage(stage, seconds):
+    if has_app_context():
+        stage_seconds = g.setdefault('stage_seconds', {})
+        stage_seconds[stage] = stage_seconds.get(stage, 0) + seconds
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
@@ -0,0 +1,37 @@
+"""unique index on clients contact
+
+Revision ID: 3c9e1f4a7b21
+Revises: 22d10b5c5e61
+Create Date: 2021-03-02 19:41:05.218334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e1f4a7b21'
+down_revision = '22d10b5c5e61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Merge the duplicated clients (created by concurrent first time sends) into the oldest one
+    # before the unique index can be created
+    op.execute("""
+        UPDATE messages SET client_id = duplicates.kept_id
+        FROM (
+            SELECT id, min(id) OVER (PARTITION BY contact) AS kept_id FROM clients
+        ) AS duplicates
+        WHERE messages.client_id = duplicates.id AND duplicates.id <> duplicates.kept_id
+    """)
+    op.execute("""
+        DELETE FROM clients USING clients AS kept
+        WHERE clients.contact = kept.contact AND clients.id > kept.id
+    """)
+    op.create_index(op.f('ix_clients_contact'), 'clients', ['contact'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_clients_contact'), table_name='clients')
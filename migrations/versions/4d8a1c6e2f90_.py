@@ -0,0 +1,37 @@
+"""dead letters
+
+Revision ID: 4d8a1c6e2f90
+Revises: 9b4e2f7c1a36
+Create Date: 2021-03-14 17:48:26.530194
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '4d8a1c6e2f90'
+down_revision = '9b4e2f7c1a36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('dead_letters',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('status', sa.String(), server_default='pending', nullable=False),
+    sa.Column('replay_attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('replayed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_dead_letters_pending_id', 'dead_letters', ['id'], unique=False, postgresql_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_dead_letters_pending_id', table_name='dead_letters')
+    op.drop_table('dead_letters')
@@ -0,0 +1,43 @@
+"""topics and segments
+
+Revision ID: 5e7a0c3d1b92
+Revises: b41f7c2d9e58
+Create Date: 2021-03-08 20:41:09.273514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7a0c3d1b92'
+down_revision = 'b41f7c2d9e58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('topics',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('kind', sa.String(), server_default='topic', nullable=False),
+    sa.Column('member_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('kind', 'name', name='uq_topics_kind_name')
+    )
+    op.create_table('topic_members',
+    sa.Column('topic_id', sa.Integer(), nullable=False),
+    sa.Column('token_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['token_id'], ['tokens.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['topic_id'], ['topics.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('topic_id', 'token_id')
+    )
+    op.create_index('ix_topic_members_token_id', 'topic_members', ['token_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_topic_members_token_id', table_name='topic_members')
+    op.drop_table('topic_members')
+    op.drop_table('topics')
@@ -0,0 +1,146 @@
+"""partition the history tables by month
+
+Revision ID: 7f3d2a9c5e14
+Revises: 5e7a0c3d1b92
+Create Date: 2021-03-10 09:12:54.608231
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3d2a9c5e14'
+down_revision = '5e7a0c3d1b92'
+branch_labels = None
+depends_on = None
+
+# Monthly partitions are created from the month of the oldest row to this number of months ahead,
+# later months are created by "flask maintain-partitions"
+months_ahead = 3
+
+history_tables = ('notifications', 'messages', 'tokennotifications')
+
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def create_partitions(table, first_month, last_month):
+    op.execute('CREATE TABLE %s_default PARTITION OF %s DEFAULT' % (table, table))
+    month = first_month
+    while month <= last_month:
+        op.execute("CREATE TABLE %s_p%04d_%02d PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+            table, month.year, month.month, table, month.isoformat(), add_months(month, 1).isoformat()))
+        month = add_months(month, 1)
+
+
+def create_history_tables(partitioned):
+    partition_options = {'postgresql_partition_by': 'RANGE (time)'} if partitioned else {}
+    op.create_table('notifications',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('notifications_id_seq')"), nullable=False),
+    sa.Column('title', sa.String(), nullable=True),
+    sa.Column('body', sa.String(), nullable=True),
+    sa.Column('time', sa.DateTime(), nullable=not partitioned),
+    sa.PrimaryKeyConstraint(*(('id', 'time') if partitioned else ('id',))),
+    **partition_options
+    )
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('messages_id_seq')"), nullable=False),
+    sa.Column('subject', sa.String(), nullable=True),
+    sa.Column('body', sa.String(), nullable=True),
+    sa.Column('time', sa.DateTime(), nullable=not partitioned),
+    sa.Column('client_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['client_id'], ['clients.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint(*(('id', 'time') if partitioned else ('id',))),
+    **partition_options
+    )
+    tokennotifications_columns = [
+        sa.Column('id', sa.Integer(), server_default=sa.text("nextval('tokennotifications_id_seq')"), nullable=False),
+        sa.Column('token_id', sa.Integer(), nullable=False),
+        sa.Column('notification_id', sa.Integer(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['token_id'], ['tokens.id'], ondelete='cascade')
+    ]
+    if partitioned:
+        tokennotifications_columns += [
+            sa.Column('time', sa.DateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['notification_id', 'time'], ['notifications.id', 'notifications.time'], ondelete='cascade'),
+            sa.PrimaryKeyConstraint('id', 'time')
+        ]
+    else:
+        tokennotifications_columns += [
+            sa.ForeignKeyConstraint(['notification_id'], ['notifications.id'], ondelete='cascade'),
+            sa.PrimaryKeyConstraint('id')
+        ]
+    op.create_table('tokennotifications', *tokennotifications_columns, **partition_options)
+    op.create_index('ix_notifications_time_id', 'notifications', ['time', 'id'], unique=False)
+    op.create_index('ix_messages_client_id_time_id', 'messages', ['client_id', 'time', 'id'], unique=False)
+    op.create_index('ix_tokennotifications_token_id_notification_id', 'tokennotifications', ['token_id', 'notification_id'], unique=False)
+
+
+# The current tables are renamed (with their primary keys, and without their indexes
+# whose names are reused) and their sequences are detached so they survive the tables
+def set_aside_history_tables():
+    op.drop_index('ix_tokennotifications_token_id_notification_id', table_name='tokennotifications')
+    op.drop_index('ix_messages_client_id_time_id', table_name='messages')
+    op.drop_index('ix_notifications_time_id', table_name='notifications')
+    for table in history_tables:
+        op.execute('ALTER TABLE %s RENAME TO %s_previous' % (table, table))
+        op.execute('ALTER TABLE %s_previous RENAME CONSTRAINT %s_pkey TO %s_previous_pkey' % (table, table, table))
+        op.execute('ALTER SEQUENCE %s_id_seq OWNED BY NONE' % table)
+
+
+def drop_previous_history_tables():
+    for table in reversed(history_tables):
+        op.drop_table(table + '_previous')
+    for table in history_tables:
+        op.execute('ALTER SEQUENCE %s_id_seq OWNED BY %s.id' % (table, table))
+
+
+def upgrade():
+    connection = op.get_bind()
+    oldest_time = connection.execute(sa.text(
+        'SELECT least((SELECT min(time) FROM notifications), (SELECT min(time) FROM messages))')).scalar()
+    current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    first_month = min(oldest_time or current_month, current_month).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    set_aside_history_tables()
+    create_history_tables(partitioned=True)
+    for table in history_tables:
+        create_partitions(table, first_month, add_months(current_month, months_ahead))
+
+    # rows stored without a time (the column was nullable) are kept in the month of the migration
+    op.execute("""
+        INSERT INTO notifications (id, title, body, time)
+        SELECT id, title, body, coalesce(time, now()) FROM notifications_previous;
+
+        INSERT INTO messages (id, subject, body, time, client_id)
+        SELECT id, subject, body, coalesce(time, now()), client_id FROM messages_previous;
+
+        INSERT INTO tokennotifications (id, token_id, notification_id, time, error)
+        SELECT tokennotifications_previous.id, tokennotifications_previous.token_id,
+               tokennotifications_previous.notification_id, notifications.time, tokennotifications_previous.error
+        FROM tokennotifications_previous
+        JOIN notifications ON notifications.id = tokennotifications_previous.notification_id;
+    """)
+    drop_previous_history_tables()
+
+
+def downgrade():
+    set_aside_history_tables()
+    create_history_tables(partitioned=False)
+    op.execute("""
+        INSERT INTO notifications (id, title, body, time)
+        SELECT id, title, body, time FROM notifications_previous;
+
+        INSERT INTO messages (id, subject, body, time, client_id)
+        SELECT id, subject, body, time, client_id FROM messages_previous;
+
+        INSERT INTO tokennotifications (id, token_id, notification_id, error)
+        SELECT id, token_id, notification_id, error FROM tokennotifications_previous;
+    """)
+    drop_previous_history_tables()
@@ -0,0 +1,28 @@
+"""history pagination indexes
+
+Revision ID: 8d2b6e0f4c13
+Revises: 3c9e1f4a7b21
+Create Date: 2021-03-04 21:12:47.730519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2b6e0f4c13'
+down_revision = '3c9e1f4a7b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_messages_client_id_time_id', 'messages', ['client_id', 'time', 'id'], unique=False)
+    op.create_index('ix_notifications_time_id', 'notifications', ['time', 'id'], unique=False)
+    op.create_index('ix_tokennotifications_token_id_notification_id', 'tokennotifications', ['token_id', 'notification_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tokennotifications_token_id_notification_id', table_name='tokennotifications')
+    op.drop_index('ix_notifications_time_id', table_name='notifications')
+    op.drop_index('ix_messages_client_id_time_id', table_name='messages')
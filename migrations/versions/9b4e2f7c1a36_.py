@@ -0,0 +1,43 @@
+"""scheduled jobs
+
+Revision ID: 9b4e2f7c1a36
+Revises: c6e8f1a2d4b7
+Create Date: 2021-03-13 11:05:42.618207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4e2f7c1a36'
+down_revision = 'c6e8f1a2d4b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scheduled_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('run_at', sa.DateTime(), nullable=False),
+    sa.Column('status', sa.String(), server_default='pending', nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('claimed_by', sa.String(), nullable=True),
+    sa.Column('claimed_until', sa.DateTime(), nullable=True),
+    sa.Column('result', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_scheduled_jobs_pending_run_at_id', 'scheduled_jobs', ['run_at', 'id'], unique=False, postgresql_where=sa.text("status = 'pending'"))
+    op.create_index('ix_scheduled_jobs_claimed_until', 'scheduled_jobs', ['claimed_until'], unique=False, postgresql_where=sa.text("status IN ('claimed', 'running')"))
+
+
+def downgrade():
+    op.drop_index('ix_scheduled_jobs_claimed_until', table_name='scheduled_jobs')
+    op.drop_index('ix_scheduled_jobs_pending_run_at_id', table_name='scheduled_jobs')
+    op.drop_table('scheduled_jobs')
@@ -0,0 +1,32 @@
+"""inactive tokens and delivery errors
+
+Revision ID: b41f7c2d9e58
+Revises: 8d2b6e0f4c13
+Create Date: 2021-03-07 18:05:32.416087
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b41f7c2d9e58'
+down_revision = '8d2b6e0f4c13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tokens', sa.Column('active', sa.Boolean(), server_default=sa.true(), nullable=False))
+    op.add_column('tokens', sa.Column('inactive_reason', sa.String(), nullable=True))
+    op.add_column('tokens', sa.Column('inactive_since', sa.DateTime(), nullable=True))
+    op.create_index('ix_tokens_inactive', 'tokens', ['token'], unique=False, postgresql_where=sa.text('NOT active'))
+    op.add_column('tokennotifications', sa.Column('error', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tokennotifications', 'error')
+    op.drop_index('ix_tokens_inactive', table_name='tokens')
+    op.drop_column('tokens', 'inactive_since')
+    op.drop_column('tokens', 'inactive_reason')
+    op.drop_column('tokens', 'active')
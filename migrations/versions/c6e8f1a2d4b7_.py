@@ -0,0 +1,29 @@
+"""indexes for notification relations and message time ranges
+
+Revision ID: c6e8f1a2d4b7
+Revises: 7f3d2a9c5e14
+Create Date: 2021-03-11 16:27:03.915842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6e8f1a2d4b7'
+down_revision = '7f3d2a9c5e14'
+branch_labels = None
+depends_on = None
+
+
+# "messages.client_id" and "tokennotifications.token_id" are already covered by the leading
+# columns of "ix_messages_client_id_time_id" and "ix_tokennotifications_token_id_notification_id",
+# and "notifications.time" by "ix_notifications_time_id"
+def upgrade():
+    op.create_index('ix_tokennotifications_notification_id_time', 'tokennotifications', ['notification_id', 'time'], unique=False)
+    op.create_index('ix_messages_time_id', 'messages', ['time', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_messages_time_id', table_name='messages')
+    op.drop_index('ix_tokennotifications_notification_id_time', table_name='tokennotifications')
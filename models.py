@@ -1,68 +1,247 @@
 import os
-from sqlalchemy import Column, String, Integer, DateTime, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from functools import wraps
+from sqlalchemy import Column, String, Integer, DateTime, Boolean, DDL, event, text, select, and_, orm, tuple_
+from sqlalchemy.dialects.postgresql import insert, JSONB
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.expression import true as sa_true
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
 from datetime import datetime
 
 from exceptions import DatabaseInsertionException
+from unit_of_work import in_unit_of_work
+from config import db_pool_size, db_max_overflow, db_pool_timeout_seconds, db_pool_pre_ping, db_pool_recycle_seconds, db_statement_timeout_ms, db_pgbouncer
 
 user = os.environ.get('db_user')
 pw = os.environ.get('db_pw')
 database_name = os.environ.get('db_name')
 db_host = os.environ.get('db_host')
-database_path = "postgresql://{}:{}@{}:5432/{}".format(user, pw, db_host, database_name)
+# "database_url" overrides the database built from the variables above (e.g. for benchmarks)
+database_path = os.environ.get('database_url') or "postgresql://{}:{}@{}:5432/{}".format(user, pw, db_host, database_name)
+# Read-only history and export queries are sent to this replica when it is set
+database_replica_path = os.environ.get('database_replica_url')
 
-db = SQLAlchemy()
+# Connection pools
+# Every engine (the primary and the replica) has its own pool, named so its checkout waits are
+# reported separately. The functions in "pool_checkout_observers" are called with
+# (pool name, seconds waited, timed out) on every checkout, a checkout that times out
+# (the pool is exhausted) raises "PoolTimeoutError"
+pool_checkout_observers = []
+
+class TimedQueuePool(QueuePool):
+    name = 'primary'
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.observe_checkout(time.perf_counter() - started_at, True)
+            raise
+        self.observe_checkout(time.perf_counter() - started_at, False)
+        return connection
+
+    def observe_checkout(self, seconds, timed_out):
+        for observer in pool_checkout_observers:
+            observer(self.name, seconds, timed_out)
+
+    # the pool is recreated when the engine is disposed (e.g. in forked workers)
+    def recreate(self):
+        pool = super().recreate()
+        pool.name = self.name
+        return pool
+
+def engine_options():
+    if db_pgbouncer:
+        return {'poolclass': NullPool}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': db_pool_size,
+        'max_overflow': db_max_overflow,
+        'pool_timeout': db_pool_timeout_seconds,
+        'pool_pre_ping': db_pool_pre_ping,
+        'pool_recycle': db_pool_recycle_seconds
+    }
+    if db_statement_timeout_ms:
+        options['connect_args'] = {'options': '-c statement_timeout=%d' % db_statement_timeout_ms}
+    return options
+
+# PgBouncer (transaction pooling) does not accept startup options and may run every transaction
+# on a different server connection, so the statement timeout is set at the start of each transaction
+def set_local_statement_timeout(connection):
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('SET LOCAL statement_timeout = %d' % db_statement_timeout_ms)
+    finally:
+        cursor.close()
+
+# Opens "connections" connections and returns them to the pool
+def prewarm_pool(engine, connections):
+    if isinstance(engine.pool, NullPool):
+        return
+    opened = []
+    try:
+        for _ in range(min(connections, db_pool_size)):
+            opened.append(engine.connect())
+    finally:
+        for connection in opened:
+            connection.close()
+
+# Replica routing
+# The ORM queries run in a function decorated by "reads_from_replica" (and the engine returned
+# by "read_engine") use the replica when one is configured. The replica may lag behind the
+# primary, so only the history and export reads (that tolerate a short delay) are routed to it
+replica_routing = threading.local()
+
+def reads_from_replica(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = getattr(replica_routing, 'enabled', False)
+        replica_routing.enabled = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            replica_routing.enabled = previous
+    return wrapper
+
+def read_engine():
+    if database_replica_path:
+        return db.get_engine(bind='replica')
+    return db.engine
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if database_replica_path and getattr(replica_routing, 'enabled', False):
+            return db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
 
 def setup_db(app):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+    if database_replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {'replica': database_replica_path}
     db.app = app
     db.init_app(app)
     migrate = Migrate(app, db)
+    with app.app_context():
+        if database_replica_path:
+            read_engine().pool.name = 'replica'
+        if db_pgbouncer and db_statement_timeout_ms:
+            for engine in {db.engine, read_engine()}:
+                event.listen(engine, 'begin', set_local_statement_timeout)
 
 #create a fresh version of database
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
+# Inside a unit of work the pending objects are only flushed (to get their generated ids)
+# and committed once by the unit of work, otherwise they are committed right away
+def commit_or_flush():
+    if in_unit_of_work():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+# Reserve "count" ids from the sequence of the passed table's id column in one round trip,
+# so that bulk inserted rows know their ids without relying on the order of "RETURNING"
+def reserve_ids(table_name, count, connection=None):
+    connection = connection or db.session
+    if count <= 0:
+        return []
+    rows = connection.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table_name, 'id')) FROM generate_series(1, :count)"),
+        {'table_name': table_name, 'count': count})
+    return [row[0] for row in rows]
+
+# Ids of the rows of "table" whose unique "column" has the passed values, the missing rows are created.
+# "DO NOTHING" leaves the existing rows untouched ("DO UPDATE" would write a new version of each of them)
+# but does not return them, so their ids are read by a second statement, only when some already existed.
+# Values are deduplicated and sorted so that concurrent inserts lock the rows in the same order
+def get_or_create_ids(table, column, values, connection=None):
+    connection = connection or db.session
+    unique_values = sorted(set(values))
+    if not unique_values:
+        return {}
+    statement = insert(table).values([{column.name: value} for value in unique_values])
+    statement = statement.on_conflict_do_nothing(index_elements=[column]).returning(table.c.id, column)
+    ids = {row[1]: row[0] for row in connection.execute(statement)}
+    existing_values = [value for value in unique_values if value not in ids]
+    if existing_values:
+        rows = connection.execute(select([table.c.id, column]).where(column.in_(existing_values)))
+        ids.update({row[1]: row[0] for row in rows})
+    return ids
+
 class Client(db.Model):
     __tablename__ = 'clients'
     id = Column(Integer, primary_key=True)
-    contact = Column(String)
+    contact = Column(String, index=True, unique=True)
     messages = db.relationship('Message', backref='client_message', cascade='all,delete', lazy=True)
     
     def insert(self):
         try:
             db.session.add(self)
-            db.session.commit()
-        except:
-            db.session.roll_back()
+            commit_or_flush()
+        except Exception as ex:
+            db.session.rollback()
+            raise DatabaseInsertionException(str(ex), 500)
+
+    # Atomic get or create of a client id: concurrent first time sends to the same contact
+    # cannot create duplicated clients thanks to the unique index on "contact"
+    @staticmethod
+    def get_or_create_id(contact, connection=None):
+        return Client.resolve_many([contact], connection)[contact]
+
+    # Resolve the ids of the passed contacts, contacts that are not stored yet are created
+    # (see "get_or_create_ids")
+    @staticmethod
+    def resolve_many(contacts, connection=None):
+        clients_table = Client.__table__
+        return get_or_create_ids(clients_table, clients_table.c.contact, contacts, connection)
 
     def format(self):
         return {
             'id': self.id,
             'contact': self.contact,
-            'messages': [message.format() for message in Message.query.filter_by(client_id=self.id).all()]
+            # uses the relationship (instead of a query per client) so listing clients
+            # with "selectinload(Client.messages)" loads all their messages in one query
+            'messages': [message.format() for message in self.messages]
         }
     
     def __repr__(self):
         return f'client id: {self.id}, contact: {self.contact}'
     
+# The history tables (notifications, tokennotifications and messages) are range partitioned by month
+# on "time" (see "partitions.py"), so "time" is part of their primary keys
 class Notification(db.Model):
     __tablename__ = 'notifications'
-    id = Column(Integer, primary_key=True)
+    __table_args__ = (
+        # keyset pagination of "/notifications"
+        db.Index('ix_notifications_time_id', 'time', 'id'),
+        {'postgresql_partition_by': 'RANGE (time)'}
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String)
     body = Column(String)
-    time = Column(DateTime, default=datetime.now())
+    time = Column(DateTime, primary_key=True, default=datetime.now)
     notificationtokens = db.relationship('TokenNotification', backref='notification_tokens', cascade='all,delete', lazy=True)
 
     def insert(self):
         try:
             db.session.add(self)
-            db.session.commit()
+            commit_or_flush()
         except Exception as ex:
-            db.session.roll_back()
+            db.session.rollback()
             raise DatabaseInsertionException(str(ex), 500)
         
     def format(self):
@@ -78,22 +257,55 @@ class Notification(db.Model):
 
 class Token(db.Model):
     __tablename__ = 'tokens'
+    __table_args__ = (
+        # the inactive tokens are loaded periodically by every worker (see "dead_tokens.py")
+        db.Index('ix_tokens_inactive', 'token', postgresql_where=text('NOT active')),
+    )
     id = Column(Integer, primary_key=True)
     token = Column(String, unique=True)
+    # Tokens that FCM reported as permanently invalid (e.g. 'NotRegistered') are marked inactive
+    # and are not targeted anymore
+    active = Column(Boolean, nullable=False, default=True, server_default=sa_true())
+    inactive_reason = Column(String)
+    inactive_since = Column(DateTime)
     tokennotifications = db.relationship('TokenNotification', backref='token_notifications', cascade='all,delete', lazy=True)
 
     def insert(self):
         try:
             db.session.add(self)
-            db.session.commit()
+            commit_or_flush()
         except Exception as ex:
-            db.session.roll_back()
+            db.session.rollback()
             raise DatabaseInsertionException(str(ex), 500)
         
+    # Resolve the ids of all passed tokens, tokens that are not stored yet are created
+    # (see "get_or_create_ids")
+    @staticmethod
+    def upsert_many(tokens, connection=None):
+        tokens_table = Token.__table__
+        return get_or_create_ids(tokens_table, tokens_table.c.token, tokens, connection)
+
+    # Marks the passed tokens (dict of token -> reason) inactive, one statement per reason
+    @staticmethod
+    def mark_inactive(reasons, connection=None):
+        connection = connection or db.session
+        tokens_table = Token.__table__
+        tokens_by_reason = {}
+        for token, reason in reasons.items():
+            tokens_by_reason.setdefault(reason, []).append(token)
+        current_time = datetime.now()
+        for reason, tokens in tokens_by_reason.items():
+            connection.execute(tokens_table.update().where(
+                tokens_table.c.token.in_(sorted(tokens))
+            ).values(active=False, inactive_reason=reason, inactive_since=current_time))
+
     def format(self):
         return {
             'id': self.id,
-            'token': self.token
+            'token': self.token,
+            'active': self.active,
+            'inactive_reason': self.inactive_reason,
+            'inactive_since': self.inactive_since
         }
 
     def __repr__(self):
@@ -107,39 +319,199 @@ class Token(db.Model):
 # but I implemented it for data tracking purpose
 class TokenNotification(db.Model):
     __tablename__ = 'tokennotifications'
-    id = Column(Integer, primary_key=True)
+    __table_args__ = (
+        # notifications received by a token ("/tokens/<token>/notifications")
+        db.Index('ix_tokennotifications_token_id_notification_id', 'token_id', 'notification_id'),
+        # relations of a notification (eager loading, exports, cascading deletes of notifications)
+        db.Index('ix_tokennotifications_notification_id_time', 'notification_id', 'time'),
+        db.ForeignKeyConstraint(['notification_id', 'time'], ['notifications.id', 'notifications.time'], ondelete='cascade'),
+        {'postgresql_partition_by': 'RANGE (time)'}
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
     token_id = Column(Integer, db.ForeignKey('tokens.id', ondelete='cascade'), nullable=False)
-    notification_id = Column(Integer, db.ForeignKey('notifications.id', ondelete='cascade'), nullable=False)
+    notification_id = Column(Integer, nullable=False)
+    # time of the notification, so the relations are stored (and expire) in the partition of their notification
+    time = Column(DateTime, primary_key=True)
+    # FCM error of the delivery to this token (None when delivered)
+    error = Column(String)
+
+    # Store the relations between a notification and the passed token ids
+    # (dict of token id -> delivery error) in one multi-row insert statement
+    @staticmethod
+    def insert_many(token_errors, notification_id, notification_time, connection=None):
+        connection = connection or db.session
+        if not token_errors:
+            return
+        connection.execute(TokenNotification.__table__.insert().values([
+            {'token_id': token_id, 'notification_id': notification_id, 'time': notification_time, 'error': error}
+            for token_id, error in token_errors.items()
+        ]))
 
     def insert(self):
         try:
             db.session.add(self)
-            db.session.commit()
+            commit_or_flush()
         except Exception as ex:
-            db.session.roll_back()
+            db.session.rollback()
             raise DatabaseInsertionException(str(ex), 500)
         
     def format(self):
         return {
             'id': self.id,
             'token_id': self.token_id,
-            'notification_id': self.notification_id
+            'notification_id': self.notification_id,
+            'time': self.time,
+            'error': self.error
+        }
+
+# Local audiences: topics (tokens subscribe and unsubscribe themselves) and segments (membership
+# computed outside the API, e.g. by a campaign job, and loaded in bulk). Both keep their precomputed
+# membership in "topic_members", so a send only reads it, and maintain their member count on every
+# membership change, so the size of a campaign is known without counting the members
+class Topic(db.Model):
+    __tablename__ = 'topics'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    # 'topic' or 'segment'
+    kind = Column(String, nullable=False, default='topic', server_default='topic')
+    member_count = Column(Integer, nullable=False, default=0, server_default='0')
+    created_at = Column(DateTime, default=datetime.now)
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'name', name='uq_topics_kind_name'),
+    )
+
+    # Atomic get or create of an audience id (see "get_or_create_ids")
+    @staticmethod
+    def get_or_create(kind, name, connection=None):
+        connection = connection or db.session
+        topics_table = Topic.__table__
+        statement = insert(topics_table).values(kind=kind, name=name, member_count=0, created_at=datetime.now())
+        statement = statement.on_conflict_do_nothing(
+            index_elements=[topics_table.c.kind, topics_table.c.name]
+        ).returning(topics_table.c.id, topics_table.c.member_count)
+        row = connection.execute(statement).first()
+        if row is None:
+            row = connection.execute(select([topics_table.c.id, topics_table.c.member_count]).where(
+                and_(topics_table.c.kind == kind, topics_table.c.name == name))).first()
+        return row
+
+    # Adds the passed tokens to the audience (tokens that are not stored yet are created)
+    # and returns its new member count, only the inserted rows (not the already existing members) are counted
+    @staticmethod
+    def add_members(topic_id, tokens, connection=None):
+        connection = connection or db.session
+        members_table = TopicMember.__table__
+        token_ids = Token.upsert_many(tokens, connection)
+        added = 0
+        if token_ids:
+            current_time = datetime.now()
+            statement = insert(members_table).values([
+                {'topic_id': topic_id, 'token_id': token_id, 'created_at': current_time} for token_id in sorted(token_ids.values())
+            ]).on_conflict_do_nothing().returning(members_table.c.token_id)
+            added = len(connection.execute(statement).fetchall())
+        return Topic.update_member_count(topic_id, added, connection)
+
+    # Removes the passed tokens from the audience and returns its new member count
+    @staticmethod
+    def remove_members(topic_id, tokens, connection=None):
+        connection = connection or db.session
+        members_table = TopicMember.__table__
+        tokens_table = Token.__table__
+        removed = 0
+        if tokens:
+            removed = connection.execute(members_table.delete().where(and_(
+                members_table.c.topic_id == topic_id,
+                members_table.c.token_id.in_(select([tokens_table.c.id]).where(tokens_table.c.token.in_(sorted(set(tokens)))))
+            ))).rowcount
+        return Topic.update_member_count(topic_id, -removed, connection)
+
+    @staticmethod
+    def update_member_count(topic_id, delta, connection):
+        topics_table = Topic.__table__
+        return connection.execute(topics_table.update().where(topics_table.c.id == topic_id).values(
+            member_count=topics_table.c.member_count + delta
+        ).returning(topics_table.c.member_count)).scalar()
+
+    # Yields the active members of the audience by batches of (token id, token) lists.
+    # Every batch is read by its own short keyset query on the (topic_id, token_id) primary key,
+    # so the memory used does not depend on the size of the audience and no transaction
+    # is kept open while a batch is being sent
+    @staticmethod
+    def member_batches(engine, topic_id, batch_size):
+        members_table = TopicMember.__table__
+        tokens_table = Token.__table__
+        last_token_id = 0
+        while True:
+            with engine.connect() as connection:
+                rows = connection.execute(select([members_table.c.token_id, tokens_table.c.token]).select_from(
+                    members_table.join(tokens_table, tokens_table.c.id == members_table.c.token_id)
+                ).where(and_(
+                    members_table.c.topic_id == topic_id,
+                    members_table.c.token_id > last_token_id,
+                    tokens_table.c.active.is_(True)
+                )).order_by(members_table.c.token_id).limit(batch_size)).fetchall()
+            if not rows:
+                return
+            yield [(row[0], row[1]) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_token_id = rows[-1][0]
+
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'kind': self.kind,
+            'member_count': self.member_count
         }
 
+    def __repr__(self):
+        return f'{self.kind}: {self.name}, members: {self.member_count}'
+
+class TopicMember(db.Model):
+    __tablename__ = 'topic_members'
+    __table_args__ = (
+        # deleting a token removes its memberships
+        db.Index('ix_topic_members_token_id', 'token_id'),
+    )
+    topic_id = Column(Integer, db.ForeignKey('topics.id', ondelete='cascade'), primary_key=True)
+    token_id = Column(Integer, db.ForeignKey('tokens.id', ondelete='cascade'), primary_key=True)
+    created_at = Column(DateTime, default=datetime.now)
+
 class Message(db.Model):
     __tablename__ = 'messages'
-    id = Column(Integer, primary_key=True)
+    __table_args__ = (
+        # keyset pagination of a client's messages ("/clients/<contact>/messages")
+        db.Index('ix_messages_client_id_time_id', 'client_id', 'time', 'id'),
+        # exports of a time range
+        db.Index('ix_messages_time_id', 'time', 'id'),
+        {'postgresql_partition_by': 'RANGE (time)'}
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
     subject = Column(String)
     body = Column(String)
-    time = Column(DateTime, default=datetime.now())
+    time = Column(DateTime, primary_key=True, default=datetime.now)
     client_id = Column(Integer, db.ForeignKey('clients.id', ondelete='cascade'), nullable=False)
 
+    # Insert the passed messages (dicts of subject, body, time and client_id) in one
+    # multi-row insert and return their ids in the same order
+    @staticmethod
+    def insert_many(messages, connection=None):
+        connection = connection or db.session
+        if not messages:
+            return []
+        message_ids = reserve_ids(Message.__tablename__, len(messages), connection)
+        connection.execute(Message.__table__.insert().values(
+            [dict(message, id=message_id) for message, message_id in zip(messages, message_ids)]
+        ))
+        return message_ids
+
     def insert(self):
         try:
             db.session.add(self)
-            db.session.commit()
+            commit_or_flush()
         except Exception as ex:
-            db.session.roll_back()
+            db.session.rollback()
             raise DatabaseInsertionException(str(ex), 500)
     
     def format(self):
@@ -152,4 +524,206 @@ class Message(db.Model):
         }
 
     def __repr__(self):
-        return f'message id: {self.id}, subject: {self.subject}, body: {self.body}, time: {self.time}, client_id: {self.client_id}'
\ No newline at end of file
+        return f'message id: {self.id}, subject: {self.subject}, body: {self.body}, time: {self.time}, client_id: {self.client_id}'
+
+# Sends scheduled for later (see "scheduler.py"). A job is 'pending' until an instance claims it
+# ('claimed'), then 'running' while it is sent, and ends 'done', 'failed' or 'cancelled'.
+# Every transition is a conditional update, so a job is claimed and started by one instance only
+class ScheduledJob(db.Model):
+    __tablename__ = 'scheduled_jobs'
+    __table_args__ = (
+        # due jobs loaded in run time order by every instance
+        db.Index('ix_scheduled_jobs_pending_run_at_id', 'run_at', 'id', postgresql_where=text("status = 'pending'")),
+        # expired claims
+        db.Index('ix_scheduled_jobs_claimed_until', 'claimed_until', postgresql_where=text("status IN ('claimed', 'running')")),
+    )
+    id = Column(Integer, primary_key=True)
+    # 'sms', 'notification_tokens' or 'notification_topic'
+    kind = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    run_at = Column(DateTime, nullable=False)
+    status = Column(String, nullable=False, default='pending', server_default='pending')
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    claimed_by = Column(String)
+    claimed_until = Column(DateTime)
+    result = Column(JSONB)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)
+
+    # Insert the passed jobs (dicts of kind, payload and run_at) in one multi-row insert
+    # and return their ids in the same order
+    @staticmethod
+    def schedule_many(jobs, connection=None):
+        connection = connection or db.session
+        if not jobs:
+            return []
+        job_ids = reserve_ids(ScheduledJob.__tablename__, len(jobs), connection)
+        current_time = datetime.now()
+        connection.execute(ScheduledJob.__table__.insert().values([
+            dict(job, id=job_id, status='pending', attempts=0, created_at=current_time)
+            for job, job_id in zip(jobs, job_ids)
+        ]))
+        return job_ids
+
+    # Returns at most "limit" (id, run_at) of the pending jobs due before "until",
+    # in run time order, after the (run_at, id) key "after"
+    @staticmethod
+    def pending_until(until, after=None, limit=500, connection=None):
+        connection = connection or db.session
+        jobs_table = ScheduledJob.__table__
+        conditions = [jobs_table.c.status == 'pending', jobs_table.c.run_at < until]
+        if after is not None:
+            conditions.append(tuple_(jobs_table.c.run_at, jobs_table.c.id) > tuple_(*after))
+        return connection.execute(select([jobs_table.c.id, jobs_table.c.run_at]).where(and_(*conditions)).order_by(
+            jobs_table.c.run_at, jobs_table.c.id
+        ).limit(limit)).fetchall()
+
+    # Claims the passed jobs that are still pending and returns their (id, kind, payload).
+    # The rows locked by a concurrent claim are skipped instead of waited for: they belong to another instance
+    @staticmethod
+    def claim(job_ids, worker_id, lease_until, connection=None):
+        connection = connection or db.session
+        jobs_table = ScheduledJob.__table__
+        claimable = select([jobs_table.c.id]).where(and_(
+            jobs_table.c.id.in_(sorted(job_ids)), jobs_table.c.status == 'pending'
+        )).with_for_update(skip_locked=True)
+        return connection.execute(jobs_table.update().where(jobs_table.c.id.in_(claimable)).values(
+            status='claimed', claimed_by=worker_id, claimed_until=lease_until, attempts=jobs_table.c.attempts + 1
+        ).returning(jobs_table.c.id, jobs_table.c.kind, jobs_table.c.payload)).fetchall()
+
+    # Starts a job claimed by "worker_id", returns False if the claim has been lost (expired)
+    @staticmethod
+    def start(job_id, worker_id, lease_until, connection=None):
+        return ScheduledJob.transition(job_id, worker_id, 'claimed', connection,
+                                       status='running', claimed_until=lease_until)
+
+    # Gives a claimed job back (e.g. when the instance stops before starting it)
+    @staticmethod
+    def release(job_id, worker_id, connection=None):
+        return ScheduledJob.transition(job_id, worker_id, 'claimed', connection,
+                                       status='pending', claimed_by=None, claimed_until=None)
+
+    @staticmethod
+    def finish(job_id, worker_id, status, result=None, error=None, connection=None):
+        return ScheduledJob.transition(job_id, worker_id, 'running', connection,
+                                       status=status, result=result, error=error, finished_at=datetime.now())
+
+    @staticmethod
+    def transition(job_id, worker_id, from_status, connection=None, **values):
+        connection = connection or db.session
+        jobs_table = ScheduledJob.__table__
+        return connection.execute(jobs_table.update().where(and_(
+            jobs_table.c.id == job_id, jobs_table.c.claimed_by == worker_id, jobs_table.c.status == from_status
+        )).values(**values)).rowcount == 1
+
+    # Claims of stopped instances: the claimed jobs have not been started and are pending again,
+    # the running ones may have been sent already, so they are failed instead of sent twice
+    @staticmethod
+    def expire_claims(current_time, connection=None):
+        connection = connection or db.session
+        jobs_table = ScheduledJob.__table__
+        connection.execute(jobs_table.update().where(and_(
+            jobs_table.c.status == 'claimed', jobs_table.c.claimed_until < current_time
+        )).values(status='pending', claimed_by=None, claimed_until=None))
+        connection.execute(jobs_table.update().where(and_(
+            jobs_table.c.status == 'running', jobs_table.c.claimed_until < current_time
+        )).values(status='failed', error='interrupted', finished_at=current_time))
+
+    # Cancels a pending job, returns False if it is not pending anymore
+    @staticmethod
+    def cancel(job_id, connection=None):
+        connection = connection or db.session
+        jobs_table = ScheduledJob.__table__
+        return connection.execute(jobs_table.update().where(and_(
+            jobs_table.c.id == job_id, jobs_table.c.status == 'pending'
+        )).values(status='cancelled', finished_at=datetime.now())).rowcount == 1
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'run_at': self.run_at,
+            'status': self.status,
+            'attempts': self.attempts,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+    def __repr__(self):
+        return f'scheduled job id: {self.id}, kind: {self.kind}, run_at: {self.run_at}, status: {self.status}'
+
+# Sends that still failed after the retries of the provider calls (see "resilience.py"), kept 'pending'
+# until they are replayed with "flask replay-dead-letters". The payload is the same as the scheduled
+# jobs' of the same kind ('sms', 'notification_tokens' or 'notification_topic')
+class DeadLetter(db.Model):
+    __tablename__ = 'dead_letters'
+    __table_args__ = (
+        db.Index('ix_dead_letters_pending_id', 'id', postgresql_where=text("status = 'pending'")),
+    )
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    error = Column(String)
+    # 'pending' or 'replayed'
+    status = Column(String, nullable=False, default='pending', server_default='pending')
+    replay_attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    created_at = Column(DateTime, default=datetime.now)
+    replayed_at = Column(DateTime)
+
+    @staticmethod
+    def store(kind, payload, error, connection=None):
+        connection = connection or db.session
+        dead_letters_table = DeadLetter.__table__
+        return connection.execute(dead_letters_table.insert().values(
+            kind=kind, payload=payload, error=error, status='pending', replay_attempts=0, created_at=datetime.now()
+        ).returning(dead_letters_table.c.id)).scalar()
+
+    # Locks the oldest pending dead letter after "after_id" (of "kind" if passed) until the end of the transaction,
+    # the dead letters locked by a concurrent replay are skipped. Returns its (id, kind, payload) or None
+    @staticmethod
+    def lock_next_pending(kind=None, after_id=0, connection=None):
+        connection = connection or db.session
+        dead_letters_table = DeadLetter.__table__
+        conditions = [dead_letters_table.c.status == 'pending', dead_letters_table.c.id > after_id]
+        if kind is not None:
+            conditions.append(dead_letters_table.c.kind == kind)
+        return connection.execute(select([
+            dead_letters_table.c.id, dead_letters_table.c.kind, dead_letters_table.c.payload
+        ]).where(and_(*conditions)).order_by(dead_letters_table.c.id).limit(1).with_for_update(skip_locked=True)).first()
+
+    # Records the outcome of a replay, a dead letter that failed again stays pending with its new error
+    # (and "payload", what is left to send, when it was partially sent)
+    @staticmethod
+    def record_replay(dead_letter_id, error=None, payload=None, connection=None):
+        connection = connection or db.session
+        dead_letters_table = DeadLetter.__table__
+        values = {'replay_attempts': dead_letters_table.c.replay_attempts + 1}
+        if error is None:
+            values.update(status='replayed', replayed_at=datetime.now())
+        else:
+            values['error'] = error
+        if payload is not None:
+            values['payload'] = payload
+        connection.execute(dead_letters_table.update().where(dead_letters_table.c.id == dead_letter_id).values(**values))
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'error': self.error,
+            'status': self.status,
+            'replay_attempts': self.replay_attempts,
+            'created_at': self.created_at,
+            'replayed_at': self.replayed_at
+        }
+
+    def __repr__(self):
+        return f'dead letter id: {self.id}, kind: {self.kind}, status: {self.status}, error: {self.error}'
+
+# Tables created by "db.create_all" (instead of the migrations) get a default partition,
+# so they accept rows of any time until "flask maintain-partitions" creates the monthly partitions
+for partitioned_table in (Notification.__table__, TokenNotification.__table__, Message.__table__):
+    event.listen(partitioned_table, 'after_create', DDL('CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT'))
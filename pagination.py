@@ -0,0 +1,60 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from exceptions import InvalidQueryParameterException
+
+# Keyset (seek) pagination on (time, id)
+# Pages are ordered by the most recent first, and the next page starts right after the
+# (time, id) of the last returned row, so the cost of a page does not depend on its position
+# (unlike OFFSET pagination that scans and discards all the previous rows).
+
+def encode_cursor(time, id):
+    raw = json.dumps([time.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    try:
+        time, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(time), int(id)
+    except (ValueError, TypeError):
+        raise InvalidQueryParameterException('cursor', 400)
+
+def parse_limit(limit, default_limit, max_limit):
+    if limit is None:
+        return default_limit
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise InvalidQueryParameterException('limit', 400)
+    if limit <= 0 or limit > max_limit:
+        raise InvalidQueryParameterException('limit', 400)
+    return limit
+
+# Returns the requested fields ("fields" query parameter as comma separated names),
+# or all the allowed fields when no projection is requested
+def parse_fields(fields, allowed_fields):
+    if not fields:
+        return list(allowed_fields)
+    requested_fields = [field.strip() for field in fields.split(',') if field.strip()]
+    for field in requested_fields:
+        if field not in allowed_fields:
+            raise InvalidQueryParameterException('fields', 400)
+    return requested_fields
+
+# Applies the keyset condition and ordering to the query and returns (rows, next cursor)
+def keyset_page(query, time_column, id_column, cursor, limit):
+    if cursor:
+        cursor_time, cursor_id = decode_cursor(cursor)
+        query = query.filter(tuple_(time_column, id_column) < tuple_(cursor_time, cursor_id))
+    rows = query.order_by(time_column.desc(), id_column.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(getattr(rows[-1], time_column.key), getattr(rows[-1], id_column.key))
+    return rows, next_cursor
+
+def project(row, fields):
+    return {field: getattr(row, field) for field in fields}
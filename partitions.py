@@ -0,0 +1,86 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+# Monthly range partitions of the history tables
+# "messages", "notifications" and "tokennotifications" are partitioned by range on "time", one partition
+# per month named "<table>_pYYYY_MM" (plus a default partition that stays empty as long as the partitions
+# are created ahead of time). A relation is stored with the time of its notification, so a month of
+# "tokennotifications" expires together with the same month of "notifications".
+# Expired months are detached (kept as plain tables, e.g. to be archived) or dropped, which is
+# immediate and leaves no dead rows behind, unlike deleting the expired rows.
+
+# Tables are listed in the order their partitions are removed: the relations before their notifications
+partitioned_tables = ('tokennotifications', 'notifications', 'messages')
+retention_actions = ('detach', 'drop')
+
+partition_name_pattern = re.compile(r'^(?P<table>\w+)_p(?P<year>\d{4})_(?P<month>\d{2})$')
+
+def month_start(time):
+    return datetime(time.year, time.month, 1)
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+def partition_name(table, month):
+    return '%s_p%04d_%02d' % (table, month.year, month.month)
+
+# Returns the months of the existing monthly partitions of the table
+def partition_months(connection, table):
+    rows = connection.execute(text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :table
+    """), {'table': table})
+    months = []
+    for row in rows:
+        match = partition_name_pattern.match(row[0])
+        if match and match.group('table') == table:
+            months.append(datetime(int(match.group('year')), int(match.group('month')), 1))
+    return sorted(months)
+
+def create_partition(connection, table, month):
+    connection.execute(text('CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (\'%s\') TO (\'%s\')' % (
+        partition_name(table, month), table, month.isoformat(), add_months(month, 1).isoformat())))
+
+def remove_partition(connection, table, month, action):
+    name = partition_name(table, month)
+    connection.execute(text('ALTER TABLE %s DETACH PARTITION %s' % (table, name)))
+    if action == 'drop':
+        connection.execute(text('DROP TABLE %s' % name))
+        return
+    # a detached partition keeps the foreign keys of its table, the ones referencing the other
+    # history tables would prevent the partitions of the same month from being detached from them
+    constraints = connection.execute(text("""
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = CAST(:name AS regclass) AND contype = 'f'
+        AND confrelid IN (SELECT CAST(table_name AS regclass) FROM unnest(CAST(:tables AS text[])) AS table_name)
+    """), {'name': name, 'tables': list(partitioned_tables)})
+    for constraint in [row[0] for row in constraints]:
+        connection.execute(text('ALTER TABLE %s DROP CONSTRAINT %s' % (name, constraint)))
+
+# Creates the partitions of the current month and of the "months_ahead" next months, and removes
+# (detaches or drops, per "action") the partitions of the months older than "retention_months".
+# Returns the names of the created and removed partitions
+def maintain_partitions(connection, months_ahead=3, retention_months=12, action='detach', now=None):
+    if action not in retention_actions:
+        raise ValueError('Unknown retention action: ' + str(action))
+    current_month = month_start(now or datetime.now())
+    oldest_kept_month = add_months(current_month, -retention_months)
+    created = []
+    removed = []
+    for table in partitioned_tables:
+        existing_months = partition_months(connection, table)
+        for months in range(months_ahead + 1):
+            month = add_months(current_month, months)
+            if month not in existing_months:
+                create_partition(connection, table, month)
+                created.append(partition_name(table, month))
+        for month in existing_months:
+            if month < oldest_kept_month:
+                remove_partition(connection, table, month, action)
+                removed.append(partition_name(table, month))
+    return created, removed
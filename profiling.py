@@ -0,0 +1,124 @@
+import cProfile
+import glob
+import hmac
+import json
+import os
+import random
+import re
+import time
+from datetime import datetime
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+
+# Opt-in per request profiling
+# A request is profiled when its "X-Profile" header matches the configured token, or randomly
+# with a probability of "sample_rate". A profiled request is run under cProfile and every SQL
+# statement it executes is counted and timed (SQLAlchemy engine events). Statements executed
+# "n_plus_one_threshold" times or more by the same request are flagged as N+1 patterns.
+# The cProfile stats (".prof", readable with pstats or snakeviz) and the statements (".json") are written
+# to a rotating directory. Only a request sent with the token gets the summary in the "X-Profile" response
+# header: the statements of a sampled request are not shown to its (possibly anonymous) client.
+# When both the token and the sample rate are unset nothing is installed, so it costs nothing.
+
+class RequestProfiler:
+    header = 'X-Profile'
+
+    def __init__(self, directory, sample_rate=0, token=None, max_files=200, n_plus_one_threshold=5):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.max_files = max_files
+        self.n_plus_one_threshold = n_plus_one_threshold
+
+    @property
+    def enabled(self):
+        return bool(self.token) or self.sample_rate > 0
+
+    def init_app(self, app, engine):
+        if not self.enabled:
+            return
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def requested(self):
+        return bool(self.token) and hmac.compare_digest(request.headers.get(self.header, ''), self.token)
+
+    def start(self):
+        requested = self.requested()
+        if not requested and not (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another request of the process is being profiled
+            return
+        g.profile = {'profiler': profiler, 'queries': [], 'started_at': time.perf_counter(), 'requested': requested}
+
+    # The start time is kept on the statement's execution context (a failed statement has no "after")
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if context is not None and has_app_context() and 'profile' in g:
+            context.profile_query_started_at = time.perf_counter()
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        started_at = getattr(context, 'profile_query_started_at', None)
+        if started_at is not None and has_app_context() and 'profile' in g:
+            g.profile['queries'].append((statement, time.perf_counter() - started_at))
+
+    def finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        profile['profiler'].disable()
+        statements = summarize_statements(profile['queries'])
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        name = '%s-%d-%s' % (datetime.now().strftime('%Y%m%dT%H%M%S%f'), os.getpid(), re.sub(r'\W+', '_', route).strip('_'))
+        summary = {
+            'duration_ms': round((time.perf_counter() - profile['started_at']) * 1000, 2),
+            'queries': len(profile['queries']),
+            'query_ms': round(sum(duration for _, duration in profile['queries']) * 1000, 2),
+            'n_plus_one': [
+                statement['statement'][:120] for statement in statements if statement['count'] >= self.n_plus_one_threshold
+            ],
+            'profile': name
+        }
+        try:
+            self.write(name, profile['profiler'], summary, statements)
+        except OSError:
+            summary['profile'] = None
+        if profile['requested']:
+            response.headers[self.header] = json.dumps(summary, separators=(',', ':'))
+        return response
+
+    def write(self, name, profiler, summary, statements):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.json', 'w') as statements_file:
+            json.dump(dict(summary, statements=statements), statements_file, indent=2)
+        self.rotate()
+
+    # Keeps the profiles of the latest "max_files" requests
+    def rotate(self):
+        profiles = sorted(glob.glob(os.path.join(self.directory, '*.prof')))
+        for path in profiles[:max(len(profiles) - self.max_files, 0)]:
+            for expired_path in (path, path[:-len('.prof')] + '.json'):
+                try:
+                    os.unlink(expired_path)
+                except FileNotFoundError:
+                    pass
+
+# Groups the executed (statement, duration) by statement, the most executed first.
+# The statements are parametrized, so the same query run with different values is the same statement
+def summarize_statements(queries):
+    statements = {}
+    for statement, duration in queries:
+        summary = statements.setdefault(statement, {'statement': statement, 'count': 0, 'total_ms': 0})
+        summary['count'] += 1
+        summary['total_ms'] += duration * 1000
+    for summary in statements.values():
+        summary['total_ms'] = round(summary['total_ms'], 2)
+    return sorted(statements.values(), key=lambda summary: (-summary['count'], -summary['total_ms']))
@@ -0,0 +1,359 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlparse
+
+from exceptions import RateLimitExceededException
+
+# Rate limiting
+# Limits are enforced with a sliding window counter: the hits of the current fixed window are added
+# to the hits of the previous window weighted by the part of it still covered by the sliding window.
+# It only needs two counters per key and is accurate enough to smooth the bursts at the windows' edges.
+#
+# Counters are kept by a pluggable storage:
+# - MemoryStorage: counters of the current process.
+# - SharedMemoryStorage: counters in a memory mapped file shared by all the worker processes of a host.
+# - RedisStorage: counters shared by all hosts through a Redis (protocol compatible) server, the hits are
+#   counted locally and synchronized in the background so a check never waits for a network round trip.
+
+class MemoryStorage:
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    # Adds "cost" to the counter of the window and returns (current window count, previous window count)
+    def incr(self, key, window, window_seconds, cost):
+        with self.lock:
+            current = self.counters.get((key, window), 0) + cost
+            self.counters[(key, window)] = current
+            previous = self.counters.get((key, window - 1), 0)
+            if len(self.counters) > 100000:
+                self.evict(window)
+            return current, previous
+
+    def decr(self, key, window, cost):
+        with self.lock:
+            if (key, window) in self.counters:
+                self.counters[(key, window)] -= cost
+
+    def evict(self, window):
+        self.counters = {
+            (key, counter_window): count for (key, counter_window), count in self.counters.items()
+            if counter_window >= window - 1
+        }
+
+# Counters live in a fixed size open addressing hash table stored in a memory mapped file,
+# each slot is (key hash, window, count). A slot whose window is older than the previous window is free.
+# The table is locked with flock between processes (and a thread lock inside a process),
+# a check is a few struct reads/writes on shared memory plus two system calls
+class SharedMemoryStorage:
+    slot = struct.Struct('<Qqq')
+    max_probes = 16
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self.size = slots * self.slot.size
+        self.thread_lock = threading.Lock()
+        self.pid = None
+        self.file = None
+        self.memory = None
+
+    # The file is opened by each process (not inherited through fork): flock locks belong to
+    # the open file, so processes sharing an inherited one would not exclude each other
+    def open(self):
+        if self.pid == os.getpid():
+            return
+        self.file = open(self.path, 'a+b')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.file.fileno()).st_size < self.size:
+                self.file.truncate(self.size)
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.memory = mmap.mmap(self.file.fileno(), self.size)
+        self.pid = os.getpid()
+
+    @contextmanager
+    def locked(self):
+        with self.thread_lock:
+            self.open()
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def hash_key(key):
+        # 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    # Returns the offset of the slot of (key hash, window), or of a free slot to store it (None if full)
+    def find(self, key_hash, window, current_window):
+        start = (key_hash ^ (window * 0x9E3779B97F4A7C15)) % self.slots
+        free_offset = None
+        for probe in range(self.max_probes):
+            offset = ((start + probe) % self.slots) * self.slot.size
+            slot_hash, slot_window, _ = self.slot.unpack_from(self.memory, offset)
+            if slot_hash == key_hash and slot_window == window:
+                return offset, True
+            if free_offset is None and (slot_hash == 0 or slot_window < current_window - 1):
+                free_offset = offset
+        return free_offset, False
+
+    def read(self, key_hash, window, current_window):
+        offset, found = self.find(key_hash, window, current_window)
+        return self.slot.unpack_from(self.memory, offset)[2] if found else 0
+
+    def incr(self, key, window, window_seconds, cost):
+        key_hash = self.hash_key(key)
+        with self.locked():
+            offset, found = self.find(key_hash, window, window)
+            if offset is None:
+                # the probed slots are all used by live counters: the hit is not counted (fail open)
+                current = cost
+            else:
+                current = (self.slot.unpack_from(self.memory, offset)[2] if found else 0) + cost
+                self.slot.pack_into(self.memory, offset, key_hash, window, current)
+            previous = self.read(key_hash, window - 1, window)
+            return current, previous
+
+    def decr(self, key, window, cost):
+        key_hash = self.hash_key(key)
+        with self.locked():
+            offset, found = self.find(key_hash, window, window)
+            if found:
+                count = self.slot.unpack_from(self.memory, offset)[2]
+                self.slot.pack_into(self.memory, offset, key_hash, window, count - cost)
+
+# Minimal client of the Redis protocol (RESP), only pipelines of simple commands are needed
+class RedisConnection:
+    def __init__(self, url, timeout=1):
+        parsed_url = urlparse(url)
+        self.address = (parsed_url.hostname or 'localhost', parsed_url.port or 6379)
+        self.database = int(parsed_url.path.lstrip('/') or 0)
+        self.password = parsed_url.password
+        self.timeout = timeout
+        self.socket = None
+        self.reader = None
+
+    def connect(self):
+        self.socket = socket.create_connection(self.address, timeout=self.timeout)
+        self.reader = self.socket.makefile('rb')
+        setup_commands = []
+        if self.password:
+            setup_commands.append(('AUTH', self.password))
+        if self.database:
+            setup_commands.append(('SELECT', self.database))
+        if setup_commands:
+            self.send_pipeline(setup_commands)
+
+    def close(self):
+        if self.socket is not None:
+            self.reader.close()
+            self.socket.close()
+            self.socket = None
+
+    @staticmethod
+    def encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for argument in command:
+            argument = str(argument).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(argument), argument))
+        return b''.join(parts)
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('connection closed by the server')
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            raise ConnectionError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2].decode()
+        if prefix == b'*':
+            length = int(payload)
+            return None if length < 0 else [self.read_reply() for _ in range(length)]
+        raise ConnectionError('unexpected reply: ' + repr(line))
+
+    def send_pipeline(self, commands):
+        if self.socket is None:
+            self.connect()
+        try:
+            self.socket.sendall(b''.join(self.encode(command) for command in commands))
+            return [self.read_reply() for _ in commands]
+        except (OSError, ConnectionError):
+            self.close()
+            raise
+
+# Hits are counted in local counters and the pending increments are pushed to the server every
+# "sync_interval_seconds" (INCRBY returns the global count, which becomes the local snapshot).
+# A check only reads the local snapshot plus the local pending hits, so the other hosts' hits are
+# seen with a delay of at most one sync interval. When the server cannot be reached the limits keep
+# being enforced per process with the local counters.
+class RedisStorage:
+    def __init__(self, url, sync_interval_seconds=0.1, prefix='rate_limit:'):
+        self.connection = RedisConnection(url)
+        self.sync_interval_seconds = sync_interval_seconds
+        self.prefix = prefix
+        self.snapshots = {}
+        self.pending = {}
+        self.expirations = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def incr(self, key, window, window_seconds, cost):
+        self.start()
+        with self.lock:
+            pending = self.pending.get((key, window), 0) + cost
+            self.pending[(key, window)] = pending
+            self.expirations[(key, window)] = window_seconds * 2
+            current = self.snapshots.get((key, window), 0) + pending
+            previous = self.snapshots.get((key, window - 1), 0) + self.pending.get((key, window - 1), 0)
+            return current, previous
+
+    def decr(self, key, window, cost):
+        with self.lock:
+            self.pending[(key, window)] = self.pending.get((key, window), 0) - cost
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='rate-limit-sync', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.sync_interval_seconds):
+            try:
+                self.sync()
+            except (OSError, ConnectionError):
+                # pending hits are kept and pushed by the next successful sync
+                pass
+
+    def sync(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            expirations, self.expirations = self.expirations, {}
+        if not pending:
+            return
+        commands = []
+        keys = list(pending)
+        for key, window in keys:
+            redis_key = self.prefix + key + ':' + str(window)
+            commands.append(('INCRBY', redis_key, pending[(key, window)]))
+            commands.append(('PEXPIRE', redis_key, int(expirations.get((key, window), 120) * 1000)))
+        try:
+            replies = self.connection.send_pipeline(commands)
+        except (OSError, ConnectionError):
+            with self.lock:
+                for counter, count in pending.items():
+                    self.pending[counter] = self.pending.get(counter, 0) + count
+                for counter, expiration in expirations.items():
+                    self.expirations.setdefault(counter, expiration)
+            raise
+        with self.lock:
+            for index, counter in enumerate(keys):
+                self.snapshots[counter] = replies[index * 2]
+            # only the snapshots of the latest windows are needed
+            latest_windows = {}
+            for key, window in self.snapshots:
+                latest_windows[key] = max(window, latest_windows.get(key, window))
+            self.snapshots = {
+                (key, window): count for (key, window), count in self.snapshots.items()
+                if window >= latest_windows[key] - 1
+            }
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.connection.close()
+
+# Client of a request for the per client limits: its API key when it is one of "client_api_keys",
+# its address otherwise
+def client_key(api_key, remote_addr, client_api_keys):
+    if api_key and api_key in client_api_keys:
+        return 'key:' + api_key
+    return 'address:' + str(remote_addr)
+
+# A limit of "limit" hits per "window_seconds" for the key returned by "key_func"
+# ("key_func" returns None when the limit does not apply to the request)
+class RateLimit:
+    def __init__(self, name, limit, window_seconds, key_func):
+        self.name = name
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.key_func = key_func
+
+class RateLimiter:
+    def __init__(self, storage, enabled=True):
+        self.storage = storage
+        self.enabled = enabled
+        self.rejections = 0
+
+    # Counts a hit of "cost" and returns (allowed, seconds to wait before retrying)
+    def hit(self, key, limit, window_seconds, cost=1, now=None):
+        now = time.time() if now is None else now
+        window = int(now // window_seconds)
+        elapsed_fraction = (now % window_seconds) / window_seconds
+        current, previous = self.storage.incr(key, window, window_seconds, cost)
+        if previous * (1 - elapsed_fraction) + current <= limit:
+            return True, 0
+        self.storage.decr(key, window, cost)
+        return False, max(window_seconds * (1 - elapsed_fraction), 1)
+
+    # Checks the passed limits, a request rejected by one limit is not counted by the others
+    def check(self, rate_limits):
+        counted = []
+        for rate_limit in rate_limits:
+            key = rate_limit.key_func()
+            if key is None:
+                continue
+            key = rate_limit.name + ':' + key
+            allowed, retry_after = self.hit(key, rate_limit.limit, rate_limit.window_seconds)
+            if not allowed:
+                now = time.time()
+                for counted_key, counted_limit in counted:
+                    self.storage.decr(counted_key, int(now // counted_limit.window_seconds), 1)
+                self.rejections += 1
+                raise RateLimitExceededException(rate_limit.name, int(retry_after + 0.5), 429)
+            counted.append((key, rate_limit))
+
+    # Decorator applying the passed limits to a view
+    def limit(self, *rate_limits):
+        def decorator(view):
+            @wraps(view)
+            def limited_view(*args, **kwargs):
+                if self.enabled:
+                    self.check(rate_limits)
+                return view(*args, **kwargs)
+            return limited_view
+        return decorator
+
+def create_rate_limit_storage(name, **settings):
+    if name == 'memory':
+        return MemoryStorage()
+    if name == 'shared_memory':
+        return SharedMemoryStorage(settings['path'], settings.get('slots', 65536))
+    if name == 'redis':
+        return RedisStorage(settings['url'], settings.get('sync_interval_seconds', 0.1))
+    raise ValueError('Unknown rate limit storage: ' + str(name))
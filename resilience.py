@@ -0,0 +1,186 @@
+import random
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+# Resilience of the provider calls (FCM and SMS)
+# The provider exceptions carry an "error_class": 'connection' (the connection could not be opened),
+# 'timeout' or 'disconnected' (the request was sent, the provider may have delivered it), 'unavailable'
+# (server errors), 'rate_limited' (429) or 'rejected' (the request itself is invalid, e.g. bad credentials or payload).
+# A failed call is retried with a jittered exponential backoff up to the number of attempts of its
+# error class ('rejected' is never retried), waiting at least the "Retry-After" of the provider.
+# A circuit breaker counts the outcomes of the calls: once the failure rate of the last
+# "window_seconds" crosses the threshold it opens, and the calls fail at once (instead of waiting
+# for the provider's timeout) for "open_seconds". Then one probe call is let through, its outcome
+# closes the circuit or opens it again. Every worker process has its own breakers.
+
+# Returns the seconds to wait of a "Retry-After" header (seconds or HTTP date), None if missing or invalid
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+# Error class of a failed "requests" call. A send is not idempotent, so only the failures to connect
+# (nothing was sent) are 'connection' errors, retried by default
+def request_error_class(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return 'connection'
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.ConnectionError):
+        cause = error.args[0] if error.args else None
+        if isinstance(getattr(cause, 'reason', cause), NewConnectionError):
+            return 'connection'
+    return 'disconnected'
+
+class RetryPolicy:
+    def __init__(self, attempts_by_error_class, base_delay_seconds=0.2, max_delay_seconds=5):
+        # error class -> attempts (including the first one)
+        self.attempts_by_error_class = attempts_by_error_class
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+
+    # Seconds to wait before the retry following the failed "attempt" (0 for the first one),
+    # None when it must not be retried: attempts exhausted, or a "Retry-After" longer than "max_delay_seconds"
+    def delay(self, attempt, error_class, retry_after=None):
+        if attempt + 1 >= self.attempts_by_error_class.get(error_class, 1):
+            return None
+        if retry_after is not None and retry_after > self.max_delay_seconds:
+            return None
+        # "full jitter": concurrent retries of the same failure do not hit the provider at once
+        delay = random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate_threshold=0.5, min_calls=20, window_seconds=30, open_seconds=15):
+        self.failure_rate_threshold = failure_rate_threshold
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.state = CircuitBreaker.CLOSED
+        self.opened_at = None
+        self.probing = False
+        # [second, calls, failures] of the last "window_seconds"
+        self.buckets = deque()
+        self.lock = threading.Lock()
+        self.rejections = 0
+        self.openings = 0
+
+    # Returns (allowed, seconds until the next call may be allowed)
+    def allow(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.state == CircuitBreaker.OPEN:
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    self.rejections += 1
+                    return False, remaining
+                self.state = CircuitBreaker.HALF_OPEN
+                self.probing = False
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if self.probing:
+                    self.rejections += 1
+                    return False, 1
+                self.probing = True
+            return True, 0
+
+    def record(self, success, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.probing = False
+                if success:
+                    self.state = CircuitBreaker.CLOSED
+                    self.buckets.clear()
+                else:
+                    self.open(now)
+                return
+            # calls started before the circuit opened
+            if self.state == CircuitBreaker.OPEN:
+                return
+            second = int(now)
+            if not self.buckets or self.buckets[-1][0] != second:
+                self.buckets.append([second, 0, 0])
+            self.buckets[-1][1] += 1
+            if not success:
+                self.buckets[-1][2] += 1
+            while self.buckets[0][0] <= second - self.window_seconds:
+                self.buckets.popleft()
+            calls = sum(bucket[1] for bucket in self.buckets)
+            failures = sum(bucket[2] for bucket in self.buckets)
+            if calls >= self.min_calls and failures >= calls * self.failure_rate_threshold:
+                self.open(now)
+
+    # A call whose outcome tells nothing about the provider: a probe lets the next call through
+    def release(self):
+        with self.lock:
+            self.probing = False
+
+    def open(self, now):
+        self.state = CircuitBreaker.OPEN
+        self.opened_at = now
+        self.buckets.clear()
+        self.openings += 1
+
+# Calls a provider through its circuit breaker and its retry policy.
+# "open_error(retry_after)" returns the exception raised while the circuit is open
+class Resilience:
+    def __init__(self, policy, breaker, open_error, sleep=time.sleep):
+        self.policy = policy
+        self.breaker = breaker
+        self.open_error = open_error
+        self.sleep = sleep
+        # retries by error class
+        self.retries = Counter()
+        self.lock = threading.Lock()
+
+    def call(self, function, *args):
+        attempt = 0
+        while True:
+            allowed, retry_after = self.breaker.allow()
+            if not allowed:
+                raise self.open_error(retry_after)
+            try:
+                result = function(*args)
+            except Exception as error:
+                error_class = getattr(error, 'error_class', None)
+                # neither unexpected errors (e.g. a bug of the caller) nor rejected requests
+                # tell anything about the provider's health
+                if error_class in (None, 'rejected'):
+                    self.breaker.release()
+                else:
+                    self.breaker.record(False)
+                if error_class is None:
+                    raise
+                delay = self.policy.delay(attempt, error_class, getattr(error, 'retry_after', None))
+                if delay is None:
+                    raise
+                self.count_retry(error_class)
+                self.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record(True)
+            return result
+
+    def count_retry(self, error_class):
+        with self.lock:
+            self.retries[error_class] += 1
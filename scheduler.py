@@ -0,0 +1,207 @@
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import ScheduledJob
+
+logger = logging.getLogger(__name__)
+
+# Scheduled sends
+# A send with "send_at" is stored as a job of the "scheduled_jobs" table (see "ScheduledJob" in "models.py")
+# instead of being sent. Every instance loads, every "poll_interval_seconds", the pending jobs due within
+# "horizon_seconds" (in run time order, "batch_size" at a time) into an in-process timer wheel, which
+# fires them on time without querying the database every tick. A fired job is claimed by a conditional
+# update (the rows locked by another instance are skipped), so when several instances load the same
+# job only one of them sends it. The jobs are persisted, so a restarted instance reloads them.
+
+# Hierarchical timer wheel: level 0 has one slot per tick, level n one slot per "slots ** n" ticks.
+# An item is kept in the lowest level whose range covers it and moves down a level when the wheel reaches
+# its slot, so adding an item and advancing a tick cost O(1) whatever the number of items
+class TimerWheel:
+    def __init__(self, tick_seconds=1, slots=64, levels=3, now=None):
+        self.tick_seconds = tick_seconds
+        self.slots = slots
+        self.levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        # next tick to process
+        self.current_tick = math.floor((time.time() if now is None else now) / tick_seconds)
+        self.size = 0
+
+    # Items due in the past are fired by the next "advance"
+    def add(self, item, due_time):
+        tick = max(math.ceil(due_time / self.tick_seconds), self.current_tick)
+        self.place(tick, item)
+        self.size += 1
+
+    def place(self, tick, item):
+        delta = tick - self.current_tick
+        for level, slots in enumerate(self.levels):
+            span = self.slots ** level
+            # the ticks beyond the top level's range wait in the top level for another turn
+            if delta < span * self.slots or level == len(self.levels) - 1:
+                slots[(tick // span) % self.slots].append((tick, item))
+                return
+
+    # Returns the items due at "now", in due time order
+    def advance(self, now):
+        last_tick = math.floor(now / self.tick_seconds)
+        if self.size == 0:
+            self.current_tick = max(self.current_tick, last_tick + 1)
+            return []
+        due = []
+        while self.current_tick <= last_tick:
+            # the upper slots starting at this tick are moved down first
+            for level in range(len(self.levels) - 1, 0, -1):
+                span = self.slots ** level
+                if self.current_tick % span == 0:
+                    slot = (self.current_tick // span) % self.slots
+                    entries, self.levels[level][slot] = self.levels[level][slot], []
+                    for tick, item in entries:
+                        self.place(tick, item)
+            slot = self.current_tick % self.slots
+            entries, self.levels[0][slot] = self.levels[0][slot], []
+            for tick, item in entries:
+                if tick <= self.current_tick:
+                    due.append(item)
+                else:
+                    self.place(tick, item)
+            self.current_tick += 1
+        self.size -= len(due)
+        return due
+
+# Run times of the "count" jobs of a campaign: spread evenly over "spread_seconds" from "send_at",
+# each delayed by a random jitter of up to "jitter_seconds"
+def spread_run_times(send_at, count, spread_seconds=0, jitter_seconds=0):
+    return [send_at + timedelta(seconds=spread_seconds * index / count + random.uniform(0, jitter_seconds))
+            for index in range(count)]
+
+class Scheduler:
+    def __init__(self, app, engine_getter, handlers, tick_seconds=1, horizon_seconds=60, poll_interval_seconds=5,
+                 batch_size=500, max_loaded_jobs=100000, workers=8, lease_seconds=600):
+        self.app = app
+        self.engine_getter = engine_getter
+        # kind -> function called with the payload of a job, returns its result
+        self.handlers = handlers
+        self.tick_seconds = tick_seconds
+        self.horizon_seconds = horizon_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.batch_size = batch_size
+        self.max_loaded_jobs = max_loaded_jobs
+        self.workers = workers
+        # a claim not finished within "lease_seconds" is considered lost (see "ScheduledJob.expire_claims")
+        self.lease_seconds = lease_seconds
+        self.wheel = TimerWheel(tick_seconds)
+        # ids of the jobs in the wheel
+        self.loaded = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.executor = None
+        self.worker_id = None
+        # finished jobs by status
+        self.finished = Counter()
+
+    # Started in the serving process (after the server forked its workers), every worker has its own id
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.worker_id = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scheduled-job')
+            self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+            self.thread.start()
+
+    # Jobs scheduled by this instance are added right away instead of waiting for the next poll
+    def add(self, job_id, run_at):
+        if run_at > datetime.now() + timedelta(seconds=self.horizon_seconds):
+            return
+        with self.lock:
+            if self.thread is not None and job_id not in self.loaded:
+                self.loaded.add(job_id)
+                self.wheel.add(job_id, run_at.timestamp())
+
+    def run(self):
+        next_load = 0
+        while not self.stopped.is_set():
+            if time.monotonic() >= next_load:
+                try:
+                    self.load_due_jobs()
+                except Exception:
+                    logger.exception('scheduled jobs loading failed')
+                next_load = time.monotonic() + self.poll_interval_seconds
+            with self.lock:
+                due = self.wheel.advance(time.time())
+                self.loaded.difference_update(due)
+            if due:
+                try:
+                    self.fire(due)
+                except Exception:
+                    # the jobs stay pending and are loaded again by the next poll
+                    logger.exception('scheduled jobs claiming failed', extra={'fields': {'jobs': len(due)}})
+            self.stopped.wait(self.tick_seconds)
+
+    def load_due_jobs(self):
+        current_time = datetime.now()
+        with self.engine_getter().begin() as connection:
+            ScheduledJob.expire_claims(current_time, connection)
+        horizon = current_time + timedelta(seconds=self.horizon_seconds)
+        after = None
+        while len(self.loaded) < self.max_loaded_jobs:
+            with self.engine_getter().connect() as connection:
+                rows = ScheduledJob.pending_until(horizon, after, self.batch_size, connection)
+            with self.lock:
+                for job_id, run_at in rows:
+                    if job_id not in self.loaded:
+                        self.loaded.add(job_id)
+                        self.wheel.add(job_id, run_at.timestamp())
+            if len(rows) < self.batch_size:
+                return
+            after = tuple(rows[-1])
+
+    def fire(self, job_ids):
+        for start in range(0, len(job_ids), self.batch_size):
+            lease_until = datetime.now() + timedelta(seconds=self.lease_seconds)
+            with self.engine_getter().begin() as connection:
+                jobs = ScheduledJob.claim(job_ids[start:start + self.batch_size], self.worker_id, lease_until, connection)
+            for job in jobs:
+                self.executor.submit(self.execute, job)
+
+    def execute(self, job):
+        try:
+            with self.app.app_context():
+                with self.engine_getter().begin() as connection:
+                    if self.stopped.is_set():
+                        ScheduledJob.release(job.id, self.worker_id, connection)
+                        return
+                    lease_until = datetime.now() + timedelta(seconds=self.lease_seconds)
+                    if not ScheduledJob.start(job.id, self.worker_id, lease_until, connection):
+                        return
+                try:
+                    result = self.handlers[job.kind](job.payload)
+                    status = 'done' if result.get('success', True) else 'failed'
+                    error = None
+                except Exception as ex:
+                    logger.exception('scheduled job failed', extra={'fields': {'job_id': job.id, 'kind': job.kind}})
+                    result = None
+                    status = 'failed'
+                    error = getattr(ex, 'exception_message', None) or str(ex) or type(ex).__name__
+                with self.engine_getter().begin() as connection:
+                    ScheduledJob.finish(job.id, self.worker_id, status, result, error, connection)
+                with self.lock:
+                    self.finished[status] += 1
+        except Exception:
+            logger.exception('scheduled job bookkeeping failed', extra={'fields': {'job_id': job.id}})
+
+    # The claimed jobs that have not started are given back, the running ones are finished
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,172 @@
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from exceptions import SMSProviderException
+from resilience import parse_retry_after, request_error_class
+
+logger = logging.getLogger(__name__)
+
+# SMS providers
+# Every provider sends one SMS with "send" (blocking, but bounded by the provider's timeout and
+# concurrency limit) and many SMSs concurrently with "send_many" on its own bounded thread pool.
+# The provider used by the app is selected by "sms_provider" in "config.py".
+
+class SMSProvider:
+    name = None
+
+    def __init__(self, max_concurrency=16):
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def send(self, contact, subject, message):
+        raise NotImplementedError
+
+    # Thread pool is created lazily, so providers can be created before the server forks its workers
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_concurrency, thread_name_prefix='sms-' + self.name)
+        return self._executor
+
+    def send_async(self, contact, subject, message):
+        return self.executor.submit(self.send, contact, subject, message)
+
+    # Sends the passed (contact, subject, message) tuples concurrently and returns, in the same order,
+    # the provider's message id of each SMS or the SMSProviderException it failed with
+    def send_many(self, messages):
+        futures = [self.send_async(contact, subject, message) for contact, subject, message in messages]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except SMSProviderException as ex:
+                results.append(ex)
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+# Logs the SMSs, used when no real provider is integrated
+class ConsoleSMSProvider(SMSProvider):
+    name = 'console'
+
+    def send(self, contact, subject, message):
+        logger.info('sms sent', extra={'fields': {'contact': contact, 'subject': subject, 'message': message}})
+        return None
+
+# Local provider that simulates a gateway without any network access (used for load tests),
+# every SMS takes "latency_seconds" and fails with a probability of "error_rate"
+class StubSMSProvider(SMSProvider):
+    name = 'stub'
+
+    def __init__(self, latency_seconds=0.05, error_rate=0.0, max_concurrency=16):
+        super().__init__(max_concurrency)
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+
+    def send(self, contact, subject, message):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if self.error_rate and random.random() < self.error_rate:
+            raise SMSProviderException('stub provider simulated failure', 502)
+        return uuid.uuid4().hex
+
+# Provider for an HTTP SMS gateway
+# All requests share one connection pool sized by the concurrency limit,
+# a request waiting longer than "timeout_seconds" for a free slot fails instead of queueing forever
+class HTTPSMSProvider(SMSProvider):
+    name = 'http'
+
+    def __init__(self, url, api_key=None, timeout_seconds=5, max_concurrency=16):
+        super().__init__(max_concurrency)
+        self.url = url
+        self.api_key = api_key
+        self.timeout_seconds = timeout_seconds
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    if self.api_key:
+                        session.headers['Authorization'] = 'Bearer ' + self.api_key
+                    self._session = session
+        return self._session
+
+    def send(self, contact, subject, message):
+        if not self.slots.acquire(timeout=self.timeout_seconds):
+            raise SMSProviderException('too many SMSs in flight', 503)
+        try:
+            response = self.session.post(
+                self.url, json={'to': contact, 'subject': subject, 'body': message}, timeout=self.timeout_seconds)
+        except requests.RequestException as ex:
+            error_class = request_error_class(ex)
+            raise SMSProviderException(str(ex), 504 if error_class == 'timeout' else 502, error_class)
+        finally:
+            self.slots.release()
+        if response.status_code >= 400:
+            if response.status_code == 429:
+                error_class = 'rate_limited'
+            elif response.status_code >= 500:
+                error_class = 'unavailable'
+            else:
+                error_class = 'rejected'
+            raise SMSProviderException('provider responded with status ' + str(response.status_code), 502,
+                                       error_class, parse_retry_after(response.headers.get('Retry-After')))
+        try:
+            return response.json().get('message_id')
+        except ValueError:
+            return None
+
+    def close(self):
+        super().close()
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+# Sends through another provider with a circuit breaker and retries (see "resilience.py")
+class ResilientSMSProvider(SMSProvider):
+    def __init__(self, provider, resilience):
+        super().__init__(provider.max_concurrency)
+        self.name = provider.name
+        self.provider = provider
+        self.resilience = resilience
+
+    def send(self, contact, subject, message):
+        return self.resilience.call(self.provider.send, contact, subject, message)
+
+    def close(self):
+        super().close()
+        self.provider.close()
+
+sms_providers = {
+    ConsoleSMSProvider.name: ConsoleSMSProvider,
+    StubSMSProvider.name: StubSMSProvider,
+    HTTPSMSProvider.name: HTTPSMSProvider
+}
+
+def create_sms_provider(name, **settings):
+    if name not in sms_providers:
+        raise ValueError('Unknown SMS provider: ' + str(name))
+    return sms_providers[name](**settings)
@@ -0,0 +1,106 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured logging
+# Records are JSON objects (one per line) written to the standard output by a background thread:
+# logging only puts the record on a bounded queue, so a slow log pipe never blocks a request.
+# When the queue is full the record is dropped and counted ("dropped") instead of waiting.
+# Structured fields are passed with extra={'fields': {...}}. A field whose JSON is longer than
+# "max_field_length" characters (e.g. a whole provider response) is kept for a sampled fraction
+# ("payload_sample_rate") of the records, the other records only keep its beginning and length.
+
+class JSONFormatter(logging.Formatter):
+    def __init__(self, max_field_length=2048, payload_sample_rate=0.01):
+        super().__init__()
+        self.max_field_length = max_field_length
+        self.payload_sample_rate = payload_sample_rate
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for name, value in getattr(record, 'fields', {}).items():
+            entry[name] = self.sample(value)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+    def sample(self, value):
+        serialized = json.dumps(value, default=str)
+        if len(serialized) <= self.max_field_length or random.random() < self.payload_sample_rate:
+            return value
+        return {'truncated': serialized[:self.max_field_length], 'length': len(serialized)}
+
+# Hands the records to a background listener without ever blocking, the listener
+# (and its queue) is started lazily in every process, so it also works in forked workers
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, target, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.pid = None
+        self.listener = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue_size)
+            self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    # Only the message is rendered by the caller, the JSON is formatted by the listener
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # Writes the queued records (at exit)
+    def stop(self):
+        if self.listener is None or self.pid != os.getpid():
+            return
+        try:
+            self.listener.stop()
+        except queue.Full:
+            pass
+        self.listener = None
+        self.pid = None
+
+def setup_logging(level='INFO', queue_size=10000, max_field_length=2048, payload_sample_rate=0.01, stream=None):
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JSONFormatter(max_field_length=max_field_length, payload_sample_rate=payload_sample_rate))
+    handler = NonBlockingQueueHandler(target, queue_size=queue_size)
+    root_logger = logging.getLogger()
+    root_logger.handlers = [handler]
+    root_logger.setLevel(level)
+    atexit.register(handler.stop)
+    return handler
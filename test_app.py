@@ -2,10 +2,43 @@ import os
 import unittest
 import json
 import time
+import asyncio
 
-from app import app, is_valid_contact_format
-from models import Message, Notification
-from config import api_limit_per_minute
+from app import app, is_valid_contact_format, parse_delivery_results, fcm_dispatcher, provider_resilience, replay_dead_letters_command
+from asgi import app as asgi_app
+from fcm_dispatcher import FCMDispatcher, merge_results
+from caching import CountingTTLCache
+from sms_providers import StubSMSProvider
+from async_providers import AsyncStubSMSProvider
+from exceptions import SMSProviderException, InvalidQueryParameterException
+from pagination import encode_cursor, decode_cursor, parse_fields
+from datetime import datetime, timedelta
+from exports import ndjson_chunks, gzip_chunks
+from rate_limiting import RateLimiter, MemoryStorage, SharedMemoryStorage, RedisStorage
+import tempfile
+import threading
+import socketserver
+import gzip
+from models import Client, Message, Notification, Token, TokenNotification, DeadLetter, db
+from history_log import HistoryLog
+from jobs import JobQueue
+from unit_of_work import unit_of_work, GroupCommitter
+from config import api_limit_per_minute, provider_retry_attempts
+from dead_tokens import DeadTokenSet
+from partitions import add_months, partition_name
+from profiling import RequestProfiler, summarize_statements
+from structured_logging import JSONFormatter, NonBlockingQueueHandler
+from idempotency import IdempotencyStore
+from scheduler import TimerWheel
+from metrics import Counter as MetricsCounter, shard_count
+from resilience import CircuitBreaker, Resilience, RetryPolicy, request_error_class
+from exceptions import IdempotencyKeyInProgressException, IdempotencyKeyReusedException, JobQueueFullException
+import logging
+import requests
+from flask import Flask, g
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.exc import DBAPIError
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
 
 class TestApp(unittest.TestCase):
     def setUp(self):
@@ -70,6 +103,36 @@ class TestApp(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(res_data['success'], False)
 
+    def test_send_sms_batch(self):
+        lines = [json.dumps(self.sms_json), json.dumps(self.invalid_sms_json), '', json.dumps(self.sms_json)]
+        res = self.client().post('/smss/batch', data='\n'.join(lines), content_type='application/x-ndjson')
+        results = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result['line'] for result in results], [1, 2, 4])
+        self.assertEqual(results[0]['success'], True)
+        self.assertEqual(results[1]['success'], False)
+        self.assertEqual(results[1]['error'], 400)
+        self.assertEqual(results[2]['success'], True)
+        self.assertTrue(Message.query.filter_by(id=results[2]['message_id']).first())
+
+    def test_get_client_messages(self):
+        self.client().post('/smss/batch', data=json.dumps(self.sms_json), content_type='application/x-ndjson').get_data()
+        res = self.client().get('/clients/' + self.valid_contact + '/messages?limit=1&fields=id,subject')
+        res_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res_data['success'], True)
+        self.assertEqual(len(res_data['messages']), 1)
+        self.assertEqual(set(res_data['messages'][0].keys()), {'id', 'subject'})
+
+    def test_get_notifications_invalid_cursor(self):
+        res = self.client().get('/notifications?cursor=invalid')
+        res_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res_data['success'], False)
+
     def test_send_sms_limit(self):
         #time.sleep(60)
         i = api_limit_per_minute + 1
@@ -81,6 +144,16 @@ class TestApp(unittest.TestCase):
         self.assertEqual(res.status_code, 429)
         self.assertEqual(res_data['success'], False)
 
+    def test_rotating_api_keys_are_limited_by_address(self):
+        statuses = []
+        for i in range(api_limit_per_minute + 1):
+            # a new contact every time, so only the per client limit applies
+            sms_json = dict(self.sms_json, contact='+2010091293%02d' % i)
+            res = self.client().post('/smss', json=sms_json, headers={'X-API-Key': 'random-' + str(i)},
+                                     environ_base={'REMOTE_ADDR': '192.0.2.1'})
+            statuses.append(res.status_code)
+        self.assertIn(429, statuses)
+
     def test_send_notification_to_topic(self):
         res = self.client().post('/notifications/topic', json=self.topic_json)
         res_data = json.loads(res.data)
@@ -118,6 +191,373 @@ class TestApp(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(res_data['success'], False)
 
+    def test_topic_members_count(self):
+        topic_url = '/topics/test-topic-' + str(time.time())
+        res = self.client().post(topic_url + '/members', json={'tokens': self.notification_json['tokens']})
+        res_data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res_data['member_count'], 2)
+
+        res = self.client().delete(topic_url + '/members', json={'tokens': self.notification_json['tokens'][:1]})
+        self.assertEqual(json.loads(res.data)['member_count'], 1)
+        res = self.client().get(topic_url)
+        self.assertEqual(json.loads(res.data)['member_count'], 1)
+
+    def test_unknown_segment_notification(self):
+        res = self.client().post('/segments/unknown-segment-' + str(time.time()) + '/notifications', json={'title': 'title', 'body': 'body'})
+        self.assertEqual(res.status_code, 404)
+
+    def test_metrics(self):
+        self.client().get('/notifications')
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_request_duration_seconds_count{route="/notifications",method="GET",status="200"}', res.data.decode())
+
+    def test_failed_statements_leave_no_db_timing_behind(self):
+        with self.app.test_request_context():
+            with db.engine.connect() as connection:
+                info = dict(connection.info)
+                for _ in range(3):
+                    with self.assertRaises(DBAPIError):
+                        connection.execute(text('SELECT 1 / 0'))
+                connection.execute(text('SELECT 1'))
+                self.assertEqual(dict(connection.info), info)
+            self.assertIn('db', g.stage_seconds)
+
+    def test_json_log_records_truncate_large_fields(self):
+        formatter = JSONFormatter(max_field_length=20, payload_sample_rate=0)
+        record = logging.makeLogRecord({'msg': 'sent %d', 'args': (2,), 'fields': {'tokens': 2, 'result': 'x' * 100}})
+        entry = json.loads(formatter.format(record))
+        self.assertEqual(entry['message'], 'sent 2')
+        self.assertEqual(entry['tokens'], 2)
+        self.assertEqual(entry['result']['length'], 102)
+
+    def test_full_log_queue_drops_records(self):
+        handler = NonBlockingQueueHandler(logging.NullHandler(), queue_size=1)
+        handler.start()
+        handler.listener.stop()
+        for _ in range(3):
+            handler.handle(logging.makeLogRecord({'msg': 'record'}))
+        self.assertEqual(handler.dropped, 2)
+
+    def test_health_checks(self):
+        self.assertEqual(self.client().get('/health/live').status_code, 200)
+        res = self.client().get('/health/ready')
+        res_data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res_data['checks']['database'])
+
+    def test_async_endpoint_shares_validation_errors(self):
+        messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': json.dumps({'tokens': [], 'title': 'title', 'body': 'body'}).encode()}
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': 'POST', 'path': '/notifications/tokens',
+                 'headers': [(b'content-type', b'application/json')], 'client': ('127.0.0.1', 5000)}
+        asyncio.run(asgi_app(scope, receive, send))
+        self.assertEqual(messages[0]['status'], 400)
+        self.assertEqual(json.loads(messages[1]['body'])['message'], 'Tokens list cannot be empty / nulled list')
+
+    def test_async_stub_provider_bounds_concurrency(self):
+        provider = AsyncStubSMSProvider(latency_seconds=0.05, max_concurrency=2)
+        async def send_all():
+            await provider.start()
+            start = time.monotonic()
+            await asyncio.gather(*[provider.send('+201009129288', 'subject', 'message') for _ in range(4)])
+            return time.monotonic() - start
+        # 4 SMSs, 2 at a time
+        self.assertGreaterEqual(asyncio.run(send_all()), 0.1)
+
+    def test_pool_checkout_wait_metrics(self):
+        self.client().get('/notifications')
+        res = self.client().get('/metrics')
+        self.assertIn('db_pool_checkout_wait_seconds_count{pool="primary"}', res.data.decode())
+
+    def test_idempotency_store_replays_the_first_response(self):
+        store = IdempotencyStore(maxsize=10, ttl_seconds=60)
+        calls = []
+        def work():
+            calls.append(1)
+            return {'status_code': 200, 'body': '{"success": true}', 'headers': {}}
+        response, replayed = store.execute('key', 'body', work)
+        self.assertFalse(replayed)
+        response, replayed = store.execute('key', 'body', work)
+        self.assertTrue(replayed)
+        self.assertEqual(response['body'], '{"success": true}')
+        self.assertEqual(len(calls), 1)
+        with self.assertRaises(IdempotencyKeyReusedException):
+            store.execute('key', 'other body', work)
+
+    def test_shared_idempotency_claim_outlives_the_wait_timeout(self):
+        # stands in for Redis: keys expire after their ttl
+        class SharedBackend:
+            def __init__(self):
+                self.values = {}
+            def live(self, key):
+                value, expires_at = self.values.get(key, (None, 0))
+                return value if expires_at > time.monotonic() else None
+            def get(self, key):
+                return self.live(key)
+            def claim(self, key, ttl_seconds):
+                if self.live(key + ':running') is not None:
+                    return False
+                self.values[key + ':running'] = ('1', time.monotonic() + ttl_seconds)
+                return True
+            def set(self, key, stored, ttl_seconds):
+                self.values[key] = (stored, time.monotonic() + ttl_seconds)
+            def release(self, key):
+                self.values.pop(key + ':running', None)
+        backend = SharedBackend()
+        # one store per process, the first request runs longer than the duplicates wait
+        first_process = IdempotencyStore(wait_timeout_seconds=0.1, claim_ttl_seconds=5, backend=backend)
+        second_process = IdempotencyStore(wait_timeout_seconds=0.1, claim_ttl_seconds=5, backend=backend)
+        started = threading.Event()
+        calls = []
+        def work():
+            calls.append(1)
+            started.set()
+            time.sleep(0.3)
+            return {'status_code': 200, 'body': '{"success": true}', 'headers': {}}
+        thread = threading.Thread(target=first_process.execute, args=('key', 'body', work))
+        thread.start()
+        started.wait()
+        time.sleep(0.15)
+        with self.assertRaises(IdempotencyKeyInProgressException):
+            second_process.execute('key', 'body', work)
+        thread.join()
+        response, replayed = second_process.execute('key', 'body', work)
+        self.assertTrue(replayed)
+        self.assertEqual(len(calls), 1)
+
+    def test_idempotent_sms_is_sent_once(self):
+        headers = {'Idempotency-Key': 'test-' + str(time.time())}
+        first = self.client().post('/smss', json=self.sms_json, headers=headers)
+        second = self.client().post('/smss', json=self.sms_json, headers=headers)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(json.loads(second.data)['message_id'], json.loads(first.data)['message_id'])
+        self.assertEqual(second.headers.get('Idempotent-Replayed'), 'true')
+
+    def test_timer_wheel_fires_items_in_due_order(self):
+        wheel = TimerWheel(tick_seconds=1, slots=4, levels=2, now=1000)
+        wheel.add('later', 1013)
+        wheel.add('soon', 1002)
+        wheel.add('overdue', 990)
+        # beyond the range of the top level
+        wheel.add('far', 1100)
+        self.assertEqual(wheel.advance(1000), ['overdue'])
+        self.assertEqual(wheel.advance(1005), ['soon'])
+        self.assertEqual(wheel.advance(1012), [])
+        self.assertEqual(wheel.advance(1013), ['later'])
+        self.assertEqual(wheel.advance(1099), [])
+        self.assertEqual(wheel.advance(1100), ['far'])
+
+    def test_scheduled_sms_can_be_cancelled(self):
+        res = self.client().post('/smss', json=dict(self.sms_json, send_at='tomorrow'))
+        self.assertEqual(res.status_code, 400)
+        send_at = (datetime.now() + timedelta(hours=1)).isoformat()
+        res = self.client().post('/smss', json=dict(self.sms_json, send_at=send_at, jitter_seconds=30))
+        self.assertEqual(res.status_code, 202)
+        job_id = json.loads(res.data)['scheduled_job_ids'][0]
+        res = self.client().delete('/scheduled-jobs/' + str(job_id))
+        self.assertEqual(json.loads(res.data)['scheduled_job']['status'], 'cancelled')
+
+    def test_replay_dead_letters_keeps_failed_tokens_pending(self):
+        title = 'replayed notification ' + str(time.time())
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                dead_letter_id = DeadLetter.store('notification_tokens', {
+                    'tokens': ['replay-a', 'replay-b'], 'title': title, 'body': 'body', 'notification_id': None
+                }, 'Unavailable', connection)
+        unavailable = {'replay-b'}
+        def post_payload(payload):
+            payload = json.loads(payload)
+            results = [{'error': 'Unavailable'} if token in unavailable else {'message_id': token}
+                       for token in payload.get('registration_ids') or [payload['to']]]
+            return {'success': sum(1 for result in results if 'error' not in result), 'results': results}
+        resilience = provider_resilience['fcm']
+        sleep = resilience.sleep
+        fcm_dispatcher.post_payload = post_payload
+        resilience.sleep = lambda seconds: None
+        try:
+            runner = self.app.test_cli_runner()
+            output = runner.invoke(replay_dead_letters_command, ['--kind', 'notification_tokens']).output
+            self.assertIn('partial %d' % dead_letter_id, output)
+            with self.app.app_context():
+                dead_letter = DeadLetter.query.get(dead_letter_id)
+                self.assertEqual(dead_letter.status, 'pending')
+                self.assertEqual(dead_letter.payload['tokens'], ['replay-b'])
+                self.assertEqual(DeadLetter.query.filter(DeadLetter.payload['title'].astext == title).count(), 1)
+            unavailable.clear()
+            output = runner.invoke(replay_dead_letters_command, ['--kind', 'notification_tokens']).output
+            self.assertIn('replayed %d' % dead_letter_id, output)
+            with self.app.app_context():
+                self.assertEqual(DeadLetter.query.get(dead_letter_id).status, 'replayed')
+                # stored in the history by the first replay only
+                self.assertEqual(Notification.query.filter_by(title=title).count(), 1)
+        finally:
+            del fcm_dispatcher.post_payload
+            resilience.sleep = sleep
+
+    def test_history_log_loads_appended_records(self):
+        directory = tempfile.mkdtemp()
+        with self.app.app_context():
+            client_id = Client.get_or_create_id(self.valid_contact)
+            db.session.commit()
+            history = HistoryLog(directory, lambda: db.engine)
+            message_id = history.log_message('', 'history body', client_id)
+            notification_id = history.log_notification('history title', 'body', {'history-token-a': None, 'history-token-b': 'Unavailable'})
+            history.close()
+            message = Message.query.filter_by(id=message_id).one()
+            # empty strings are not loaded as NULL
+            self.assertEqual(message.subject, '')
+            self.assertEqual(message.client_id, client_id)
+            self.assertEqual(Notification.query.filter_by(id=notification_id).one().title, 'history title')
+            errors = sorted(relation.error or '' for relation in TokenNotification.query.filter_by(notification_id=notification_id))
+            self.assertEqual(errors, ['', 'Unavailable'])
+            self.assertEqual(TokenNotification.query.filter_by(notification_id=notification_id, error=None).count(), 1)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_history_log_replays_crashed_segments_once(self):
+        directory = tempfile.mkdtemp()
+        with self.app.app_context():
+            crashed = HistoryLog(directory, lambda: db.engine)
+            notification_id = crashed.log_notification('crashed title', 'body', {'history-token-a': None, 'history-token-c': None})
+            crashed.stopped.set()
+            crashed.flusher.join()
+            crashed.sync()
+            with open(crashed.segment_path) as segment:
+                records = segment.read()
+            # the process dies while writing a record: its lock is released and the segment is left active
+            crashed.segment.write('{"type": "message", "id": ')
+            crashed.segment.close()
+            # the same records loaded again (e.g. a segment loaded right before the crash, but not deleted)
+            with open(os.path.join(directory, 'segment-0-0-000000.closed'), 'w') as segment:
+                segment.write(records)
+            restarted = HistoryLog(directory, lambda: db.engine)
+            restarted.recover_orphaned_segments()
+            restarted.load_closed_segments()
+            self.assertEqual(Notification.query.filter_by(id=notification_id).count(), 1)
+            self.assertEqual(TokenNotification.query.filter_by(notification_id=notification_id).count(), 2)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_async_sms_is_accepted_then_reported(self):
+        sms_json = dict(self.sms_json, contact='+201009129401')
+        res = self.client().post('/smss?async=true', json=sms_json, environ_base={'REMOTE_ADDR': '192.0.2.2'})
+        self.assertEqual(res.status_code, 202)
+        job_id = json.loads(res.data)['job_id']
+        self.assertTrue(res.headers['Location'].endswith('/jobs/' + job_id))
+        deadline = time.monotonic() + 10
+        while True:
+            job = json.loads(self.client().get('/jobs/' + job_id).data)['job']
+            if job['status'] not in ('queued', 'running') or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertTrue(job['result']['success'])
+        self.assertIsNotNone(job['result']['message_id'])
+
+    def test_unknown_job_is_not_found(self):
+        res = self.client().get('/jobs/unknown')
+        self.assertEqual(res.status_code, 404)
+
+    def test_full_job_queue_rejects_jobs(self):
+        job_queue = JobQueue(self.app, workers=1, max_queued_jobs=1)
+        started = threading.Event()
+        release = threading.Event()
+        def blocking_job():
+            started.set()
+            release.wait()
+        job_queue.submit(blocking_job)
+        started.wait()
+        # the worker is busy: one job waits in the queue, the next one is rejected
+        job_queue.submit(lambda: None)
+        with self.assertRaises(JobQueueFullException) as context:
+            job_queue.submit(lambda: None)
+        self.assertEqual(context.exception.status_code, 429)
+        release.set()
+        job_queue.shutdown()
+
+    def stored_contacts(self, contacts):
+        clients = Client.__table__
+        with db.engine.connect() as connection:
+            return {row[0] for row in connection.execute(select([clients.c.contact]).where(clients.c.contact.in_(contacts)))}
+
+    def test_unit_of_work_rolls_back_all_the_writes_of_a_failed_request(self):
+        contacts = ['uow-%s-%d' % (time.time(), i) for i in range(2)]
+        with self.app.app_context():
+            with self.assertRaises(ValueError):
+                with unit_of_work(db.session) as session:
+                    session.execute(Client.__table__.insert().values(contact=contacts[0]))
+                    session.execute(Client.__table__.insert().values(contact=contacts[1]))
+                    raise ValueError('failed mid-request')
+            self.assertEqual(self.stored_contacts(contacts), set())
+
+    def test_nested_units_of_work_commit_once(self):
+        contact = 'uow-nested-%s' % time.time()
+        with self.app.app_context():
+            with unit_of_work(db.session):
+                with unit_of_work(db.session) as nested_session:
+                    nested_session.execute(Client.__table__.insert().values(contact=contact))
+                # not committed by the nested unit of work
+                self.assertEqual(self.stored_contacts([contact]), set())
+            self.assertEqual(self.stored_contacts([contact]), {contact})
+
+    def test_group_commit_isolates_failing_writes(self):
+        contacts = ['uow-group-%s-%d' % (time.time(), i) for i in range(2)]
+        committer = GroupCommitter(lambda: db.engine, window_seconds=0.2)
+        def failing_write(connection):
+            connection.execute(Client.__table__.insert().values(contact=contacts[1]))
+            raise ValueError('failed write')
+        errors = []
+        def submit_failing_write():
+            try:
+                committer.submit(failing_write)
+            except ValueError as ex:
+                errors.append(ex)
+        with self.app.app_context():
+            thread = threading.Thread(target=submit_failing_write)
+            thread.start()
+            committer.submit(lambda connection: connection.execute(Client.__table__.insert().values(contact=contacts[0])))
+            thread.join()
+            committer.stop()
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(self.stored_contacts(contacts), {contacts[0]})
+
+    def test_upsert_many_resolves_duplicated_tokens_once(self):
+        tokens = ['upsert-%s-%d' % (time.time(), i) for i in range(2)]
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                token_ids = Token.upsert_many([tokens[0], tokens[1], tokens[0]], connection)
+                stored = connection.execute(select([Token.__table__.c.token, Token.__table__.c.id])
+                                            .where(Token.__table__.c.token.in_(tokens))).fetchall()
+        self.assertEqual(token_ids, dict(stored))
+
+    def test_upsert_many_keeps_existing_tokens(self):
+        tokens = ['upsert-%s-%d' % (time.time(), i) for i in range(3)]
+        tokens_table = Token.__table__
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                existing_ids = Token.upsert_many(tokens[:2], connection)
+            versions = select([tokens_table.c.token, text('xmin::text')]).where(tokens_table.c.token.in_(tokens[:2]))
+            with db.engine.connect() as connection:
+                existing_versions = connection.execute(versions).fetchall()
+            notification_time = datetime.now()
+            with db.engine.begin() as connection:
+                token_ids = Token.upsert_many(tokens[1:], connection)
+                notification_id = connection.execute(Notification.__table__.insert().values(
+                    title='upsert', body='upsert', time=notification_time).returning(Notification.__table__.c.id)).scalar()
+                TokenNotification.insert_many({token_ids[tokens[1]]: None, token_ids[tokens[2]]: 'NotRegistered'},
+                                              notification_id, notification_time, connection)
+            with db.engine.connect() as connection:
+                # the existing rows are not written again
+                self.assertEqual(connection.execute(versions).fetchall(), existing_versions)
+                relations = connection.execute(select([TokenNotification.__table__.c.token_id, TokenNotification.__table__.c.error])
+                                               .where(TokenNotification.__table__.c.notification_id == notification_id)).fetchall()
+        self.assertEqual(token_ids[tokens[1]], existing_ids[tokens[1]])
+        self.assertNotIn(token_ids[tokens[2]], existing_ids.values())
+        self.assertEqual(dict(relations), {token_ids[tokens[1]]: None, token_ids[tokens[2]]: 'NotRegistered'})
+
     # Testing HTTPException Handler
     # Example:
     def test_405_method_not_allowed(self):
@@ -142,5 +582,232 @@ class TestApp(unittest.TestCase):
         expected_value = True
         self.assertEqual(expected_value, tested_value)
 
+    def test_merge_results_of_multiple_chunks(self):
+        chunk_results = [
+            {'multicast_id': 1, 'success': 2, 'failure': 0, 'canonical_ids': 0, 'results': [{'message_id': 'a'}, {'message_id': 'b'}]},
+            {'multicast_id': 2, 'success': 0, 'failure': 1, 'canonical_ids': 0, 'results': [{'error': 'NotRegistered'}]}
+        ]
+        merged = merge_results(chunk_results)
+        self.assertEqual(merged['multicast_ids'], [1, 2])
+        self.assertEqual(merged['success'], 2)
+        self.assertEqual(merged['failure'], 1)
+        self.assertEqual(len(merged['results']), 3)
+        self.assertEqual(merged['results'][2], {'error': 'NotRegistered'})
+
+    def test_parse_delivery_results(self):
+        result = {'success': 1, 'failure': 1, 'results': [{'message_id': '0:1'}, {'error': 'NotRegistered'}]}
+        self.assertEqual(parse_delivery_results(['a', 'b'], result), {'a': None, 'b': 'NotRegistered'})
+
+    def test_dead_token_set_filters_added_tokens(self):
+        dead_tokens = DeadTokenSet(lambda: None, refresh_interval_seconds=60)
+        dead_tokens.add(['b'])
+        self.assertEqual(dead_tokens.filter(['a', 'b', 'c']), (['a', 'c'], ['b']))
+
+    def test_dispatcher_chunks_registration_ids(self):
+        dispatcher = FCMDispatcher('test-api-key', chunk_size=2)
+        chunks = list(dispatcher.chunks(['a', 'b', 'c', 'd', 'e']))
+        self.assertEqual(chunks, [['a', 'b'], ['c', 'd'], ['e']])
+
+    def test_dispatcher_resends_tokens_with_retryable_errors(self):
+        resilience = Resilience(RetryPolicy({'unavailable': 3}), CircuitBreaker(), None, sleep=lambda seconds: None)
+        dispatcher = FCMDispatcher('test-api-key', chunk_size=2, resilience=resilience)
+        sent = []
+        def post_payload(payload):
+            payload = json.loads(payload)
+            # a single token is sent as "to"
+            tokens = payload.get('registration_ids') or [payload['to']]
+            sent.append(tokens)
+            results = [{'error': 'Unavailable'} if token == 'b' and len(sent) == 1 else {'message_id': token} for token in tokens]
+            return {'success': sum(1 for result in results if 'error' not in result), 'results': results}
+        dispatcher.post_payload = post_payload
+        result = dispatcher.notify_multiple_devices(['a', 'b'])
+        self.assertEqual(sent, [['a', 'b'], ['b']])
+        self.assertEqual(result['success'], 2)
+        self.assertEqual(result['failure'], 0)
+
+    def test_provider_call_retries_wait_for_retry_after(self):
+        delays = []
+        resilience = Resilience(RetryPolicy({'rate_limited': 3}), CircuitBreaker(), None, sleep=delays.append)
+        failures = [SMSProviderException('busy', 502, 'rate_limited', 2) for _ in range(2)]
+        def send():
+            if failures:
+                raise failures.pop()
+            return 'message-id'
+        self.assertEqual(resilience.call(send), 'message-id')
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(all(delay >= 2 for delay in delays))
+        # rejected requests are not retried
+        with self.assertRaises(SMSProviderException):
+            resilience.call(lambda: (_ for _ in ()).throw(SMSProviderException('invalid', 502, 'rejected')))
+        self.assertEqual(len(delays), 2)
+
+    def test_only_failures_to_connect_are_retried_by_default(self):
+        refused = requests.ConnectionError(MaxRetryError(None, '/send', NewConnectionError(None, 'refused')))
+        self.assertEqual(request_error_class(refused), 'connection')
+        self.assertEqual(request_error_class(requests.ConnectTimeout()), 'connection')
+        self.assertEqual(request_error_class(requests.ReadTimeout()), 'timeout')
+        self.assertEqual(request_error_class(requests.ConnectionError(ProtocolError('reset'))), 'disconnected')
+        policy = RetryPolicy(provider_retry_attempts)
+        self.assertIsNotNone(policy.delay(0, 'connection'))
+        self.assertIsNone(policy.delay(0, 'timeout'))
+        self.assertIsNone(policy.delay(0, 'disconnected'))
+
+    def test_circuit_breaker_opens_on_failure_rate(self):
+        breaker = CircuitBreaker(failure_rate_threshold=0.5, min_calls=4, window_seconds=10, open_seconds=5)
+        for success in (True, False, True, False):
+            breaker.record(success, now=100)
+        self.assertEqual(breaker.allow(now=101), (False, 4))
+        # one probe call once "open_seconds" have passed
+        self.assertEqual(breaker.allow(now=105), (True, 0))
+        self.assertFalse(breaker.allow(now=105)[0])
+        breaker.record(True, now=105)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_unexpected_errors_do_not_close_the_circuit(self):
+        breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+        breaker.record(False)
+        resilience = Resilience(RetryPolicy({}), breaker, None, sleep=lambda seconds: None)
+        with self.assertRaises(ValueError):
+            resilience.call(lambda: (_ for _ in ()).throw(ValueError('bug')))
+        # the probe is given back, the next call probes the provider
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(resilience.call(lambda: 'message-id'), 'message-id')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_metric_shards_do_not_grow_with_threads(self):
+        counter = MetricsCounter('test_total', 'test')
+        threads = [threading.Thread(target=counter.inc) for _ in range(100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(counter.shards), shard_count)
+        self.assertEqual(counter.collect(), {'[]': 100})
+
+    def test_counting_ttl_cache_counts_hits_and_misses(self):
+        cache = CountingTTLCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get('+201009129288'))
+        cache.set('+201009129288', 1)
+        self.assertEqual(cache.get('+201009129288'), 1)
+        cache.set('+201009129288', 1)
+        cache.set('+201009129289', 2)
+        cache.set('+201009129290', 3)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 2)
+
+    def test_stub_sms_provider_error_rate(self):
+        messages = [(self.valid_contact, 'testSubject', 'test message body')] * 3
+        failing_provider = StubSMSProvider(latency_seconds=0, error_rate=1)
+        working_provider = StubSMSProvider(latency_seconds=0, error_rate=0)
+
+        failing_results = failing_provider.send_many(messages)
+        working_results = working_provider.send_many(messages)
+
+        self.assertTrue(all(isinstance(result, SMSProviderException) for result in failing_results))
+        self.assertFalse(any(isinstance(result, SMSProviderException) for result in working_results))
+
+    def test_cursor_round_trip(self):
+        time = datetime(2021, 3, 4, 21, 12, 47, 730519)
+        self.assertEqual(decode_cursor(encode_cursor(time, 42)), (time, 42))
+
+    def test_parse_fields_rejects_unknown_fields(self):
+        self.assertEqual(parse_fields('id,title', ['id', 'title', 'body']), ['id', 'title'])
+        self.assertEqual(parse_fields(None, ['id', 'title']), ['id', 'title'])
+        with self.assertRaises(InvalidQueryParameterException):
+            parse_fields('id,password', ['id', 'title'])
+
+    def test_gzip_ndjson_export_chunks(self):
+        row_chunks = [[{'id': 1, 'time': datetime(2021, 3, 1)}], [{'id': 2, 'time': datetime(2021, 3, 2)}]]
+        compressed = b''.join(gzip_chunks(ndjson_chunks(row_chunks)))
+        lines = gzip.decompress(compressed).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'id': 1, 'time': '2021-03-01T00:00:00'},
+            {'id': 2, 'time': '2021-03-02T00:00:00'}
+        ])
+
+    def test_export_messages(self):
+        self.client().post('/smss/batch', data=json.dumps(self.sms_json), content_type='application/x-ndjson').get_data()
+        res = self.client().get('/exports/messages?from=2000-01-01&to=2100-01-01&format=csv')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,subject,body,time,client_id,contact')
+        self.assertTrue(len(lines) > 1)
+
+    def test_partition_months(self):
+        self.assertEqual(add_months(datetime(2021, 11, 1), 3), datetime(2022, 2, 1))
+        self.assertEqual(add_months(datetime(2021, 1, 1), -12), datetime(2020, 1, 1))
+        self.assertEqual(partition_name('messages', datetime(2021, 3, 1)), 'messages_p2021_03')
+
+    def test_summarize_statements_groups_repeated_statements(self):
+        queries = [('SELECT * FROM tokens WHERE token = %(token_1)s', 0.001)] * 3 + [('INSERT INTO notifications', 0.002)]
+        statements = summarize_statements(queries)
+        self.assertEqual(statements[0]['statement'], 'SELECT * FROM tokens WHERE token = %(token_1)s')
+        self.assertEqual(statements[0]['count'], 3)
+        self.assertEqual(statements[1]['count'], 1)
+
+    def test_sampled_profiles_are_not_returned_to_the_client(self):
+        profiled_app = Flask('profiled')
+        profiled_app.route('/')(lambda: 'ok')
+        directory = tempfile.mkdtemp()
+        RequestProfiler(directory, sample_rate=1, token='secret').init_app(profiled_app, create_engine('sqlite://'))
+        self.assertNotIn('X-Profile', profiled_app.test_client().get('/').headers)
+        self.assertIn('X-Profile', profiled_app.test_client().get('/', headers={'X-Profile': 'secret'}).headers)
+        self.assertEqual(len(os.listdir(directory)), 4)
+
+    def test_sliding_window_rate_limit(self):
+        limiter = RateLimiter(MemoryStorage())
+        hits = [limiter.hit('contact', 5, 60, now=1000)[0] for _ in range(6)]
+        self.assertEqual(hits, [True] * 5 + [False])
+        # half of the previous window is still covered by the sliding window: 5 * 0.5 + 3 > 5
+        hits = [limiter.hit('contact', 5, 60, now=1050)[0] for _ in range(3)]
+        self.assertEqual(hits, [True, True, False])
+
+    def test_shared_memory_rate_limit_storage(self):
+        path = os.path.join(tempfile.mkdtemp(), 'rate_limits')
+        first_worker_limiter = RateLimiter(SharedMemoryStorage(path, slots=64))
+        second_worker_limiter = RateLimiter(SharedMemoryStorage(path, slots=64))
+        self.assertEqual(first_worker_limiter.hit('api_key', 2, 60, now=1000)[0], True)
+        self.assertEqual(second_worker_limiter.hit('api_key', 2, 60, now=1000)[0], True)
+        self.assertEqual(first_worker_limiter.hit('api_key', 2, 60, now=1000)[0], False)
+
+    def test_redis_rate_limit_storage_against_local_stand_in(self):
+        counters = {}
+
+        # Stand-in that speaks enough of the Redis protocol for the storage (INCRBY and PEXPIRE)
+        class RedisStandIn(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    arguments = []
+                    for _ in range(int(line[1:])):
+                        length = int(self.rfile.readline()[1:])
+                        arguments.append(self.rfile.read(length + 2)[:-2].decode())
+                    if arguments[0] == 'INCRBY':
+                        counters[arguments[1]] = counters.get(arguments[1], 0) + int(arguments[2])
+                        self.wfile.write(b':%d\r\n' % counters[arguments[1]])
+                    else:
+                        self.wfile.write(b':1\r\n')
+
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), RedisStandIn)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'redis://127.0.0.1:%d/0' % server.server_address[1]
+        try:
+            first_host_storage = RedisStorage(url, sync_interval_seconds=60)
+            second_host_storage = RedisStorage(url, sync_interval_seconds=60)
+            first_host_storage.incr('topic:news', 10, 60, 3)
+            first_host_storage.sync()
+            second_host_storage.incr('topic:news', 10, 60, 1)
+            second_host_storage.sync()
+            self.assertEqual(second_host_storage.incr('topic:news', 10, 60, 1), (5, 0))
+        finally:
+            server.shutdown()
+            server.server_close()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, text
+
+from app import app, client_id_cache, store_sms_in_db, store_notification_in_db, store_tokens_notification_relation_in_db
+from models import db, Token, Topic
+from exports import export
+from dead_tokens import DeadTokenSet
+
+# Query plan regression suite
+# A synthetic dataset is seeded once (its size is set by the "query_plan_rows" environment variable),
+# then the statements the app issues are captured while its endpoints and storage functions run,
+# and explained with "EXPLAIN (FORMAT JSON)". The suite fails when:
+# - a plan scans sequentially a table (or partition) of more than "large_table_rows" rows,
+# - the estimated cost of a plan exceeds its cost in "query_plan_baseline.json" by more than "cost_tolerance",
+# - a plan has no cost in the baseline (a new statement, or a scenario that issues its statements in another order).
+# Run it with "update_query_plan_baseline=true" to record the current costs as the new baseline.
+# Writes are captured inside transactions that are rolled back, so the dataset is not modified.
+
+seed_rows = int(os.environ.get('query_plan_rows', 200000))
+# the history tables ("seed_rows" rows) must not be scanned, the smaller tables of the dataset
+# (a tenth of it at most) may be: the planner rightly prefers a scan of a few hundred pages to as many index lookups
+large_table_rows = seed_rows // 4
+cost_tolerance = 0.5
+# costs this close to their baseline always pass (the tolerance alone would fail any cost above a baseline of 0)
+cost_margin = 1
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plan_baseline.json')
+update_baseline = os.environ.get('update_query_plan_baseline', 'false').lower() == 'true'
+
+# the dataset is seeded once per database (whatever the size requested afterwards)
+seed_marker = 'plan-seeded'
+
+seed_statements = """
+    INSERT INTO clients (contact) SELECT 'plan-client-' || i FROM generate_series(1, :clients) i;
+
+    INSERT INTO messages (subject, body, time, client_id)
+    SELECT 'plan subject', 'plan body', now() - random() * interval '60 days', clients.id
+    FROM generate_series(1, :messages) i
+    JOIN clients ON clients.contact = 'plan-client-' || (i % :clients + 1);
+
+    INSERT INTO tokens (token, active, inactive_reason, inactive_since)
+    SELECT 'plan-token-' || i, i % 50 <> 0,
+           CASE WHEN i % 50 = 0 THEN 'NotRegistered' END, CASE WHEN i % 50 = 0 THEN now() END
+    FROM generate_series(1, :tokens) i;
+
+    INSERT INTO notifications (title, body, time)
+    SELECT 'plan-notification-' || i, 'plan body', now() - random() * interval '60 days'
+    FROM generate_series(1, :notifications) i;
+
+    INSERT INTO tokennotifications (token_id, notification_id, time)
+    SELECT tokens.id, notifications.id, notifications.time
+    FROM generate_series(1, :relations) i
+    JOIN tokens ON tokens.token = 'plan-token-' || (i % :tokens + 1)
+    JOIN notifications ON notifications.title = 'plan-notification-' || (i % :notifications + 1);
+
+    INSERT INTO topics (name, kind, member_count, created_at) VALUES ('plan-topic', 'segment', :tokens, now());
+
+    INSERT INTO topic_members (topic_id, token_id, created_at)
+    SELECT topics.id, tokens.id, now() FROM topics, tokens
+    WHERE topics.kind = 'segment' AND topics.name = 'plan-topic' AND tokens.token LIKE 'plan-token-%';
+
+    INSERT INTO clients (contact) VALUES (:marker);
+"""
+
+# Statements executed by the foreign keys' cascading deletes (they do not appear in the plans of the deletes)
+cascade_statements = {
+    'cascade_client_messages': ('DELETE FROM messages WHERE client_id = %(id)s', {'id': 1}),
+    'cascade_notification_relations': (
+        'DELETE FROM tokennotifications WHERE notification_id = %(id)s AND time = %(time)s', {'id': 1, 'time': datetime.now()}),
+    'cascade_token_relations': ('DELETE FROM tokennotifications WHERE token_id = %(id)s', {'id': 1}),
+    'cascade_token_memberships': ('DELETE FROM topic_members WHERE token_id = %(id)s', {'id': 1})
+}
+
+def seed(connection):
+    if connection.execute(text('SELECT 1 FROM clients WHERE contact = :marker'), {'marker': seed_marker}).first():
+        return
+    connection.execute(text(seed_statements), {
+        'clients': max(seed_rows // 20, 1),
+        'messages': seed_rows,
+        'tokens': max(seed_rows // 10, 1),
+        'notifications': max(seed_rows // 10, 1),
+        'relations': seed_rows,
+        'marker': seed_marker
+    })
+
+# Collects the statements executed on the engine by the current thread (the first occurrence of each statement),
+# the statements of the background threads (e.g. the scheduler's polls) are not part of the scenario
+class StatementRecorder:
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.thread_id = threading.get_ident()
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, connection, cursor, statement, parameters, context, executemany):
+        if executemany or threading.get_ident() != self.thread_id:
+            return
+        if not statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+            return
+        if statement not in [recorded for recorded, _ in self.statements]:
+            self.statements.append((statement, parameters))
+
+# Runs "work(connection)" in a transaction that is rolled back
+def rolled_back(work):
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            work(connection)
+        finally:
+            transaction.rollback()
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+class TestQueryPlans(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = app.test_client()
+        with app.app_context():
+            with db.engine.begin() as connection:
+                seed(connection)
+            with db.engine.connect() as connection:
+                connection.execution_options(isolation_level='AUTOCOMMIT').execute(text('ANALYZE'))
+            cls.plans = cls.explain(cls.capture_statements())
+            cls.table_rows = cls.relation_rows()
+
+    @classmethod
+    def scenarios(cls):
+        now = datetime.now()
+        topic_id = Topic.query.filter_by(kind='segment', name='plan-topic').first().id
+        deliveries = {'plan-token-%d' % i: None for i in range(1, 101)}
+
+        def client_messages():
+            client_id_cache.clear()
+            first_page = json.loads(cls.client.get('/clients/plan-client-1/messages?limit=5').data)
+            cls.client.get('/clients/plan-client-1/messages?limit=5&cursor=' + first_page['next_cursor'])
+
+        def store_notification_history(connection):
+            notification_id = store_notification_in_db('plan title', 'plan body', now, connection)
+            store_tokens_notification_relation_in_db(deliveries, notification_id, now, connection)
+            Token.mark_inactive({'plan-token-1': 'NotRegistered'}, connection)
+
+        def update_audience(connection):
+            Topic.get_or_create('segment', 'plan-topic', connection)
+            Topic.add_members(topic_id, list(deliveries), connection)
+            Topic.remove_members(topic_id, list(deliveries), connection)
+
+        return {
+            'client_messages': client_messages,
+            'notifications_with_tokens': lambda: cls.client.get('/notifications?tokens=true'),
+            'token_notifications': lambda: cls.client.get('/tokens/plan-token-1/notifications'),
+            'export_messages': lambda: list(export(db.engine, 'messages', now - timedelta(days=1), now)),
+            'export_notifications': lambda: list(export(db.engine, 'notifications', now - timedelta(days=1), now)),
+            'dead_tokens_refresh': lambda: DeadTokenSet(lambda: db.engine).refresh(),
+            'audience_members': lambda: next(Topic.member_batches(db.engine, topic_id, 1000)),
+            'store_sms': lambda: rolled_back(lambda connection: store_sms_in_db('plan-client-new', 'subject', 'body', None, connection)),
+            'store_notification_history': lambda: rolled_back(store_notification_history),
+            'update_audience': lambda: rolled_back(update_audience)
+        }
+
+    # Returns {name: (statement, parameters)} of all the statements issued by the scenarios,
+    # named after their scenario and their text (so the names do not depend on the order of the statements)
+    @classmethod
+    def capture_statements(cls):
+        statements = dict(cascade_statements)
+        for name, scenario in cls.scenarios().items():
+            with StatementRecorder(db.engine) as recorder:
+                scenario()
+            for statement, parameters in recorder.statements:
+                statements['%s:%s' % (name, hashlib.sha1(statement.encode()).hexdigest()[:8])] = (statement, parameters)
+        return statements
+
+    @classmethod
+    def explain(cls, statements):
+        plans = {}
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for name, (statement, parameters) in statements.items():
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+                plans[name] = cursor.fetchone()[0][0]['Plan']
+        finally:
+            connection.rollback()
+            connection.close()
+        return plans
+
+    @classmethod
+    def relation_rows(cls):
+        with db.engine.connect() as connection:
+            rows = connection.execute(text("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'"))
+            return {row[0]: row[1] for row in rows}
+
+    def test_no_sequential_scans_on_large_tables(self):
+        for name, plan in self.plans.items():
+            for node in plan_nodes(plan):
+                if node['Node Type'] != 'Seq Scan':
+                    continue
+                rows = self.table_rows.get(node['Relation Name'], 0)
+                self.assertLess(rows, large_table_rows,
+                                '%s scans sequentially %s (%d rows)' % (name, node['Relation Name'], rows))
+
+    def test_plan_costs_do_not_regress(self):
+        costs = {name: plan['Total Cost'] for name, plan in self.plans.items()}
+        if update_baseline:
+            with open(baseline_path, 'w') as baseline_file:
+                json.dump(costs, baseline_file, indent=2, sort_keys=True)
+            return
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        for name, cost in costs.items():
+            self.assertIn(name, baseline, '%s has no baseline (record it with update_query_plan_baseline=true)' % name)
+            self.assertLessEqual(cost, baseline[name] * (1 + cost_tolerance) + cost_margin,
+                                 '%s costs %.1f (baseline %.1f)' % (name, cost, baseline[name]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from sqlalchemy import event
+
+# Request scoped unit of work
+# All the writes done inside "unit_of_work" (during the same request / job app context) are
+# flushed in one transaction that is committed once at the end of the outermost unit of work,
+# or rolled back entirely if anything fails. Nested units of work join the outermost one.
+
+def in_unit_of_work():
+    return has_app_context() and g.get('unit_of_work_depth', 0) > 0
+
+@contextmanager
+def unit_of_work(session):
+    if in_unit_of_work():
+        g.unit_of_work_depth += 1
+        try:
+            yield session
+        finally:
+            g.unit_of_work_depth -= 1
+        return
+
+    g.unit_of_work_depth = 1
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        g.unit_of_work_depth = 0
+
+# Group commit
+# Writes submitted by concurrent requests are executed by one committer thread that merges them
+# into shared transactions (up to "max_batch" writes, waiting at most "window_seconds" for more),
+# so N concurrent requests cost one commit (and one fsync) instead of N.
+# Each write runs in its own savepoint, a failing write is rolled back alone and its error
+# is raised in the request that submitted it. The submitting request waits for the shared commit.
+class GroupCommitter:
+    def __init__(self, engine_getter, max_batch=64, window_seconds=0.002):
+        self.engine_getter = engine_getter
+        self.max_batch = max_batch
+        self.window_seconds = window_seconds
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    # Executes "work(connection)" in the next shared transaction and returns its result once committed
+    def submit(self, work):
+        future = Future()
+        with self.condition:
+            self.start()
+            self.pending.append((work, future))
+            self.condition.notify()
+        return future.result()
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run, name='group-committer', daemon=True)
+            self.thread.start()
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending and not self.stopped:
+                self.condition.wait()
+            if not self.pending:
+                return []
+            deadline = time.monotonic() + self.window_seconds
+            while len(self.pending) < self.max_batch and not self.stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            self.commit_batch(batch)
+
+    def commit_batch(self, batch):
+        results = []
+        try:
+            with self.engine_getter().begin() as connection:
+                for work, future in batch:
+                    savepoint = connection.begin_nested()
+                    try:
+                        results.append((future, work(connection), None))
+                        savepoint.commit()
+                    except Exception as ex:
+                        savepoint.rollback()
+                        results.append((future, None, ex))
+        except Exception as ex:
+            # the shared commit itself failed, so none of the writes is stored
+            for _, future in batch:
+                future.set_exception(ex)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+# Counts the commits issued on an engine, in total and for the current request (or job)
+class CommitCounter:
+    def __init__(self):
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def install(self, engine):
+        event.listen(engine, 'commit', self.on_commit)
+
+    def on_commit(self, connection):
+        with self.lock:
+            self.total += 1
+        if has_app_context():
+            g.db_commits = g.get('db_commits', 0) + 1
+
+    @staticmethod
+    def current():
+        return g.get('db_commits', 0) if has_app_context() else 0
@@ -0,0 +1,80 @@
+import re
+from datetime import datetime
+
+from exceptions import InvalidContactException, InvalidFieldException, JSONBodyFormatException, MissingJSONBodyException, RegistrationIDsNULLException
+from config import schedule_max_window_seconds
+
+# Validation of the send requests, shared by the Flask app ("app.py") and the ASGI app ("asgi.py")
+
+contact_fixed_length = 13
+
+# Validate the passed contact with respect to its country code and its format
+def is_valid_contact_format(client_contact):
+    # check that the contact starts with '+20' which is Egypt's country code 
+    # and end with number
+    # example: +201009129288
+    is_valid_format = re.search("[\'+20\'].+[0123456789]$", client_contact)
+    #check that the contact is all numeric
+    is_valid_contact = client_contact[1:len(client_contact)].isnumeric()
+    #check that the contact contains 13 character ('+' sign and 12 numeric)
+    is_valid_contact_len = len(client_contact) == contact_fixed_length
+    return is_valid_format and is_valid_contact and is_valid_contact_len
+
+# Validate the JSON body of an SMS and return its (contact, subject, message)
+def validate_sms_body(body):
+    if not body:
+        raise MissingJSONBodyException(status_code=400)
+    if not isinstance(body, dict) or 'contact' not in body or 'subject' not in body or 'message' not in body:
+        raise JSONBodyFormatException(status_code=400)
+
+    contact = body.get('contact')
+    subject = body.get('subject')
+    message = body.get('message')
+
+    if not isinstance(contact, str) or not is_valid_contact_format(contact):
+        #if contact is not valid, raise exception with status code: 400 Bad Request
+        raise InvalidContactException(str(contact), 400)
+    return contact, subject, message
+
+# Validate the JSON body of a notification to tokens and return its (tokens, title, body)
+def validate_tokens_notification_body(body):
+    if not body:
+        raise MissingJSONBodyException(status_code=400)
+    if not isinstance(body, dict) or 'tokens' not in body or 'title' not in body or 'body' not in body:
+        raise JSONBodyFormatException(status_code=400)
+
+    tokens = body.get('tokens')
+    # if passed tokens list is empty, raise exception with status code: 400 Bad Request
+    if not tokens:
+        raise RegistrationIDsNULLException(status_code=400)
+    return tokens, body.get('title'), body.get('body')
+
+# Validate the JSON body of a notification to an FCM topic and return its (topic, title, body)
+def validate_topic_notification_body(body):
+    if not body:
+        raise MissingJSONBodyException(status_code=400)
+    if not isinstance(body, dict) or 'topic' not in body or 'title' not in body or 'body' not in body:
+        raise JSONBodyFormatException(status_code=400)
+    return body.get('topic'), body.get('title'), body.get('body')
+
+# Validate the optional schedule of a send and return its (send_at, jitter seconds, spread seconds),
+# send_at is None when the send is not scheduled. "send_at" is an ISO 8601 date (local time unless it has
+# an offset), "jitter_seconds" and "spread_seconds" are at most "schedule_max_window_seconds"
+def validate_schedule(body):
+    send_at = body.get('send_at')
+    if send_at is None:
+        return None, 0, 0
+    try:
+        send_at = datetime.fromisoformat(send_at.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        raise InvalidFieldException('send_at', 400)
+    if send_at.tzinfo is not None:
+        send_at = send_at.astimezone().replace(tzinfo=None)
+
+    windows = []
+    for name in ('jitter_seconds', 'spread_seconds'):
+        value = body.get(name, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= schedule_max_window_seconds:
+            raise InvalidFieldException(name, 400)
+        windows.append(value)
+    return (send_at,) + tuple(windows)